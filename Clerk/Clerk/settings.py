@@ -10,6 +10,7 @@ https://docs.djangoproject.com/en/1.6/ref/settings/
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
+import sys
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 
 
@@ -41,10 +42,12 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'clerk.instrumentation.QueryCountMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'clerk.audit.AuditUserMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
@@ -71,6 +74,26 @@ DATABASES = {
 #     )
 # }
 
+# Caches
+# https://docs.djangoproject.com/en/1.6/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Rendered current and future rate responses, shared by every process
+    # so they see each other's purges. Memcached also works. Tests use
+    # their own in memory, see clerk.runner.
+    'rates': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('CLERK_RATE_CACHE_DIR',
+                                   os.path.join(BASE_DIR, 'rate_cache')),
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+
+TEST_RUNNER = 'clerk.runner.TestRunner'
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
 
@@ -91,3 +114,71 @@ USE_TZ = False
 STATIC_URL = '/static/'
 
 TEMPLATE_DIRS = [os.path.join(BASE_DIR, 'templates')]
+
+# Clerk
+
+# Seconds each process trusts its in-memory rate timelines before
+# rebuilding them from the database.
+CLERK_TIMELINE_TIMEOUT = 300
+# Services whose rate timelines each process keeps, the least recently
+# used being dropped first.
+CLERK_TIMELINE_MAX_ENTRIES = 10000
+
+# Seconds each process trusts its cached catalog version, which every
+# ETag and cached rate response depends on, before reading it again.
+CLERK_CATALOG_TIMEOUT = 5
+
+# Seconds each process trusts its cached region, service type and
+# service ids by name, and how long it remembers names that don't exist.
+CLERK_RESOLVER_TIMEOUT = 300
+CLERK_RESOLVER_NEGATIVE_TIMEOUT = 30
+
+# The cache, dedicated to it, for rendered current and future rate
+# responses, and how many seconds to keep them when no future rate is set.
+CLERK_RATE_CACHE = 'rates'
+CLERK_RATE_CACHE_TIMEOUT = 3600
+
+# How changes are written to the audit log: 'sync' as they are made, or
+# 'async' in batches from a background thread every so many seconds.
+CLERK_AUDIT_MODE = 'async'
+CLERK_AUDIT_FLUSH_INTERVAL = 1.0
+# Whether to write the audit log to the database, shown in the admin, and
+# the JSON lines file to append it to, rotated by size, if any.
+CLERK_AUDIT_DATABASE = True
+CLERK_AUDIT_FILE = None
+CLERK_AUDIT_FILE_MAX_BYTES = 50 * 1024 * 1024
+CLERK_AUDIT_FILE_BACKUP_COUNT = 10
+
+# Days a superseded rate, and an admin log entry, is kept before the
+# archive command moves it to the archive tables.
+CLERK_ARCHIVE_RATE_DAYS = 365
+CLERK_ARCHIVE_LOG_DAYS = 365
+
+# Whether Service.set_new_rate skips a rate equal to the one already in
+# effect at its date, rather than adding a row that repeats it.
+CLERK_RATE_DEDUPE = False
+
+# A directory shared by every process serving Clerk, to which each writes
+# its metrics at most every so many seconds, so /metrics adds them up.
+# None to report those of the process answering only.
+CLERK_METRICS_DIR = None
+CLERK_METRICS_FLUSH_INTERVAL = 5.0
+
+# Each request's queries and timings are logged as a JSON line to the
+# clerk.instrumentation logger, at INFO. Tests make too many requests to
+# log them all.
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'clerk.instrumentation': {
+            'handlers': ['console'],
+            'level': 'WARNING' if sys.argv[1:2] == ['test'] else 'INFO',
+        },
+    },
+}
@@ -1,14 +1,64 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.contrib.admin import helpers
+from django.template.response import TemplateResponse
+from clerk import repricing
 from clerk.models import Rate, Service, Region, Service_Type
 from clerk.forms import (CreateServiceForm, EditServiceForm,
                          CreateRateForm, create_region_form,
-                         EditRateForm)
+                         EditRateForm, RepriceForm, CloneRegionForm)
+from clerk.filters import IsCurrentListFilter, HasNextRateListFilter
+
+
+def render_action_form(model_admin, request, title, description, queryset,
+                       action, form, submit):
+    """Renders the page asking for the form of an admin action, listing
+       the objects selected for it."""
+    context = {
+        'title': title,
+        'description': description,
+        'queryset': queryset,
+        'opts': model_admin.model._meta,
+        'app_label': model_admin.model._meta.app_label,
+        'action_checkbox_name': helpers.ACTION_CHECKBOX_NAME,
+        'action': action,
+        'form': form,
+        'submit': submit,
+    }
+    return TemplateResponse(request, 'admin/clerk/action_form.html',
+                            context, current_app=model_admin.admin_site.name)
 
 
 class RegionAdmin(admin.ModelAdmin):
     list_display = ('name', 'description', 'created')
     readonly_fields = ('created',)
     search_fields = ['name', 'description']
+    actions = ['clone_selected']
+
+    def clone_selected(self, request, queryset):
+        """Creates a new region priced like the selected one, after asking
+           for its name and description."""
+        if queryset.count() != 1:
+            self.message_user(request, "Select a single region to clone.",
+                              level=messages.ERROR)
+            return None
+        source = queryset.get()
+        if 'apply' in request.POST:
+            form = CloneRegionForm(request.POST)
+            if form.is_valid():
+                region = source.clone(form.cleaned_data['name'],
+                                      form.cleaned_data['description'] or None,
+                                      user_id=request.user.pk)
+                self.message_user(request, "Cloned %s as %s." % (source,
+                                                                 region))
+                return None
+        else:
+            form = CloneRegionForm()
+        return render_action_form(
+            self, request, "Clone region",
+            "Create a new region with the services of the following " +
+            "region, and its current and future rates:",
+            queryset, 'clone_selected', form, "Clone")
+    clone_selected.short_description = "Clone selected region"
 
     def get_actions(self, request):
         actions = super(RegionAdmin, self).get_actions(request)
@@ -32,11 +82,52 @@ class ServiceTypeAdmin(admin.ModelAdmin):
 
 
 class ServiceAdmin(admin.ModelAdmin):
-    list_display = ('service_type', 'region',
-                    'get_current_rate', 'get_next_future_rate', 'created')
+    list_display = ('service_type', 'region', 'current_rate_value',
+                    'next_rate_value', 'next_change_at', 'created')
+    # the rate columns come from the rate pointers on Service, so a page
+    # of services is a single query however long it is.
+    list_select_related = ('service_type', 'region', 'current_rate',
+                           'next_rate')
     readonly_fields = ('created',)
-    list_filter = ['region']
+    list_filter = ['region', 'service_type', HasNextRateListFilter]
     search_fields = ['service_type', 'region']
+    actions = ['reprice_selected']
+
+    def current_rate_value(self, obj):
+        if obj.current_rate is not None:
+            return obj.current_rate.rate
+    current_rate_value.short_description = "Current rate"
+    current_rate_value.admin_order_field = 'current_rate__rate'
+
+    def next_rate_value(self, obj):
+        if obj.next_rate is not None:
+            return obj.next_rate.rate
+    next_rate_value.short_description = "Next future rate"
+    next_rate_value.admin_order_field = 'next_rate__rate'
+
+    def reprice_selected(self, request, queryset):
+        """Sets a new rate for every selected service in one batch, after
+           asking for the rate, or the change to it, and its date."""
+        if 'apply' in request.POST:
+            form = RepriceForm(request.POST)
+            if form.is_valid():
+                count = repricing.reprice(
+                    queryset, form.cleaned_data['date'],
+                    percent=form.cleaned_data['percent'],
+                    rate=form.cleaned_data['rate'],
+                    user_id=request.user.pk)
+                self.message_user(request, "Repriced %d services." % count)
+                return None
+        else:
+            form = RepriceForm()
+        return render_action_form(
+            self, request, "Reprice services",
+            "Set a new rate for the following services, either a change " +
+            "to the rate effective at the start date or a new rate for " +
+            "all of them:",
+            queryset.select_related('region', 'service_type'),
+            'reprice_selected', form, "Reprice")
+    reprice_selected.short_description = "Reprice selected services"
 
     def get_form(self, request, obj=None, **kwargs):
         if obj is None:
@@ -60,9 +151,11 @@ class ServiceAdmin(admin.ModelAdmin):
 class RateAdmin(admin.ModelAdmin):
     list_display = ('rate', 'date_effective', 'service',
                     'is_current', 'region', 'created')
+    list_select_related = ('service__service_type', 'service__region',
+                           'region')
     readonly_fields = ('created',)
     search_fields = ['region', 'service', 'service_type']
-    list_filter = ['region', 'service_type']
+    list_filter = ['region', 'service_type', IsCurrentListFilter]
 
     def get_form(self, request, obj=None, **kwargs):
         if obj is None:
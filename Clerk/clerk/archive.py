@@ -0,0 +1,87 @@
+"""Retention for rates and audit log entries that are long past.
+
+archive_rates moves rates that were superseded before a cutoff from the
+Rate table to ArchivedRate, and archive_log moves, or prunes, admin log
+entries older than a cutoff to ArchivedLogEntry. Both work through the
+rows a chunk at a time, each chunk in its own short transaction, so the
+tables stay usable while a large backlog is cleared.
+
+Archived rates always precede the live rates of their service, so the
+live timelines still answer every lookup from the oldest live rate on,
+and only lookups before it fall back to the archive, see
+Service.get_rate_nearest_to and Catalog.archived_until."""
+from django.contrib.admin.models import LogEntry
+from django.db import connection, transaction
+
+from clerk import timeline
+from clerk.models import ArchivedLogEntry, ArchivedRate, Catalog, Rate, Service
+
+# rows moved per transaction, kept under the parameter limits of sqlite.
+ARCHIVE_CHUNK_SIZE = 500
+
+RATE_FIELDS = ('id', 'rate', 'date_effective', 'created', 'effective_until',
+               'service_id', 'service_type_id', 'region_id')
+LOG_FIELDS = ('id', 'action_time', 'user_id', 'content_type_id',
+              'object_id', 'object_repr', 'action_flag', 'change_message')
+
+
+def delete_rates(pks):
+    # a queryset delete would send the rate signals for every row, which
+    # would repair intervals that archiving leaves whole anyway.
+    sql = "DELETE FROM %s WHERE %s IN (%s)" % (
+        connection.ops.quote_name(Rate._meta.db_table),
+        connection.ops.quote_name('id'), ', '.join(['%s'] * len(pks)))
+    connection.cursor().execute(sql, pks)
+
+
+def archive_rates(before, chunk_size=ARCHIVE_CHUNK_SIZE):
+    """Moves every rate superseded before the given date to the archive.
+       Returns the number of rates archived.
+       - before = datetime object, no later than now"""
+    count = 0
+    while True:
+        with transaction.atomic():
+            rows = list(Rate.objects.filter(
+                effective_until__lte=before).order_by('pk').values_list(
+                *RATE_FIELDS)[:chunk_size])
+            if len(rows) == 0:
+                break
+            pks = [row[0] for row in rows]
+            ArchivedRate.objects.bulk_create([
+                ArchivedRate(**dict(zip(RATE_FIELDS, row))) for row in rows])
+            # only a service whose pointers are stale could point at one.
+            Service.objects.filter(current_rate__in=pks).update(
+                current_rate=None)
+            delete_rates(pks)
+        count += len(rows)
+
+    catalog = Catalog.get_current()
+    if count > 0 and (catalog.archived_until is None or
+                      catalog.archived_until < before):
+        Catalog.objects.filter(pk=catalog.pk).update(archived_until=before)
+    if count > 0:
+        timeline.clear()
+        Catalog.bump()
+    return count
+
+
+def archive_log(before, chunk_size=ARCHIVE_CHUNK_SIZE, prune=False):
+    """Moves every admin log entry from before the given date to the
+       archive, or deletes them if prune is True. Returns the number of
+       entries archived or deleted.
+       - before = datetime object"""
+    count = 0
+    while True:
+        with transaction.atomic():
+            rows = list(LogEntry.objects.filter(
+                action_time__lt=before).order_by('pk').values_list(
+                *LOG_FIELDS)[:chunk_size])
+            if len(rows) == 0:
+                break
+            if not prune:
+                ArchivedLogEntry.objects.bulk_create([
+                    ArchivedLogEntry(**dict(zip(LOG_FIELDS, row)))
+                    for row in rows])
+            LogEntry.objects.filter(pk__in=[row[0] for row in rows]).delete()
+        count += len(rows)
+    return count
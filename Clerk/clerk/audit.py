@@ -0,0 +1,191 @@
+"""The audit log of changes made to the catalog.
+
+Entries are LogEntry rows, shown in the admin, and can also be appended
+as JSON lines to a file rotated by size, set by CLERK_AUDIT_FILE. How
+they are written is set by CLERK_AUDIT_MODE:
+
+    'sync'  - entries are written as they are logged, within the
+              transaction of the change they record.
+    'async' - entries are queued in memory and written in batches by a
+              background thread, every CLERK_AUDIT_FLUSH_INTERVAL
+              seconds or once AUDIT_BATCH_SIZE are waiting, so changes
+              don't wait on them. Entries still queued are written when
+              the process exits, but are lost if it is killed. Entries
+              logged inside a transaction are still written at once,
+              within it, so they are rolled back along with the change
+              they record rather than written for a change never made.
+
+Entries are logged against the given user, or else the user of the
+request being handled, as recorded by AuditUserMiddleware, or else
+DEFAULT_USER_ID."""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import threading
+
+from django.conf import settings
+from django.contrib.admin.models import LogEntry
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.utils import timezone
+
+# the user changes are logged against when no other is known, assumed to
+# be the first admin.
+DEFAULT_USER_ID = 1
+DEFAULT_MODE = 'sync'
+# seconds between writes of queued entries in async mode.
+DEFAULT_FLUSH_INTERVAL = 1.0
+# entries written per insert, and the queue size that wakes the writer.
+AUDIT_BATCH_SIZE = 500
+# size in bytes at which the audit file is rotated, and files kept.
+DEFAULT_FILE_MAX_BYTES = 50 * 1024 * 1024
+DEFAULT_FILE_BACKUP_COUNT = 10
+
+_queue = []
+_lock = threading.Lock()
+_wake = threading.Event()
+_writer = None
+_file_handler = None
+_local = threading.local()
+
+
+def get_mode():
+    return getattr(settings, 'CLERK_AUDIT_MODE', DEFAULT_MODE)
+
+
+def get_flush_interval():
+    return getattr(settings, 'CLERK_AUDIT_FLUSH_INTERVAL',
+                   DEFAULT_FLUSH_INTERVAL)
+
+
+def get_user_id(user_id=None):
+    """Returns the given user id, or else that of the user of the
+       current request, or else DEFAULT_USER_ID."""
+    if user_id is None:
+        user_id = getattr(_local, 'user_id', None)
+    if user_id is None:
+        user_id = DEFAULT_USER_ID
+    return user_id
+
+
+class AuditUserMiddleware(object):
+    """Records the logged in user of each request, so changes made while
+       handling it are logged against them."""
+
+    def process_request(self, request):
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated():
+            _local.user_id = user.pk
+        else:
+            _local.user_id = None
+
+    def process_response(self, request, response):
+        _local.user_id = None
+        return response
+
+
+def make_entry(model, object_id, object_repr, action_flag, change_message,
+               user_id=None):
+    """Returns an unsaved LogEntry, for log_entries.
+       - model = the model class of the object changed"""
+    return LogEntry(
+        action_time=timezone.now(), user_id=get_user_id(user_id),
+        content_type_id=ContentType.objects.get_for_model(model).pk,
+        object_id=object_id, object_repr=object_repr,
+        action_flag=action_flag, change_message=change_message)
+
+
+def log(model, object_id, object_repr, action_flag, change_message,
+        user_id=None):
+    """Logs a change to an object.
+       - model = the model class of the object changed
+       - action_flag = one of ADDITION, CHANGE or DELETION
+       - user_id = int, defaults as described above"""
+    log_entries([make_entry(model, object_id, object_repr, action_flag,
+                            change_message, user_id)])
+
+
+def log_entries(entries):
+    """Logs many changes at once.
+       - entries = list of unsaved LogEntry objects"""
+    if get_mode() != 'async' or connection.in_atomic_block:
+        write(entries)
+        return
+    with _lock:
+        _queue.extend(entries)
+        size = len(_queue)
+    start_writer()
+    if size >= AUDIT_BATCH_SIZE:
+        _wake.set()
+
+
+def flush():
+    """Writes every queued entry."""
+    while True:
+        with _lock:
+            batch = _queue[:AUDIT_BATCH_SIZE]
+            del _queue[:AUDIT_BATCH_SIZE]
+        if len(batch) == 0:
+            return
+        write(batch)
+
+
+def write(entries):
+    if len(entries) == 0:
+        return
+    if getattr(settings, 'CLERK_AUDIT_DATABASE', True):
+        LogEntry.objects.bulk_create(entries, batch_size=AUDIT_BATCH_SIZE)
+    path = getattr(settings, 'CLERK_AUDIT_FILE', None)
+    if path:
+        write_file(path, entries)
+
+
+def write_file(path, entries):
+    global _file_handler
+    with _lock:
+        if (_file_handler is None or
+                _file_handler.baseFilename != os.path.abspath(path)):
+            _file_handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=getattr(settings, 'CLERK_AUDIT_FILE_MAX_BYTES',
+                                       DEFAULT_FILE_MAX_BYTES),
+                backupCount=getattr(settings, 'CLERK_AUDIT_FILE_BACKUP_COUNT',
+                                    DEFAULT_FILE_BACKUP_COUNT))
+            _file_handler.setFormatter(logging.Formatter('%(message)s'))
+        for entry in entries:
+            _file_handler.emit(logging.makeLogRecord({'msg': json.dumps({
+                'action_time': entry.action_time.isoformat(),
+                'user_id': entry.user_id,
+                'content_type_id': entry.content_type_id,
+                'object_id': entry.object_id,
+                'object_repr': entry.object_repr,
+                'action_flag': entry.action_flag,
+                'change_message': entry.change_message})}))
+
+
+def run_writer():
+    while True:
+        _wake.wait(get_flush_interval())
+        _wake.clear()
+        try:
+            flush()
+        except Exception:
+            logging.getLogger(__name__).exception(
+                "Could not write the audit log.")
+        finally:
+            # the writer's connection would otherwise stay open forever.
+            connection.close()
+
+
+def start_writer():
+    global _writer
+    if _writer is not None:
+        return
+    with _lock:
+        if _writer is None:
+            _writer = threading.Thread(target=run_writer,
+                                       name='clerk-audit-writer')
+            _writer.daemon = True
+            _writer.start()
+            atexit.register(flush)
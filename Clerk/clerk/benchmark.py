@@ -0,0 +1,400 @@
+"""Benchmarks of the api and the model methods behind it.
+
+Each scenario is timed against a catalog made by generate_catalog, over
+a seeded sample of its services, and summarized as latency percentiles,
+throughput and SQL queries per request. Api scenarios run either in
+process, through the Django test client, or over http against a WSGI
+server, started locally in a thread unless the url of one is given,
+from concurrent client threads. Model scenarios always run in process.
+The queries of api requests are read from the X-Clerk-Queries header,
+see clerk.instrumentation.
+
+The results are plain dicts, saved as JSON by the benchmark command so
+runs of different versions can be compared, see compare. The write
+scenarios are undone after they run, see cleanup."""
+import base64
+from datetime import timedelta
+import json
+import logging
+import math
+import random
+import SocketServer
+import threading
+import time
+import urllib2
+from wsgiref import simple_server
+
+from django.contrib.auth.models import User
+from django.core.wsgi import get_wsgi_application
+from django.db import connection, transaction
+from django.test.client import Client
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from clerk.archive import ARCHIVE_CHUNK_SIZE, delete_rates
+from clerk import instrumentation
+from clerk.instrumentation import QUERIES_HEADER
+from clerk.models import Rate, Region, Service, Service_Type
+
+PERCENTILES = (50, 90, 99)
+# the names of the regions created by the region_list_post scenario.
+POST_PREFIX = 'benchmark_post_'
+BENCHMARK_USER = 'benchmark'
+
+
+class BenchmarkError(ValueError):
+    """Raised when there is no catalog to run the benchmarks against."""
+
+
+class Dataset(object):
+    """A seeded sample of the services of a generated catalog, with the
+       objects the scenarios create, so they can be removed."""
+
+    def __init__(self, prefix='gen', sample=100, seed=0):
+        rows = list(Service.objects.filter(
+            region__name__startswith=prefix + '_region_').order_by(
+            'pk').values_list('pk', 'region__name', 'service_type__name'))
+        if len(rows) == 0:
+            raise BenchmarkError("There is no catalog with the prefix '%s', "
+                                 "generate one with generate_catalog."
+                                 % prefix)
+        self.rng = random.Random(seed)
+        self.targets = self.rng.sample(rows, min(sample, len(rows)))
+        self.services = Service.objects.select_related(
+            'region', 'service_type').in_bulk(
+            [target[0] for target in self.targets])
+        self.type_names = list(Service_Type.objects.values_list(
+            'name', flat=True))
+        self.counts = {'regions': Region.objects.count(),
+                       'services': Service.objects.count(),
+                       'rates': Rate.objects.count()}
+        self.run = int(time.time())
+        self.posted = 0
+        self.rates = []
+
+    def choose(self):
+        """Returns a (pk, region name, service type name) target."""
+        return self.rng.choice(self.targets)
+
+
+# Api scenarios, each returns a (method, path, data) request:
+
+def rate_current(dataset):
+    return 'GET', '/regions/%s/services/%s/rates/current/' % \
+        dataset.choose()[1:], None
+
+
+def rate_future(dataset):
+    return 'GET', '/regions/%s/services/%s/rates/future/' % \
+        dataset.choose()[1:], None
+
+
+def rate_list(dataset):
+    return 'GET', '/regions/%s/services/%s/rates/?limit=100' % \
+        dataset.choose()[1:], None
+
+
+def service_list(dataset):
+    return 'GET', '/regions/%s/services/' % dataset.choose()[1], None
+
+
+def region_list(dataset):
+    return 'GET', '/regions/', None
+
+
+def region_list_post(dataset):
+    dataset.posted += 1
+    data = {'name': '%s%d_%d' % (POST_PREFIX, dataset.run, dataset.posted),
+            'description': "Created by the benchmarks."}
+    for name in dataset.type_names:
+        data[name + '_rate'] = round(dataset.rng.uniform(0.01, 10), 4)
+    return 'POST', '/regions/', data
+
+
+# Model scenarios, each makes the call it times:
+
+def get_current_rate(dataset):
+    dataset.services[dataset.choose()[0]].get_current_rate()
+
+
+def get_rate_nearest_to(dataset):
+    date = timezone.now() - timedelta(hours=dataset.rng.randint(0, 87600))
+    dataset.services[dataset.choose()[0]].get_rate_nearest_to(date)
+
+
+def set_new_rate(dataset):
+    date = timezone.now() + timedelta(hours=dataset.rng.randint(1, 8760))
+    rate = dataset.services[dataset.choose()[0]].set_new_rate(
+        round(dataset.rng.uniform(0.01, 10), 4), date, dedupe=False)
+    dataset.rates.append(rate.pk)
+
+
+API_SCENARIOS = [('rate_current', rate_current),
+                 ('rate_future', rate_future),
+                 ('rate_list', rate_list),
+                 ('service_list', service_list),
+                 ('region_list', region_list),
+                 ('region_list_post', region_list_post)]
+MODEL_SCENARIOS = [('get_current_rate', get_current_rate),
+                   ('get_rate_nearest_to', get_rate_nearest_to),
+                   ('set_new_rate', set_new_rate)]
+# scenarios that write, and so are run fewer times.
+WRITE_SCENARIOS = ('region_list_post', 'set_new_rate')
+
+
+def percentile(values, percent):
+    """Returns the nearest rank percentile of a sorted list."""
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def summarize(timings, queries, elapsed, errors):
+    """Returns the summary of a run of a scenario.
+       - timings = list of the seconds each request took
+       - queries = list of the queries each request took, None where
+         not known
+       - elapsed = float, the seconds the whole run took"""
+    timings = sorted(timings)
+    result = {'requests': len(timings), 'errors': errors,
+              'throughput': round(len(timings) / elapsed, 2)
+              if elapsed > 0 else None,
+              'latency_ms': None, 'queries': None}
+    if len(timings) > 0:
+        latency = dict(('p%d' % percent,
+                        round(percentile(timings, percent) * 1000, 3))
+                       for percent in PERCENTILES)
+        latency['mean'] = round(sum(timings) / len(timings) * 1000, 3)
+        latency['max'] = round(timings[-1] * 1000, 3)
+        result['latency_ms'] = latency
+    queries = [count for count in queries if count is not None]
+    if len(queries) > 0:
+        result['queries'] = {
+            'mean': round(sum(queries) / float(len(queries)), 2),
+            'max': max(queries)}
+    return result
+
+
+def get_credentials():
+    """Returns the username and a new password of the user the write
+       scenarios are made as."""
+    password = base64.b64encode(str(random.getrandbits(96)))
+    user, created = User.objects.get_or_create(username=BENCHMARK_USER)
+    user.set_password(password)
+    user.save()
+    return BENCHMARK_USER, password
+
+
+def run_model(function, dataset, count, warmup=0):
+    """Times count calls of a model scenario, one at a time."""
+    for i in range(warmup):
+        function(dataset)
+    timings, queries = [], []
+    start = time.time()
+    for i in range(count):
+        with CaptureQueriesContext(connection) as context:
+            began = time.time()
+            function(dataset)
+            timings.append(time.time() - began)
+        queries.append(len(context))
+    return summarize(timings, queries, time.time() - start, 0)
+
+
+def run_in_process(requests, credentials, warmup=()):
+    """Times requests made one at a time through the test client.
+       - requests = list of (method, path, data) tuples"""
+    # only writes are made as a user, as they are over http.
+    client = Client(HTTP_ACCEPT='application/json')
+    user_client = Client(HTTP_ACCEPT='application/json')
+    user_client.login(username=credentials[0], password=credentials[1])
+
+    def send(method, path, data):
+        if method == 'GET':
+            return client.get(path)
+        return user_client.post(path, json.dumps(data),
+                                content_type='application/json')
+
+    for request in warmup:
+        send(*request)
+    timings, queries, errors = [], [], 0
+    start = time.time()
+    for request in requests:
+        began = time.time()
+        response = send(*request)
+        timings.append(time.time() - began)
+        # the queries of a request can't be counted around the client,
+        # as the list of them is reset as each request starts.
+        count = response.get(QUERIES_HEADER)
+        queries.append(int(count) if count else None)
+        if response.status_code >= 400:
+            errors += 1
+    return summarize(timings, queries, time.time() - start, errors)
+
+
+def send_http(url, method, path, data, credentials):
+    """Makes a request, returning its status and the queries it took, if
+       the server says."""
+    headers = {'Accept': 'application/json'}
+    if data is not None:
+        data = json.dumps(data)
+        headers['Content-Type'] = 'application/json'
+        headers['Authorization'] = 'Basic ' + base64.b64encode(
+            '%s:%s' % credentials)
+    try:
+        response = urllib2.urlopen(urllib2.Request(url + path, data, headers),
+                                   timeout=60)
+    except urllib2.HTTPError as error:
+        response = error
+    response.read()
+    queries = response.info().getheader(QUERIES_HEADER)
+    return response.getcode(), int(queries) if queries else None
+
+
+def run_http(url, requests, credentials, concurrency=1, warmup=()):
+    """Times requests made over http, from concurrency threads at once.
+       - requests = list of (method, path, data) tuples"""
+    for request in warmup:
+        send_http(url, *(request + (credentials,)))
+    timings, queries, errors = [], [], []
+    pending = list(reversed(requests))
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            with lock:
+                if len(pending) == 0:
+                    return
+                request = pending.pop()
+            began = time.time()
+            try:
+                status, count = send_http(url, *(request + (credentials,)))
+            except IOError:
+                status, count = None, None
+            took = time.time() - began
+            with lock:
+                timings.append(took)
+                queries.append(count)
+                if status is None or status >= 400:
+                    errors.append(request)
+
+    threads = [threading.Thread(target=work) for i in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(timings, queries, time.time() - start, len(errors))
+
+
+class ThreadingWSGIServer(SocketServer.ThreadingMixIn,
+                          simple_server.WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(simple_server.WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server():
+    """Serves the site from a thread on a free local port, returning
+       the server, see server.shutdown."""
+    server = simple_server.make_server(
+        '127.0.0.1', 0, get_wsgi_application(),
+        ThreadingWSGIServer, QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def cleanup(dataset):
+    """Removes the regions and rates created by the write scenarios."""
+    Rate.objects.filter(pk__in=dataset.rates).delete()
+    dataset.rates = []
+    regions = Region.objects.filter(name__startswith=POST_PREFIX)
+    with transaction.atomic():
+        # their rates are removed without the per-row signals, which
+        # would repair the intervals of services about to be removed.
+        Service.objects.filter(region__in=regions).update(
+            current_rate=None, next_rate=None)
+        pks = list(Rate.objects.filter(region__in=regions).values_list(
+            'pk', flat=True))
+        for start in range(0, len(pks), ARCHIVE_CHUNK_SIZE):
+            delete_rates(pks[start:start + ARCHIVE_CHUNK_SIZE])
+        regions.delete()
+
+
+def run(dataset, requests=200, write_requests=20, warmup=10, mode='process',
+        url=None, concurrency=8, scenarios=None):
+    """Runs the benchmarks, returning a dict of the results by scenario.
+       - mode = 'process' to make the api requests through the test
+         client, or 'http' to make them over http to url, or to a local
+         server if url is None
+       - scenarios = list of the names of the scenarios to run, defaults
+         to all of them"""
+    credentials = get_credentials()
+    # a log line per request would drown the report.
+    level = instrumentation.logger.level
+    instrumentation.logger.setLevel(logging.WARNING)
+    server = None
+    if mode == 'http' and url is None:
+        server = start_server()
+        url = 'http://127.0.0.1:%d' % server.server_port
+
+    results = dict()
+    try:
+        for name, function in API_SCENARIOS + MODEL_SCENARIOS:
+            if scenarios is not None and name not in scenarios:
+                continue
+            count = requests
+            if name in WRITE_SCENARIOS:
+                count = write_requests
+            if (name, function) in MODEL_SCENARIOS:
+                results[name] = run_model(function, dataset, count, warmup)
+                results[name]['mode'] = 'process'
+                continue
+            # the requests are made up front, so the same seed always
+            # makes the same ones.
+            made = [function(dataset) for i in range(warmup + count)]
+            if mode == 'http':
+                results[name] = run_http(url, made[warmup:], credentials,
+                                         concurrency, made[:warmup])
+                results[name]['concurrency'] = concurrency
+            else:
+                results[name] = run_in_process(made[warmup:], credentials,
+                                               made[:warmup])
+            results[name]['mode'] = mode
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        cleanup(dataset)
+        instrumentation.logger.setLevel(level)
+    return results
+
+
+def compare(results, baseline):
+    """Returns a list of (scenario, p50 ratio, p90 ratio, throughput
+       ratio, change in mean queries) tuples comparing the scenarios
+       of two runs, the ratios being new over baseline."""
+    def ratio(new, old):
+        if new is None or not old:
+            return None
+        return round(new / float(old), 3)
+
+    rows = []
+    for name in sorted(results):
+        new, old = results[name], baseline.get(name)
+        if old is None:
+            continue
+        latency = new['latency_ms'] or {}
+        old_latency = old['latency_ms'] or {}
+        queries = None
+        if new['queries'] is not None and old['queries'] is not None:
+            queries = round(new['queries']['mean'] -
+                            old['queries']['mean'], 2)
+        rows.append((name, ratio(latency.get('p50'), old_latency.get('p50')),
+                     ratio(latency.get('p90'), old_latency.get('p90')),
+                     ratio(new['throughput'], old['throughput']), queries))
+    return rows
@@ -0,0 +1,42 @@
+"""A process-local copy of the catalog version.
+
+Every conditional GET hashes the catalog version into its validators,
+and the rate response cache keys on it, so it is read from the database
+once per process rather than once per request. Catalog.bump forgets it,
+so writes made by this process are seen at once, and it expires so
+writes made by other processes are picked up."""
+import time
+
+from django.conf import settings
+
+# seconds the catalog version is trusted before being read again.
+DEFAULT_TIMEOUT = 5
+
+# [catalog, expires]
+_catalog = [None, 0]
+
+
+def get_timeout():
+    return getattr(settings, 'CLERK_CATALOG_TIMEOUT', DEFAULT_TIMEOUT)
+
+
+def get_catalog(request=None):
+    """Returns the catalog, read at most once per request given, so
+       every part of a response sees the same version."""
+    catalog = getattr(request, 'clerk_catalog', None)
+    if catalog is not None:
+        return catalog
+
+    catalog, expires = _catalog
+    if catalog is None or expires <= time.time():
+        from clerk.models import Catalog
+        catalog = Catalog.get_current()
+        _catalog[:] = [catalog, time.time() + get_timeout()]
+    if request is not None:
+        request.clerk_catalog = catalog
+    return catalog
+
+
+def clear():
+    """Forgets the catalog version."""
+    _catalog[:] = [None, 0]
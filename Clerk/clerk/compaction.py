@@ -0,0 +1,95 @@
+"""Compaction of rate histories.
+
+Setting a rate equal to the one already in effect, as automation
+re-asserting prices often does, adds a row that doesn't change the rate
+of its service at any date. compact_rates removes such rows: each run of
+consecutive identical rates of a service collapses into its first rate,
+whose effective_until is extended over the rest, so the rate effective
+at every date stays the same. Service.set_new_rate can also skip them as
+they are written, see CLERK_RATE_DEDUPE."""
+from django.contrib.admin.models import DELETION
+from django.db import transaction
+from django.utils import timezone
+
+from clerk import audit, ratecache, timeline
+from clerk.archive import ARCHIVE_CHUNK_SIZE, delete_rates
+from clerk.models import Catalog, Rate, Service
+
+
+def find_redundant(rates):
+    """Returns the pks of the rates that repeat the rate before them.
+       - rates = list of (pk, rate) tuples of one service, ordered by
+         date_effective then pk"""
+    redundant = []
+    previous = None
+    for pk, rate in rates:
+        if previous is not None and previous == rate:
+            redundant.append(pk)
+        else:
+            previous = rate
+    return redundant
+
+
+def compact_rates(services=None, chunk_size=timeline.LOAD_BATCH_SIZE,
+                  user_id=None):
+    """Removes every rate equal to the rate before it of its service,
+       working through the services a chunk at a time, each chunk in
+       its own transaction. Returns the number of rates removed.
+       - services = Service queryset, defaults to every service
+       - user_id = int, the user the removals are logged against,
+         see clerk.audit for the default"""
+    if services is None:
+        services = Service.objects.all()
+    pks = list(services.order_by('pk').values_list('pk', flat=True))
+
+    count = 0
+    changed = []
+    for start in range(0, len(pks), chunk_size):
+        batch = pks[start:start + chunk_size]
+        with transaction.atomic():
+            rates = dict((pk, []) for pk in batch)
+            for pk, service_id, rate in Rate.objects.filter(
+                    service__in=batch).order_by(
+                    'date_effective', 'pk').values_list(
+                    'pk', 'service_id', 'rate'):
+                rates[service_id].append((pk, rate))
+
+            removed = dict()
+            for service_id in batch:
+                redundant = find_redundant(rates[service_id])
+                if len(redundant) > 0:
+                    removed[service_id] = redundant
+            if len(removed) == 0:
+                continue
+
+            entries = []
+            values = dict((row[0], row[1]) for service_rates in
+                          rates.values() for row in service_rates)
+            for service in Service.objects.filter(
+                    pk__in=removed.keys()).select_related(
+                    'region', 'service_type'):
+                for pk in removed[service.pk]:
+                    entries.append(audit.make_entry(
+                        Rate, pk, str(values[pk]), DELETION,
+                        "Rate removed from " + service.__unicode__() +
+                        ", by compaction as it repeats the rate before it.",
+                        user_id))
+            redundant = [pk for pks in removed.values() for pk in pks]
+            for offset in range(0, len(redundant), ARCHIVE_CHUNK_SIZE):
+                delete_rates(redundant[offset:offset + ARCHIVE_CHUNK_SIZE])
+            audit.log_entries(entries)
+
+            # the rates left before those removed now last over them.
+            now = timezone.now()
+            Rate.objects.update_intervals(removed.keys())
+            Rate.objects.update_current(now, service_ids=removed.keys())
+            Service.objects.update_rate_pointers(removed.keys(), now)
+        count += len(redundant)
+        changed.extend(removed.keys())
+
+    for service_id in changed:
+        timeline.invalidate(service_id)
+        ratecache.purge(service_id)
+    if count > 0:
+        Catalog.bump()
+    return count
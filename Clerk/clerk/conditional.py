@@ -0,0 +1,120 @@
+"""Validators for conditional GETs on the read api.
+
+Every response carries an ETag and Last-Modified derived from the
+catalog version, so pollers sending them back get a 304 Not Modified,
+without any serializer running, until something is written. The current
+and future rate views also change when the next rate takes effect, so
+their validators include the rate effective now. Each process keeps the
+catalog version for a few seconds, see clerk.catalogcache."""
+from functools import wraps
+import hashlib
+
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.utils.decorators import method_decorator
+from django.utils.encoding import force_bytes
+from django.views.decorators.http import condition
+
+from clerk import resolver, timeline
+from clerk.catalogcache import get_catalog
+
+
+def make_etag(request, *parts):
+    """Hashes the catalog version with the resource, its representation
+       and any extra parts given."""
+    renderer = getattr(request, 'accepted_renderer', None)
+    key = [get_catalog(request).version, request.get_full_path(),
+           getattr(renderer, 'format', '')] + list(parts)
+    return hashlib.md5(b':'.join(force_bytes(part)
+                                 for part in key)).hexdigest()
+
+
+def as_utc(date):
+    # dates are stored in local time, but http dates are in UTC.
+    if timezone.is_naive(date):
+        date = timezone.make_aware(date, timezone.get_default_timezone())
+    return date
+
+
+def is_unknown_service(kwargs):
+    # views of unknown services 404 without reading the catalog.
+    return ('serv_type' in kwargs and resolver.get_service_id(
+        kwargs['name'], kwargs['serv_type']) is None)
+
+
+def catalog_etag(request, *args, **kwargs):
+    if not is_unknown_service(kwargs):
+        return make_etag(request)
+
+
+def catalog_last_modified(request, *args, **kwargs):
+    if not is_unknown_service(kwargs):
+        return as_utc(get_catalog(request).modified)
+
+
+def get_rate_now(name, serv_type):
+    service_id = resolver.get_service_id(name, serv_type)
+    if service_id is None:
+        return None
+    return timeline.get_timeline(service_id).rate_at(timezone.now())
+
+
+def rate_etag(request, name, serv_type, **kwargs):
+    if is_unknown_service({'name': name, 'serv_type': serv_type}):
+        return None
+    rate = get_rate_now(name, serv_type)
+    return make_etag(request, rate.pk if rate is not None else None)
+
+
+def rate_last_modified(request, name, serv_type, **kwargs):
+    if is_unknown_service({'name': name, 'serv_type': serv_type}):
+        return None
+    modified = get_catalog(request).modified
+    rate = get_rate_now(name, serv_type)
+    if rate is not None and rate.date_effective > modified:
+        modified = rate.date_effective
+    return as_utc(modified)
+
+
+def ratecard_etag(request, **kwargs):
+    # without a date the rate card changes as rates take effect.
+    if 'at' in request.GET:
+        return make_etag(request)
+
+
+def ratecard_last_modified(request, **kwargs):
+    if 'at' in request.GET:
+        return as_utc(get_catalog(request).modified)
+
+
+def max_age_until_next_rate(func):
+    """Lets caches keep the response, or the 304 answering it, until
+       the next rate of the service takes effect."""
+    @wraps(func)
+    def inner(request, name, serv_type, **kwargs):
+        response = func(request, name, serv_type, **kwargs)
+        service_id = resolver.get_service_id(name, serv_type)
+        if response.status_code in (200, 304) and service_id is not None:
+            now = timezone.now()
+            rate = timeline.get_timeline(service_id).rate_after(now)
+            if rate is None:
+                # no change is scheduled, but a rate could be set anytime.
+                patch_cache_control(response, no_cache=True)
+            else:
+                seconds = (rate.date_effective - now).total_seconds()
+                patch_cache_control(response, max_age=max(0, int(seconds)))
+        return response
+    return inner
+
+
+def rate_condition_decorator(func):
+    return max_age_until_next_rate(condition(
+        etag_func=rate_etag, last_modified_func=rate_last_modified)(func))
+
+
+# For the get methods of the api views:
+catalog_condition = method_decorator(condition(
+    etag_func=catalog_etag, last_modified_func=catalog_last_modified))
+rate_condition = method_decorator(rate_condition_decorator)
+ratecard_condition = method_decorator(condition(
+    etag_func=ratecard_etag, last_modified_func=ratecard_last_modified))
@@ -0,0 +1,21 @@
+"""Date parsing shared by the api views and the rating engine."""
+from datetime import datetime
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+DATE_ERROR = (u'Must be a valid ISO 8601 datetime or a date in the ' +
+              u'format: dd/mm/yyyy')
+
+
+def parse_date(value):
+    """Parses either an ISO 8601 datetime or a dd/mm/yyyy date.
+       Raises ValueError if the value is neither."""
+    value = unicode(value)
+    date = parse_datetime(value)
+    if date is None:
+        return datetime.strptime(value, "%d/%m/%Y")
+    if timezone.is_aware(date) and not settings.USE_TZ:
+        date = timezone.make_naive(date, timezone.get_default_timezone())
+    return date
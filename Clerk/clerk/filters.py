@@ -6,7 +6,7 @@ class IsCurrentListFilter(admin.SimpleListFilter):
     title = _('is current')
 
     # Parameter for the filter that will be used in the URL query.
-    parameter_name = 'decade'
+    parameter_name = 'current'
 
     def lookups(self, request, model_admin):
         """
@@ -27,12 +27,29 @@ class IsCurrentListFilter(admin.SimpleListFilter):
         provided in the query string and retrievable via
         `self.value()`.
         """
-        # Compare the requested value (either '80s' or '90s')
-        # to decide how to filter the queryset.
+        # The current flag is indexed, so this is a cheap lookup.
+        if self.value() == 'True':
+            return queryset.filter(current=True)
+        elif self.value() == 'False':
+            return queryset.filter(current=False)
+        return queryset
 
-        print "words!! "
 
-        if self.value() == 'False':
-            return queryset.filter(current=False)
-        else:
-            return queryset.filter(current=True)
\ No newline at end of file
+class HasNextRateListFilter(admin.SimpleListFilter):
+    title = _('has a future rate')
+
+    parameter_name = 'has_next_rate'
+
+    def lookups(self, request, model_admin):
+        return (
+            ('True', _('true')),
+            ('False', _('false')),
+        )
+
+    def queryset(self, request, queryset):
+        # next_change_at is only set while a service has a future rate.
+        if self.value() == 'True':
+            return queryset.filter(next_change_at__isnull=False)
+        elif self.value() == 'False':
+            return queryset.filter(next_change_at__isnull=True)
+        return queryset
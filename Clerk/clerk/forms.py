@@ -1,6 +1,8 @@
-from clerk.models import Service, Rate, Region, Service_Type
+from clerk.models import Service, Rate, Region, Service_Type, noSpaces
 from django import forms
+from django.db import transaction
 from django.contrib.admin import widgets
+import math
 
 
 def create_region_form():
@@ -29,23 +31,40 @@ class RegionFormTemplate(forms.ModelForm):
         if self.is_valid():
             name = str(self.cleaned_data['name'])
             description = str(self.cleaned_data['description'])
-            region = Region.objects.create(name=name,
-                                           description=description)
-            region.save()
             # Sets a new service for each type based on the Service_types
             # table data, and uses the rates given in this form.
+            rates = dict()
             for service in Service_Type.objects.all():
                 # Constructs the same key as used by 'create_region_form()'
                 # and uses it to pull the correct rate out.
                 key = str(service.name) + "_rate"
-                rate = float(self.cleaned_data[key])
-                region.set_new_service(service, rate)
+                rates[service] = float(self.cleaned_data[key])
+            # Creates the region with all its services, or nothing at all.
+            with transaction.atomic():
+                region = Region.objects.create(name=name,
+                                               description=description)
+                region.set_new_services(rates)
             return region
 
     def save_m2m(self):
         pass
 
 
+class CloneRegionForm(forms.Form):
+    """Form for naming the copy of a region."""
+    name = forms.CharField(max_length=200, validators=[noSpaces])
+    description = forms.CharField(widget=forms.Textarea, required=False,
+                                  help_text="Defaults to the description " +
+                                            "of the region cloned.")
+
+    def clean_name(self):
+        name = self.cleaned_data['name']
+        if Region.objects.filter(name=name).exists():
+            raise forms.ValidationError("Region with this Name already " +
+                                        "exists.")
+        return name
+
+
 class CreateServiceForm(forms.ModelForm):
     class Meta:
         model = Service
@@ -107,6 +126,37 @@ class EditServiceForm(forms.ModelForm):
         pass
 
 
+class RepriceForm(forms.Form):
+    """Form for setting a new rate for many services at once."""
+    percent = forms.FloatField(label="Change the current rate by (%):",
+                               required=False, min_value=-100)
+    rate = forms.FloatField(label="Or set a new rate:", required=False,
+                            min_value=0)
+    date = forms.DateTimeField(label="Effective start date for new rate:",
+                               widget=widgets.AdminSplitDateTime())
+
+    def clean_finite(self, key):
+        # FloatField takes nan and inf, which repricing refuses.
+        value = self.cleaned_data.get(key)
+        if value is not None and (math.isnan(value) or math.isinf(value)):
+            raise forms.ValidationError("Enter a number.")
+        return value
+
+    def clean_percent(self):
+        return self.clean_finite('percent')
+
+    def clean_rate(self):
+        return self.clean_finite('rate')
+
+    def clean(self):
+        cleaned_data = super(RepriceForm, self).clean()
+        if ((cleaned_data.get('percent') is None) ==
+                (cleaned_data.get('rate') is None)):
+            raise forms.ValidationError("Give either a percentage " +
+                                        "change or a new rate.")
+        return cleaned_data
+
+
 class CreateRateForm(forms.ModelForm):
     class Meta:
         model = Rate
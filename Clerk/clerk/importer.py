@@ -0,0 +1,168 @@
+"""Bulk import of scheduled rate changes.
+
+Each row sets a new rate for a service, as Service.set_new_rate does, but
+the whole batch is checked before anything is written and is then
+inserted by create_rates, with bulk_create in a single transaction,
+along with a LogEntry per rate. bulk_create sends no signals, so the
+effective_until of the new and existing rates, the current flags, rate
+pointers, timelines, cached responses and catalog version are brought
+up to date afterwards, with a query per batch of services for each."""
+import csv
+import itertools
+import math
+
+from django.contrib.admin.models import ADDITION
+from django.db import transaction
+from django.utils import timezone
+
+from clerk import audit, ratecache, timeline
+from clerk.dates import parse_date, DATE_ERROR
+from clerk.models import Catalog, Rate, Service
+
+# rows written per insert, capped further by the database backend.
+IMPORT_BATCH_SIZE = 500
+# the columns of an import, date is optional.
+FIELDS = ('region', 'service_type', 'rate', 'date')
+
+
+class RateImportError(ValueError):
+    """Raised for a batch with invalid rows, carrying a list of the
+       errors by parameter of each, along with its row number."""
+
+    def __init__(self, errors):
+        super(RateImportError, self).__init__(errors)
+        self.errors = errors
+
+
+def read_csv(stream):
+    """Reads rows from CSV with a header naming the columns region,
+       service_type, rate and, optionally, date."""
+    return [dict((key, value) for key, value in row.items()
+                 if key is not None and value not in (None, ''))
+            for row in csv.DictReader(stream)]
+
+
+def parse_rows(rows, now=None):
+    """Checks every row of a batch, returning a list of (service, rate,
+       date) tuples in the same order. Raises RateImportError listing
+       the errors of every invalid row.
+       - rows = list of dicts with the keys in FIELDS
+       - now = datetime object, the date of rows without one"""
+    if now is None:
+        now = timezone.now()
+    if not isinstance(rows, list):
+        raise RateImportError([{'non_field_errors':
+                                [u'Must be a list of rates to import.']}])
+
+    names = set((row.get('region'), row.get('service_type'))
+                for row in rows if isinstance(row, dict))
+    services = Service.objects.get_by_names(
+        name for name in names if None not in name)
+
+    parsed = []
+    errors = []
+    for number, row in enumerate(rows):
+        if not isinstance(row, dict):
+            errors.append({'row': number,
+                           'non_field_errors': [u'Must be an object.']})
+            continue
+        row_errors = dict()
+        for key in ('region', 'service_type', 'rate'):
+            if key not in row:
+                row_errors[key] = [u'Is a required parameter.']
+        service = services.get((row.get('region'), row.get('service_type')))
+        if service is None and 'region' in row and 'service_type' in row:
+            row_errors['service'] = [u'Not found.']
+        rate = None
+        if 'rate' in row:
+            try:
+                rate = float(row['rate'])
+                # nan isn't < 0, and neither nan nor inf can be stored.
+                if rate < 0 or math.isnan(rate) or math.isinf(rate):
+                    raise ValueError
+            except (TypeError, ValueError):
+                row_errors['rate'] = [u'Must be a valid number >= zero']
+        date = now
+        if row.get('date') is not None:
+            try:
+                date = parse_date(row['date'])
+            except ValueError:
+                row_errors['date'] = [DATE_ERROR]
+        if row_errors:
+            row_errors['row'] = number
+            errors.append(row_errors)
+        else:
+            parsed.append((service, rate, date))
+    if errors:
+        raise RateImportError(errors)
+    return parsed
+
+
+def import_rates(rows, user_id=None):
+    """Imports a batch of rows, all or none of them. Returns the number
+       of rates created. Raises RateImportError if any row is invalid.
+       - rows = list of dicts with the keys in FIELDS
+       - user_id = int, the user the changes are logged against,
+         see clerk.audit for the default"""
+    now = timezone.now()
+    return create_rates(parse_rows(rows, now), user_id, "by import", now)
+
+
+def create_rates(parsed, user_id=None, reason="by import", now=None):
+    """Sets many new rates in one transaction. Returns the number of
+       rates created.
+       - parsed = list of (service, rate, date) tuples, the services
+         with their region and service_type selected
+       - user_id = int, the user the changes are logged against,
+         see clerk.audit for the default
+       - reason = string, ends the message logged for each rate
+       - now = datetime object, the created date of the new rates"""
+    if len(parsed) == 0:
+        return 0
+    if now is None:
+        now = timezone.now()
+    services = dict()
+    new_rates = dict()
+    for service, rate, date in parsed:
+        services[service.pk] = service
+        new_rates.setdefault(service.pk, []).append(Rate(
+            rate=rate, date_effective=date, created=now, service=service,
+            service_type_id=service.service_type_id,
+            region_id=service.region_id))
+    services = services.values()
+
+    with transaction.atomic():
+        Rate.objects.bulk_create(
+            list(itertools.chain.from_iterable(new_rates.values())),
+            batch_size=IMPORT_BATCH_SIZE)
+
+        # bulk_create doesn't set pks, so read the new rates back to log
+        # them, they are the ones created now.
+        entries = []
+        for start in range(0, len(services), timeline.LOAD_BATCH_SIZE):
+            batch = services[start:start + timeline.LOAD_BATCH_SIZE]
+            names = dict((service.pk, service.__unicode__())
+                         for service in batch)
+            for pk, service_id, rate in Rate.objects.filter(
+                    service__in=batch, created=now).values_list(
+                    'pk', 'service_id', 'rate'):
+                entries.append(audit.make_entry(
+                    Rate, pk, str(rate), ADDITION,
+                    "New rate created for " + names[service_id] + ", " +
+                    reason + ".", user_id))
+        audit.log_entries(entries)
+
+        # only rates lasting past the earliest new one can be cut short.
+        since = min(date for service, rate, date in parsed)
+        pks = [service.pk for service in services]
+        for start in range(0, len(pks), timeline.LOAD_BATCH_SIZE):
+            batch = pks[start:start + timeline.LOAD_BATCH_SIZE]
+            Rate.objects.update_intervals(batch, since)
+            Rate.objects.update_current(service_ids=batch)
+            Service.objects.update_rate_pointers(batch)
+
+    for service in services:
+        timeline.invalidate(service.pk)
+        ratecache.purge(service.pk)
+    Catalog.bump()
+    return len(parsed)
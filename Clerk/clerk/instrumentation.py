@@ -0,0 +1,139 @@
+"""Per-request instrumentation of SQL queries and time.
+
+QueryCountMiddleware records the queries each request makes, the time
+they take, and the time taken by the view and the request as a whole.
+They are returned in the X-Clerk-Queries and Server-Timing headers, so
+they can be read from any client or the browser's developer tools,
+logged as a JSON line to the clerk.instrumentation logger at INFO, and
+added to the metrics of the view, see clerk.metrics.
+
+Queries are counted and timed by wrapping the cursors of the default
+connection for the duration of each request only. They aren't kept, so
+production requests don't grow connection.queries, unless DEBUG is on
+or something else, such as a test, keeps them. The rows of a streamed
+response are generated after the headers are sent, so queries made
+while streaming aren't counted."""
+import json
+import logging
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.db.backends.util import CursorWrapper
+
+from clerk import metrics
+
+QUERIES_HEADER = 'X-Clerk-Queries'
+
+logger = logging.getLogger(__name__)
+
+
+class CountingCursorWrapper(CursorWrapper):
+    """Adds the number of queries a cursor runs, and the seconds they
+       take, to the counts given, without keeping the queries."""
+
+    def __init__(self, cursor, db, counts):
+        super(CountingCursorWrapper, self).__init__(cursor, db)
+        self.counts = counts
+
+    def execute(self, sql, params=None):
+        start = time.time()
+        try:
+            return super(CountingCursorWrapper, self).execute(sql, params)
+        finally:
+            self.counts['queries'] += 1
+            self.counts['db'] += time.time() - start
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return super(CountingCursorWrapper, self).executemany(
+                sql, param_list)
+        finally:
+            self.counts['queries'] += 1
+            self.counts['db'] += time.time() - start
+
+
+def start_counting(state):
+    # Django wraps cursors with make_debug_cursor while use_debug_cursor
+    # is set, so wrap that for this connection, keeping the queries only
+    # if they would have been kept anyway.
+    keep = (connection.use_debug_cursor or
+            (connection.use_debug_cursor is None and settings.DEBUG))
+    state['debug'] = connection.use_debug_cursor
+    state['make_cursor'] = connection.__dict__.get('make_debug_cursor')
+    if keep:
+        make_cursor = connection.make_debug_cursor
+    else:
+        def make_cursor(cursor):
+            return CursorWrapper(cursor, connection)
+
+    def make_counting_cursor(cursor):
+        return CountingCursorWrapper(make_cursor(cursor), connection, state)
+    connection.make_debug_cursor = make_counting_cursor
+    connection.use_debug_cursor = True
+
+
+def stop_counting(state):
+    connection.use_debug_cursor = state['debug']
+    if state['make_cursor'] is None:
+        del connection.make_debug_cursor
+    else:
+        connection.make_debug_cursor = state['make_cursor']
+
+
+class QueryCountMiddleware(object):
+    """Should come first in MIDDLEWARE_CLASSES, so the queries of the
+       other middleware are counted."""
+
+    def process_request(self, request):
+        request.clerk_instrumentation = {
+            'start': time.time(), 'queries': 0, 'db': 0.0, 'view': None,
+            'view_start': None}
+        start_counting(request.clerk_instrumentation)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        state = getattr(request, 'clerk_instrumentation', None)
+        if state is not None:
+            state['view'] = getattr(view_func, '__name__', None)
+            state['view_start'] = time.time()
+
+    def process_response(self, request, response):
+        state = getattr(request, 'clerk_instrumentation', None)
+        if state is None:
+            # an earlier middleware answered before this one was reached.
+            return response
+        end = time.time()
+        stop_counting(state)
+        queries = state['queries']
+
+        db_ms = state['db'] * 1000
+        total_ms = (end - state['start']) * 1000
+        view_ms = None
+        if state['view_start'] is not None:
+            view_ms = (end - state['view_start']) * 1000
+
+        response[QUERIES_HEADER] = str(queries)
+        timing = ['db;dur=%.1f;desc="%d queries"' % (db_ms, queries)]
+        if view_ms is not None:
+            timing.append('view;dur=%.1f' % view_ms)
+        timing.append('total;dur=%.1f' % total_ms)
+        response['Server-Timing'] = ', '.join(timing)
+
+        logger.info(json.dumps({
+            'method': request.method, 'path': request.path,
+            'status': response.status_code, 'view': state['view'],
+            'queries': queries, 'db_ms': round(db_ms, 3),
+            'view_ms': round(view_ms, 3) if view_ms is not None else None,
+            'total_ms': round(total_ms, 3)}, sort_keys=True))
+
+        # requests not reaching a view, such as 404s, are counted together.
+        view = state['view'] or 'none'
+        metrics.inc('clerk_requests_total', view=view, method=request.method,
+                    status=str(response.status_code))
+        metrics.observe('clerk_request_duration_seconds', total_ms / 1000,
+                        view=view)
+        metrics.observe('clerk_db_duration_seconds', db_ms / 1000, view=view)
+        metrics.inc('clerk_db_queries_total', queries, view=view)
+        metrics.maybe_flush()
+        return response
@@ -0,0 +1,55 @@
+from datetime import timedelta
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand, CommandError
+from django.utils import timezone
+
+from clerk import archive
+
+# days a superseded rate or a log entry is kept before being archived.
+DEFAULT_RATE_DAYS = 365
+DEFAULT_LOG_DAYS = 365
+
+
+class Command(NoArgsCommand):
+    help = ("Moves rates superseded more than --rate-days ago, and admin "
+            "log entries older than --log-days, to the archive tables, "
+            "a chunk at a time. Should be run regularly, e.g. daily from "
+            "cron.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--rate-days', type='int',
+                    default=getattr(settings, 'CLERK_ARCHIVE_RATE_DAYS',
+                                    DEFAULT_RATE_DAYS),
+                    help="Archive rates superseded more than this many "
+                         "days ago."),
+        make_option('--log-days', type='int',
+                    default=getattr(settings, 'CLERK_ARCHIVE_LOG_DAYS',
+                                    DEFAULT_LOG_DAYS),
+                    help="Archive log entries older than this many days."),
+        make_option('--prune-log', action='store_true', default=False,
+                    help="Delete old log entries rather than archive them."),
+        make_option('--chunk-size', type='int',
+                    default=archive.ARCHIVE_CHUNK_SIZE,
+                    help="Rows moved per transaction."),
+    )
+
+    def handle_noargs(self, **options):
+        if options['rate_days'] < 0 or options['log_days'] < 0:
+            raise CommandError("Days can't be negative.")
+        if options['chunk_size'] < 1:
+            raise CommandError("The chunk size must be at least 1.")
+        now = timezone.now()
+
+        count = archive.archive_rates(
+            now - timedelta(days=options['rate_days']),
+            options['chunk_size'])
+        self.stdout.write("Archived %d rates." % count)
+
+        count = archive.archive_log(
+            now - timedelta(days=options['log_days']),
+            options['chunk_size'], prune=options['prune_log'])
+        if options['prune_log']:
+            self.stdout.write("Deleted %d log entries." % count)
+        else:
+            self.stdout.write("Archived %d log entries." % count)
@@ -0,0 +1,106 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.utils import timezone
+
+from clerk import benchmark
+
+SCENARIOS = [name for name, function in
+             benchmark.API_SCENARIOS + benchmark.MODEL_SCENARIOS]
+
+
+class Command(NoArgsCommand):
+    help = ("Benchmarks the api and the model methods behind it against a "
+            "catalog made by generate_catalog, reporting latency "
+            "percentiles, throughput and queries per request. The write "
+            "scenarios are undone afterwards, but run it against a "
+            "database made for it. Scenarios: " + ", ".join(SCENARIOS) +
+            ".")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--mode', choices=['process', 'http'], default='process',
+                    help="Make the api requests in process through the "
+                         "test client, or over http."),
+        make_option('--url',
+                    help="The server to make http requests to, by default "
+                         "one is started locally."),
+        make_option('--concurrency', type='int', default=8,
+                    help="Clients making http requests at once."),
+        make_option('--requests', type='int', default=200,
+                    help="Requests timed per scenario."),
+        make_option('--write-requests', type='int', default=20,
+                    help="Requests timed per scenario that writes."),
+        make_option('--warmup', type='int', default=10,
+                    help="Untimed requests made first per scenario."),
+        make_option('--scenario', action='append', dest='scenarios',
+                    choices=SCENARIOS,
+                    help="A scenario to run, may be repeated, by default "
+                         "all are run."),
+        make_option('--prefix', default='gen',
+                    help="Prefix of the generated catalog."),
+        make_option('--sample', type='int', default=100,
+                    help="Services the requests are spread over."),
+        make_option('--seed', type='int', default=0,
+                    help="Seed of the sample and the requests."),
+        make_option('--label',
+                    help="Saved with the results, e.g. the version."),
+        make_option('--output',
+                    help="File to save the results to as JSON."),
+        make_option('--compare',
+                    help="Results saved by an earlier run to compare "
+                         "with."),
+    )
+
+    def handle_noargs(self, **options):
+        for option in ('concurrency', 'requests', 'sample'):
+            if options[option] < 1:
+                raise CommandError("--%s must be at least 1." % option)
+        if options['write_requests'] < 0 or options['warmup'] < 0:
+            raise CommandError("Request counts can't be negative.")
+        if options['url'] and options['mode'] != 'http':
+            raise CommandError("--url needs --mode=http.")
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as stream:
+                baseline = json.load(stream)
+
+        try:
+            dataset = benchmark.Dataset(options['prefix'], options['sample'],
+                                        options['seed'])
+        except benchmark.BenchmarkError as error:
+            raise CommandError(str(error))
+        scenarios = benchmark.run(
+            dataset, options['requests'], options['write_requests'],
+            options['warmup'], options['mode'], options['url'],
+            options['concurrency'], options['scenarios'])
+        results = {'label': options['label'],
+                   'created': timezone.now().isoformat(),
+                   'dataset': dataset.counts, 'seed': options['seed'],
+                   'scenarios': scenarios}
+
+        self.stdout.write("%-20s %8s %6s %9s %9s %9s %9s %8s" % (
+            'scenario', 'requests', 'errors', 'req/s', 'p50 ms', 'p90 ms',
+            'p99 ms', 'queries'))
+        for name in SCENARIOS:
+            if name not in scenarios:
+                continue
+            result = scenarios[name]
+            latency = result['latency_ms'] or {}
+            queries = result['queries'] or {}
+            self.stdout.write("%-20s %8d %6d %9s %9s %9s %9s %8s" % (
+                name, result['requests'], result['errors'],
+                result['throughput'], latency.get('p50'),
+                latency.get('p90'), latency.get('p99'),
+                queries.get('mean')))
+
+        if baseline is not None:
+            self.stdout.write("\nCompared with %s (new / old):" % (
+                baseline.get('label') or options['compare']))
+            self.stdout.write("%-20s %9s %9s %9s %9s" % (
+                'scenario', 'p50', 'p90', 'req/s', 'queries'))
+            for row in benchmark.compare(scenarios, baseline['scenarios']):
+                self.stdout.write("%-20s %9s %9s %9s %9s" % row)
+
+        if options['output']:
+            with open(options['output'], 'w') as stream:
+                json.dump(results, stream, indent=2, sort_keys=True)
@@ -0,0 +1,34 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from clerk import compaction, timeline
+from clerk.models import Service
+
+
+class Command(NoArgsCommand):
+    help = ("Removes every rate that repeats the rate before it of its "
+            "service, without changing the rate effective at any date, "
+            "and reports how many were removed.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--region',
+                    help="Only compact the services of this region."),
+        make_option('--service-type',
+                    help="Only compact the services of this service type."),
+        make_option('--chunk-size', type='int',
+                    default=timeline.LOAD_BATCH_SIZE,
+                    help="Services compacted per transaction."),
+    )
+
+    def handle_noargs(self, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError("The chunk size must be at least 1.")
+        services = Service.objects.all()
+        if options['region']:
+            services = services.filter(region__name=options['region'])
+        if options['service_type']:
+            services = services.filter(
+                service_type__name=options['service_type'])
+
+        count = compaction.compact_rates(services, options['chunk_size'])
+        self.stdout.write("Removed %d redundant rates." % count)
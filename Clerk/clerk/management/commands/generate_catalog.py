@@ -0,0 +1,52 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from clerk import synthetic
+
+
+class Command(NoArgsCommand):
+    help = ("Generates a synthetic catalog for benchmarks: a service for "
+            "every region and service type, each with a history of rates "
+            "from --years ago until --future-years from now. The same "
+            "options and --seed always generate the same catalog. The "
+            "defaults create 100,000 services and about 4.5 million "
+            "rates.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--regions', type='int', default=500,
+                    help="Number of regions."),
+        make_option('--service-types', type='int', default=200,
+                    help="Number of service types."),
+        make_option('--years', type='int', default=10,
+                    help="Years of rate history before now."),
+        make_option('--future-years', type='int', default=1,
+                    help="Years of rates scheduled after now."),
+        make_option('--changes-per-year', type='int', default=4,
+                    help="Mean number of rate changes per year."),
+        make_option('--seed', type='int', default=synthetic.DEFAULT_SEED,
+                    help="Seed of the random rates and dates."),
+        make_option('--prefix', default='gen',
+                    help="Prefix of the generated names."),
+        make_option('--chunk-size', type='int',
+                    default=synthetic.GENERATE_CHUNK_SIZE,
+                    help="Services generated per transaction."),
+    )
+
+    def handle_noargs(self, **options):
+        def progress(counts):
+            if int(options['verbosity']) > 1:
+                self.stdout.write("Generated %(regions)d regions, "
+                                  "%(services)d services and %(rates)d "
+                                  "rates." % counts)
+
+        try:
+            counts = synthetic.generate_catalog(
+                options['regions'], options['service_types'],
+                options['years'], options['future_years'],
+                options['changes_per_year'], options['seed'],
+                options['prefix'], options['chunk_size'], progress)
+        except ValueError as error:
+            raise CommandError(str(error))
+        self.stdout.write("Generated %(regions)d regions, %(service_types)d "
+                          "service types, %(services)d services and "
+                          "%(rates)d rates." % counts)
@@ -0,0 +1,56 @@
+from optparse import make_option
+import csv
+import json
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from clerk import importer
+
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = ("Schedules the rate changes listed in a JSON or CSV file, "
+            "each row giving a region, service_type, rate and optional "
+            "date. Every row is checked before any is imported.")
+    option_list = BaseCommand.option_list + (
+        make_option('--format', choices=('json', 'csv'), default=None,
+                    help="The format of the file, json or csv. Defaults "
+                         "to its extension."),
+        make_option('--user', default=None,
+                    help="The username to log the changes against. "
+                         "Defaults to the user with id 1."),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give the file to import.")
+        path = args[0]
+        format = options['format'] or path.rsplit('.', 1)[-1].lower()
+        if format not in ('json', 'csv'):
+            raise CommandError("Give the format of the file with --format.")
+
+        user_id = None
+        if options['user'] is not None:
+            try:
+                user_id = User.objects.get(username=options['user']).pk
+            except User.DoesNotExist:
+                raise CommandError("No user named %s." % options['user'])
+
+        try:
+            with open(path, 'rb') as stream:
+                if format == 'json':
+                    rows = json.load(stream)
+                else:
+                    rows = importer.read_csv(stream)
+        except (IOError, ValueError, csv.Error) as e:
+            raise CommandError("Could not read %s: %s" % (path, e))
+
+        try:
+            count = importer.import_rates(rows, user_id=user_id)
+        except importer.RateImportError as e:
+            for error in e.errors:
+                self.stderr.write(json.dumps(error))
+            raise CommandError("Nothing was imported, %d rows are invalid."
+                               % len(e.errors))
+        self.stdout.write("Imported %d rates." % count)
@@ -0,0 +1,21 @@
+from django.core.management.base import NoArgsCommand
+from django.utils import timezone
+
+from clerk.models import Catalog, Rate, Service
+
+
+class Command(NoArgsCommand):
+    help = ("Moves the current flag and the current and next rates of "
+            "services onto rates whose date_effective has passed. Should "
+            "be run regularly, e.g. every minute from cron.")
+
+    def handle_noargs(self, **options):
+        now = timezone.now()
+        changed = Rate.objects.update_current(now)
+        self.stdout.write("Updated the current flag on %d rates." % changed)
+
+        count = Service.objects.update_due_rate_pointers(now)
+        self.stdout.write("Updated the current and next rates of " +
+                          "%d services." % count)
+        if changed > 0 or count > 0:
+            Catalog.bump()
@@ -0,0 +1,20 @@
+from django.core.management.base import NoArgsCommand
+
+from clerk.models import Catalog, Rate, Service
+
+
+class Command(NoArgsCommand):
+    help = ("Recalculates when each rate stops being effective, which "
+            "rates are current, and the current and next rates of every "
+            "service. Run once after adding the effective_until, current "
+            "and rate pointer columns to an existing database.")
+
+    def handle_noargs(self, **options):
+        count = 0
+        for service in Service.objects.all():
+            service.update_rate_intervals()
+            service.update_rate_pointers()
+            count += 1
+        Rate.objects.update_current()
+        Catalog.bump()
+        self.stdout.write("Updated rate intervals for %d services." % count)
@@ -0,0 +1,213 @@
+"""An in-process registry of metrics, exported in the Prometheus text
+format on /metrics.
+
+Requests are counted and timed per view by QueryCountMiddleware, see
+clerk.instrumentation, and the rate response cache, the name resolver
+and the rate timelines count their hits and misses. Each process keeps
+its own registry. To add up those of several WSGI workers, set
+CLERK_METRICS_DIR to a directory they share: each worker then writes a
+snapshot of its registry there, named by its pid, at most every
+CLERK_METRICS_FLUSH_INTERVAL seconds and when it exits, and /metrics
+adds up every snapshot. Snapshots of exited workers are kept, so totals
+don't drop when one is replaced, until a new worker reuses its pid; the
+directory should be emptied when the service is restarted."""
+import atexit
+import json
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+DEFAULT_FLUSH_INTERVAL = 5.0
+# upper bounds, in seconds, of the buckets of every histogram.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+           10.0)
+
+# name: (type, help) of every metric.
+METRICS = {
+    'clerk_requests_total': (
+        'counter', "Requests handled, by view, method and status."),
+    'clerk_request_duration_seconds': (
+        'histogram', "Time taken to handle requests, by view."),
+    'clerk_db_duration_seconds': (
+        'histogram', "Time taken by the SQL queries of requests, by view."),
+    'clerk_db_queries_total': (
+        'counter', "SQL queries made handling requests, by view."),
+    'clerk_cache_requests_total': (
+        'counter', "Lookups in the rate response cache, the name resolver "
+                   "and the rate timelines, by cache and result."),
+}
+
+_lock = threading.Lock()
+_counters = dict()
+# (name, labels): [bucket counts..., sum, count]
+_histograms = dict()
+_pid = os.getpid()
+_last_flush = time.time()
+
+
+def get_directory():
+    return getattr(settings, 'CLERK_METRICS_DIR', None)
+
+
+def get_flush_interval():
+    return getattr(settings, 'CLERK_METRICS_FLUSH_INTERVAL',
+                   DEFAULT_FLUSH_INTERVAL)
+
+
+def _check_pid():
+    # a worker forked after metrics were recorded starts its own count.
+    global _pid
+    if os.getpid() != _pid:
+        _pid = os.getpid()
+        _counters.clear()
+        _histograms.clear()
+
+
+def inc(name, amount=1, **labels):
+    """Adds to a counter.
+       - labels = strings, the labels of the series"""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _check_pid()
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name, value, **labels):
+    """Records a value, in seconds, in a histogram.
+       - labels = strings, the labels of the series"""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _check_pid()
+        counts = _histograms.get(key)
+        if counts is None:
+            counts = _histograms[key] = [0] * (len(BUCKETS) + 2)
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                counts[i] += 1
+                break
+        counts[-2] += value
+        counts[-1] += 1
+
+
+def snapshot():
+    """Returns the registry of this process as a dict that can be saved
+       as JSON."""
+    with _lock:
+        _check_pid()
+        return {'counters': [[name, labels, value] for (name, labels), value
+                             in _counters.items()],
+                'histograms': [[name, labels, list(counts)]
+                               for (name, labels), counts
+                               in _histograms.items()]}
+
+
+def get_path(pid):
+    return os.path.join(get_directory(), '%d.json' % pid)
+
+
+def flush():
+    """Writes the snapshot of this process to CLERK_METRICS_DIR, if
+       set, replacing the last one."""
+    global _last_flush
+    directory = get_directory()
+    if not directory:
+        return
+    _last_flush = time.time()
+    data = json.dumps(snapshot())
+    # written aside then renamed, so readers never see part of it.
+    handle, path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+    with os.fdopen(handle, 'w') as stream:
+        stream.write(data)
+    os.rename(path, get_path(os.getpid()))
+
+
+def maybe_flush():
+    """Flushes if CLERK_METRICS_FLUSH_INTERVAL seconds have passed since
+       the last flush."""
+    if get_directory() and (time.time() - _last_flush >=
+                            get_flush_interval()):
+        flush()
+
+
+def collect():
+    """Returns the snapshot of this process added to those of every
+       other process in CLERK_METRICS_DIR, as a dict of counters, and a
+       dict of histograms, by (name, labels)."""
+    snapshots = [snapshot()]
+    directory = get_directory()
+    if directory:
+        own = '%d.json' % os.getpid()
+        for filename in os.listdir(directory):
+            if not filename.endswith('.json') or filename == own:
+                continue
+            try:
+                with open(os.path.join(directory, filename)) as stream:
+                    snapshots.append(json.load(stream))
+            except (IOError, ValueError):
+                # the worker's file was replaced as it was read.
+                continue
+
+    counters = dict()
+    histograms = dict()
+    for data in snapshots:
+        for name, labels, value in data['counters']:
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, counts in data['histograms']:
+            key = (name, tuple(tuple(label) for label in labels))
+            total = histograms.setdefault(key, [0] * len(counts))
+            for i, count in enumerate(counts):
+                total[i] += count
+    return counters, histograms
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, unicode(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n')) for key, value in labels)
+
+
+def render():
+    """Returns every metric, of every process, in the Prometheus text
+       format."""
+    counters, histograms = collect()
+    lines = []
+    for name in sorted(METRICS):
+        kind, description = METRICS[name]
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s %s' % (name, kind))
+        if kind == 'counter':
+            for key in sorted(key for key in counters if key[0] == name):
+                lines.append('%s%s %s' % (name, format_labels(key[1]),
+                                          counters[key]))
+            continue
+        for key in sorted(key for key in histograms if key[0] == name):
+            counts = histograms[key]
+            cumulative = 0
+            for bound, count in zip(BUCKETS, counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (
+                    name, format_labels(key[1] + (('le', repr(bound)),)),
+                    cumulative))
+            lines.append('%s_bucket%s %d' % (
+                name, format_labels(key[1] + (('le', '+Inf'),)), counts[-1]))
+            lines.append('%s_sum%s %s' % (name, format_labels(key[1]),
+                                          counts[-2]))
+            lines.append('%s_count%s %d' % (name, format_labels(key[1]),
+                                            counts[-1]))
+    return '\n'.join(lines) + '\n'
+
+
+def clear():
+    """Forgets every metric recorded by this process."""
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+atexit.register(flush)
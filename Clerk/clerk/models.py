@@ -1,10 +1,14 @@
-from django.db import models
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.db.models import Q
 from django.utils import timezone
 from datetime import datetime
 from django.core import validators
-from django.contrib.contenttypes.models import ContentType as ct
 import re
-from django.contrib.admin.models import LogEntry, ADDITION
+from django.contrib.admin.models import ADDITION
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+from clerk import audit, catalogcache, ratecache, resolver, timeline
 
 noSpaces = validators.RegexValidator(regex='^[A-Za-z0-9_]+$',
                                      message="Must contain only " +
@@ -20,34 +24,155 @@ class Region(models.Model):
     description = models.TextField()
     created = models.DateTimeField(default=timezone.now, editable=False)
 
-    def set_new_service(self, service_type, start_rate):
+    def set_new_service(self, service_type, start_rate, user_id=None):
         """Adds a new service.
            - name = string
            - description = string
-           - start_rate = any positive number or zero """
+           - start_rate = any positive number or zero
+           - user_id = int, the user the addition is logged against,
+             see clerk.audit for the default"""
+        return self.set_new_services({service_type: start_rate},
+                                     user_id)[0]
 
+    def set_new_services(self, start_rates, user_id=None):
+        """Adds a new service for each of the given service types, with
+           their starting rates, in a single transaction. The services,
+           rates and log entries are each inserted in bulk, so this costs
+           the same few queries however many services are added.
+           Returns the new services.
+           - start_rates = dict of Service_Type to any positive number
+             or zero
+           - user_id = int, the user the additions are logged against,
+             see clerk.audit for the default"""
         # check input types, throw typeError if incorrect:
-        if not isinstance(service_type, Service_Type):
-            raise TypeError("service_type must be a Service_Type object")
-        elif (not isinstance(start_rate, (int, long, float, complex))
-              or start_rate < 0):
-            raise TypeError("start_rate must be a positive number, or zero")
-
-        if (len(self.service_set.filter(service_type=service_type)) == 0):
-            new_service = Service(service_type=service_type, region=self)
-            new_service.save()
-            new_service.set_new_rate(start_rate)
-            LogEntry.objects.log_action(
-                user_id=1,  # somewhat unsafe assumption, that admin is user 1.
-                content_type_id=ct.objects.get_for_model(Service).pk,
-                object_id=new_service.pk,
-                object_repr=new_service.__unicode__(),
-                action_flag=ADDITION,
-                change_message="New service created @ " + self.__unicode__() +
-                               ", automatically.")
-            return new_service
-        else:
-            raise AttributeError("service with this name already exists.")
+        for service_type, start_rate in start_rates.items():
+            if not isinstance(service_type, Service_Type):
+                raise TypeError("service_type must be a Service_Type object")
+            elif (not isinstance(start_rate, (int, long, float, complex))
+                  or start_rate < 0):
+                raise TypeError("start_rate must be a positive number, " +
+                                "or zero")
+        if len(start_rates) == 0:
+            return []
+
+        now = timezone.now()
+        with transaction.atomic():
+            if self.service_set.filter(
+                    service_type__in=start_rates.keys()).exists():
+                raise AttributeError("service with this name already exists.")
+            Service.objects.bulk_create([
+                Service(service_type=service_type, region=self, created=now)
+                for service_type in start_rates])
+            # bulk_create doesn't set pks, so read the services back.
+            services = list(self.service_set.filter(
+                service_type__in=start_rates.keys()).select_related(
+                'service_type', 'region'))
+            Rate.objects.bulk_create([
+                Rate(rate=start_rates[service.service_type],
+                     date_effective=now, created=now, current=True,
+                     service=service, service_type=service.service_type,
+                     region=self)
+                for service in services])
+            rates = list(Rate.objects.filter(service__in=services))
+            Service.objects.update_rate_pointers(
+                [service.pk for service in services], now)
+            current = dict((rate.service_id, rate) for rate in rates)
+            for service in services:
+                service.current_rate = current[service.pk]
+
+            entries = []
+            for service in services:
+                entries.append(audit.make_entry(
+                    Service, service.pk, service.__unicode__(), ADDITION,
+                    "New service created @ " + self.__unicode__() +
+                    ", automatically.", user_id))
+            names = dict((service.pk, service.__unicode__())
+                         for service in services)
+            for rate in rates:
+                entries.append(audit.make_entry(
+                    Rate, rate.pk, rate.__unicode__(), ADDITION,
+                    "New rate created for " + names[rate.service_id] +
+                    ", automatically.", user_id))
+            audit.log_entries(entries)
+            Catalog.bump()
+
+        # bulk_create sends no signals, so do what the handlers would.
+        resolver.clear()
+        for service in services:
+            timeline.invalidate(service.pk)
+            ratecache.purge(service.pk)
+        return services
+
+    def clone(self, name, description=None, user_id=None):
+        """Creates a new region with a copy of each of this region's
+           services, priced from now on as they are here. The current and
+           future rates of every service are copied, with the current one
+           taking effect now. The services and rates are each copied with
+           a single bulk insert, in a single transaction.
+           Returns the new region.
+           - name = string, the name of the new region
+           - description = string, defaults to this region's
+           - user_id = int, the user the additions are logged against,
+             see clerk.audit for the default"""
+        if description is None:
+            description = self.description
+        now = timezone.now()
+        with transaction.atomic():
+            region = Region.objects.create(name=name,
+                                           description=description)
+            Service.objects.bulk_create([
+                Service(service_type_id=service_type_id, region=region,
+                        created=now)
+                for service_type_id in self.service_set.values_list(
+                    'service_type', flat=True)])
+            # bulk_create doesn't set pks, so read the services back.
+            services = list(region.service_set.select_related(
+                'service_type'))
+            copies = dict((service.service_type_id, service)
+                          for service in services)
+
+            rates = []
+            for rate in Rate.objects.filter(service__region=self).filter(
+                    Q(effective_until__isnull=True) |
+                    Q(effective_until__gt=now)).order_by(
+                    'date_effective', 'id'):
+                rates.append(Rate(
+                    rate=rate.rate, date_effective=max(rate.date_effective,
+                                                       now),
+                    effective_until=rate.effective_until, created=now,
+                    current=rate.date_effective <= now,
+                    service=copies[rate.service_type_id],
+                    service_type_id=rate.service_type_id, region=region))
+            Rate.objects.bulk_create(rates)
+            Service.objects.update_rate_pointers(
+                [service.pk for service in services], now)
+
+            entries = [audit.make_entry(
+                Region, region.pk, region.__unicode__(), ADDITION,
+                "Region cloned from " + self.__unicode__() + ".", user_id)]
+            names = dict()
+            for service in services:
+                names[service.pk] = (service.service_type.name + " @ " +
+                                     region.name)
+                entries.append(audit.make_entry(
+                    Service, service.pk, names[service.pk], ADDITION,
+                    "New service created @ " + region.__unicode__() +
+                    ", by cloning " + self.__unicode__() + ".", user_id))
+            for pk, service_id, rate in Rate.objects.filter(
+                    region=region).values_list('pk', 'service', 'rate'):
+                entries.append(audit.make_entry(
+                    Rate, pk, str(rate), ADDITION,
+                    "New rate created for " + names[service_id] +
+                    ", by cloning " + self.__unicode__() + ".", user_id))
+            audit.log_entries(entries)
+
+        # bulk_create sends no signals, so do what the handlers would.
+        resolver.clear()
+        for service in services:
+            timeline.invalidate(service.pk)
+            ratecache.purge(service.pk)
+        Catalog.bump()
+        return region
 
     def get_service_by_type_name(self, type):
         """Return the service of with given type at this region.
@@ -55,8 +180,11 @@ class Region(models.Model):
         # check input types, throw typeError if incorrect:
         if not isinstance(type, str) or not re.match(r'^[A-Za-z0-9_]+$', type):
             raise TypeError("type must be a string")
-        service_type = Service_Type.objects.get(name=type)
-        return self.service_set.get(service_type=service_type)
+        pk = resolver.get_service_id(self.name, type)
+        if pk is None:
+            raise Service.DoesNotExist("service with this type does " +
+                                       "not exist at this region.")
+        return self.service_set.get(pk=pk)
 
     def __unicode__(self):
         return self.name
@@ -73,6 +201,86 @@ class Service_Type(models.Model):
         return self.pretty_name
 
 
+class ServiceManager(models.Manager):
+
+    def update_rate_pointers(self, pks, now=None):
+        """Does what Service.update_rate_pointers does for many services
+           with a single UPDATE, correlated with the rate table, which
+           the ORM can't express.
+           - pks = list of service pks
+           - now = datetime object, defaults to now"""
+        if len(pks) == 0:
+            return
+        self._update_rate_pointers('%(id)s IN (' +
+                                   ', '.join(['%%s'] * len(pks)) + ')',
+                                   list(pks), now)
+
+    def update_due_rate_pointers(self, now=None):
+        """Does what Service.update_rate_pointers does for every service
+           whose next rate has taken effect, with a single UPDATE.
+           Returns the number of services updated.
+           - now = datetime object, defaults to now"""
+        if now is None:
+            now = timezone.now()
+        return self._update_rate_pointers(
+            '%(next_change_at)s <= %%s',
+            [connection.ops.value_to_db_datetime(now)], now)
+
+    def _update_rate_pointers(self, where, params, now=None):
+        if now is None:
+            now = timezone.now()
+        quote = connection.ops.quote_name
+        names = {
+            'service': quote(Service._meta.db_table),
+            'rate': quote(Rate._meta.db_table),
+            'id': quote('id'),
+            'service_id': quote(Rate._meta.get_field('service').column),
+            'date': quote('date_effective'),
+            'until': quote('effective_until'),
+            'current_rate': quote(Service._meta.get_field(
+                'current_rate').column),
+            'next_rate': quote(Service._meta.get_field('next_rate').column),
+            'next_change_at': quote('next_change_at')}
+        # of rates sharing a date, the latest created takes effect.
+        sql = ("UPDATE %(service)s SET "
+               "%(current_rate)s = (SELECT %(id)s FROM %(rate)s "
+               "WHERE %(service_id)s = %(service)s.%(id)s "
+               "AND %(date)s <= %%s "
+               "AND (%(until)s IS NULL OR %(until)s > %%s) "
+               "ORDER BY %(date)s DESC, %(id)s DESC LIMIT 1), "
+               "%(next_rate)s = (SELECT %(id)s FROM %(rate)s "
+               "WHERE %(service_id)s = %(service)s.%(id)s "
+               "AND %(date)s > %%s "
+               "ORDER BY %(date)s, %(id)s DESC LIMIT 1), "
+               "%(next_change_at)s = (SELECT MIN(%(date)s) FROM %(rate)s "
+               "WHERE %(service_id)s = %(service)s.%(id)s "
+               "AND %(date)s > %%s) "
+               "WHERE " + where) % names
+        now = connection.ops.value_to_db_datetime(now)
+        cursor = connection.cursor()
+        cursor.execute(sql, [now, now, now, now] + params)
+        return cursor.rowcount
+
+    def get_by_names(self, names):
+        """Returns a dict of every service with one of the given
+           (region name, service type name) pairs, keyed by the pair,
+           in a single query.
+           - names = iterable of (string, string) tuples"""
+        names = set((unicode(region), unicode(service_type))
+                    for region, service_type in names)
+        services = dict()
+        if len(names) == 0:
+            return services
+        for service in self.get_queryset().select_related(
+                'region', 'service_type').filter(
+                region__name__in=set(name[0] for name in names),
+                service_type__name__in=set(name[1] for name in names)):
+            key = (service.region.name, service.service_type.name)
+            if key in names:
+                services[key] = service
+        return services
+
+
 class Service(models.Model):
     """Service representation.
        Connects to all rates, past and future.
@@ -81,23 +289,48 @@ class Service(models.Model):
     created = models.DateTimeField(default=timezone.now, editable=False)
     region = models.ForeignKey(Region)
 
+    # Denormalised so services can be listed with their rates in one
+    # query, kept up to date by update_rate_pointers.
+    current_rate = models.ForeignKey('Rate', null=True, blank=True,
+                                     editable=False, related_name='+',
+                                     on_delete=models.SET_NULL)
+    next_rate = models.ForeignKey('Rate', null=True, blank=True,
+                                  editable=False, related_name='+',
+                                  on_delete=models.SET_NULL)
+    # when next_rate takes over, None if there is no future rate.
+    next_change_at = models.DateTimeField(null=True, blank=True,
+                                          editable=False, db_index=True)
+
+    objects = ServiceManager()
+
     def get_current_rate(self):
         """Returns the most recent rate that was effective from a date
            that is less than or equal to now."""
-        now = timezone.now()
-        rates = self.rate_set.filter(date_effective__lte=
-                                     now).order_by('-date_effective')
-        if len(rates) > 0:
-            return rates[0]
-        else:
-            return None
+        return self._as_rate(
+            timeline.get_timeline(self.pk).rate_at(timezone.now()))
     get_current_rate.short_description = "Current rate"
 
-    def set_new_rate(self, new_rate, start_date=None):
+    def _as_rate(self, entry):
+        # a Rate for an entry of this service's timeline, sharing the
+        # region and service_type this service was loaded with.
+        rate = timeline.as_rate(entry)
+        if rate is not None:
+            rate.service = self
+            rate.service_type = self.service_type
+            rate.region = self.region
+        return rate
+
+    def set_new_rate(self, new_rate, start_date=None, user_id=None,
+                     dedupe=None):
         """Sets a new rate. If no start_date is given
            now will be used. Default value will mean given rate is now current.
            - new_rate = none negative number, can be zero
-           - start_date = datetime object, can be in the future"""
+           - start_date = datetime object, can be in the future
+           - user_id = int, the user the change is logged against,
+             see clerk.audit for the default
+           - dedupe = bool, if True and the rate effective at start_date
+             is already new_rate, nothing is written and that rate is
+             returned. Defaults to the CLERK_RATE_DEDUPE setting."""
 
         # Set start_date default if one is not given:
         if start_date is None:
@@ -110,22 +343,44 @@ class Service(models.Model):
         elif (not isinstance(new_rate, (int, long, float, complex))
               or new_rate < 0):
             raise TypeError("new_rate must a positive number or zero")
+        if dedupe is None:
+            dedupe = getattr(settings, 'CLERK_RATE_DEDUPE', False)
 
-        new_rate_object = Rate(rate=new_rate, date_effective=start_date,
-                               service=self, service_type=self.service_type,
-                               region=self.region)
-        new_rate_object.save()
-        LogEntry.objects.log_action(
-            user_id=1,  # somewhat unsafe assumption, that admin is user 1.
-            content_type_id=ct.objects.get_for_model(Rate).pk,
-            object_id=new_rate_object.pk,
-            object_repr=new_rate_object.__unicode__(),
-            action_flag=ADDITION,
-            change_message="New rate created for " + self.__unicode__() +
-                           ", automatically.")
+        with transaction.atomic():
+            if dedupe:
+                # another row would repeat it, see clerk.compaction.
+                previous = list(self.rate_set.filter(
+                    date_effective__lte=start_date).order_by(
+                    '-date_effective', '-id')[:1])
+                if len(previous) > 0 and previous[0].rate == new_rate:
+                    return previous[0]
+            new_rate_object = Rate(rate=new_rate, date_effective=start_date,
+                                   service=self,
+                                   service_type=self.service_type,
+                                   region=self.region)
+            # the new rate lasts until the next one, if any, starts:
+            following = list(self.rate_set.filter(
+                date_effective__gt=start_date).order_by('date_effective')[:1])
+            if len(following) > 0:
+                new_rate_object.effective_until = following[0].date_effective
+            # it is patched into the timeline below, once committed.
+            new_rate_object.patch_timeline = False
+            new_rate_object.save()
+            # and cuts short the rate that was effective at its start.
+            self.rate_set.effective_at(start_date).exclude(
+                pk=new_rate_object.pk).update(effective_until=start_date)
+            self.rate_set.update_current()
+            self.update_rate_pointers()
+        # the rate signal purged cached responses before the commit,
+        # purge again in case one was cached from the old rates since,
+        # and patch in the committed rate.
+        ratecache.purge(self.pk)
+        timeline.add_rate(new_rate_object)
+        audit.log(Rate, new_rate_object.pk, new_rate_object.__unicode__(),
+                  ADDITION, "New rate created for " + self.__unicode__() +
+                  ", automatically.", user_id)
         return new_rate_object
 
-    # this function is currently unused, but should be bound to the rest API
     def get_rate_nearest_to(self, date):
         """Returns the most recent rate that is less than or equal to
            the given date.
@@ -134,30 +389,175 @@ class Service(models.Model):
         if type(date) != datetime:
             raise TypeError("date must be a datetime object.")
 
-        rates = self.rate_set.filter(date_effective__lte=
-                                     date).order_by('-date_effective')
-        for i in range(len(rates)):
-            if rates[i].date_effective <= date:
-                return rates[i]
-        return None
+        rate = self._as_rate(timeline.get_timeline(self.pk).rate_at(date))
+        if rate is None:
+            # rates before the oldest live one may have been archived.
+            archived_until = catalogcache.get_catalog().archived_until
+            if archived_until is not None and date < archived_until:
+                rate = self.archivedrate_set.filter(
+                    date_effective__lte=date).order_by(
+                    '-date_effective', '-id').first()
+        return rate
 
     def get_next_future_rate(self):
         """Returns the next rate after the current one.
            Returns current rate if no future ones."""
-        now = timezone.now()
-        rates = self.rate_set.filter(date_effective__gt=
-                                     now).order_by('date_effective')
-        if len(rates) > 0:
-            return rates[0]
+        rate = timeline.get_timeline(self.pk).rate_after(timezone.now())
+        if rate is not None:
+            return self._as_rate(rate)
         else:
             return self.get_current_rate()
     get_next_future_rate.short_description = "Next future rate"
 
+    def update_rate_pointers(self, now=None):
+        """Points current_rate and next_rate at the rates effective now
+           and next, and records when the next one takes over.
+           - now = datetime object, defaults to now"""
+        if now is None:
+            now = timezone.now()
+        current = list(self.rate_set.effective_at(now)[:1])
+        # of future rates sharing a date, the latest created takes effect.
+        following = list(self.rate_set.filter(
+            date_effective__gt=now).order_by('date_effective', '-id')[:1])
+
+        self.current_rate = current[0] if len(current) > 0 else None
+        self.next_rate = following[0] if len(following) > 0 else None
+        if self.next_rate is not None:
+            self.next_change_at = self.next_rate.date_effective
+        else:
+            self.next_change_at = None
+        Service.objects.filter(pk=self.pk).update(
+            current_rate=self.current_rate, next_rate=self.next_rate,
+            next_change_at=self.next_change_at)
+
+    def update_rate_intervals(self):
+        """Recalculates effective_until for every rate of this service,
+           needed only when rates have been edited directly."""
+        with transaction.atomic():
+            rates = list(self.rate_set.order_by('date_effective', 'id'))
+            for i in range(len(rates)):
+                if i + 1 < len(rates):
+                    until = rates[i + 1].date_effective
+                else:
+                    until = None
+                if rates[i].effective_until != until:
+                    Rate.objects.filter(pk=rates[i].pk).update(
+                        effective_until=until)
+
     def __unicode__(self):
         return (self.service_type.name + " @ "
                 + self.region.name)
 
 
+class RateHistoryManager(models.Manager):
+
+    def effective_at(self, date):
+        """Returns the rate effective at the given date for every
+           service, in a single query.
+           - date = datetime object, can be in the future"""
+        return self.overlapping(date, date)
+
+    def overlapping(self, start, end):
+        """Returns every rate that was effective at any point
+           between the given dates, inclusive.
+           - start, end = datetime objects, can be in the future"""
+        return self.get_queryset().filter(
+            Q(effective_until__isnull=True) | Q(effective_until__gt=start),
+            date_effective__lte=end)
+
+    def history(self, start=None, end=None, after=None):
+        """Returns rates ordered by date_effective then pk, for paging
+           through with a keyset rather than an offset.
+           - start, end = datetime objects, optional, limit the rates to
+             those effective at any point between them, inclusive
+           - after = (date_effective, pk) tuple, optional, of the last
+             rate already seen"""
+        rates = self.get_queryset()
+        if start is not None:
+            rates = rates.filter(Q(effective_until__isnull=True) |
+                                 Q(effective_until__gt=start))
+        if end is not None:
+            rates = rates.filter(date_effective__lte=end)
+        if after is not None:
+            date, pk = after
+            rates = rates.filter(Q(date_effective__gt=date) |
+                                 Q(date_effective=date, pk__gt=pk))
+        return rates.order_by('date_effective', 'pk')
+
+
+class RateManager(RateHistoryManager):
+
+    def update_current(self, now=None, service_ids=None):
+        """Sets the current flag on the rates effective now and clears it
+           from every other rate. Returns the number of rates changed.
+           - now = datetime object, defaults to now
+           - service_ids = list of service pks, optional, limits the
+             rates updated to theirs"""
+        if now is None:
+            now = timezone.now()
+        rates = self.get_queryset()
+        effective = self.effective_at(now)
+        if service_ids is not None:
+            rates = rates.filter(service__in=service_ids)
+            effective = effective.filter(service__in=service_ids)
+        # the rates not effective_at now, written out rather than as a
+        # subquery, as MySQL can't select from the table it updates.
+        changed = rates.filter(Q(date_effective__gt=now) |
+                               Q(effective_until__lte=now),
+                               current=True).update(current=False)
+        changed += effective.filter(current=False).update(current=True)
+        return changed
+
+    def update_intervals(self, service_ids, since=None):
+        """Does what Service.update_rate_intervals does for many services
+           with a single UPDATE, correlated with the rate table itself.
+           Returns the number of rates updated.
+           - service_ids = list of service pks
+           - since = datetime object, optional, only rates lasting past
+             it are updated, as when no rate was added or removed
+             before it"""
+        if len(service_ids) == 0:
+            return 0
+        quote = connection.ops.quote_name
+        names = {
+            'rate': quote(Rate._meta.db_table),
+            'later': quote('later'),
+            'intervals': quote('intervals'),
+            'id': quote('id'),
+            'service_id': quote(Rate._meta.get_field('service').column),
+            'date': quote('date_effective'),
+            'until': quote('effective_until')}
+        # of rates sharing a date, the later created takes effect at once.
+        later = ("%(later)s.%(service_id)s = %(rate)s.%(service_id)s "
+                 "AND (%(later)s.%(date)s > %(rate)s.%(date)s "
+                 "OR (%(later)s.%(date)s = %(rate)s.%(date)s "
+                 "AND %(later)s.%(id)s > %(rate)s.%(id)s))")
+        where = ("%(rate)s.%(service_id)s IN (" +
+                 ", ".join(["%%s"] * len(service_ids)) + ")")
+        params = list(service_ids)
+        if since is not None:
+            where += (" AND (%(rate)s.%(until)s IS NULL "
+                      "OR %(rate)s.%(until)s > %%s)")
+            params.append(connection.ops.value_to_db_datetime(since))
+        if connection.features.update_can_self_select:
+            sql = ("UPDATE %(rate)s SET %(until)s = ("
+                   "SELECT MIN(%(later)s.%(date)s) FROM %(rate)s %(later)s "
+                   "WHERE " + later + ") WHERE " + where) % names
+        else:
+            # MySQL can't read the table it updates in a subquery, but
+            # can join it to a derived table read first.
+            sql = ("UPDATE %(rate)s INNER JOIN ("
+                   "SELECT %(rate)s.%(id)s AS %(id)s, "
+                   "MIN(%(later)s.%(date)s) AS %(until)s FROM %(rate)s "
+                   "LEFT OUTER JOIN %(rate)s %(later)s ON " + later +
+                   " WHERE " + where + " GROUP BY %(rate)s.%(id)s) "
+                   "%(intervals)s ON %(intervals)s.%(id)s = %(rate)s.%(id)s "
+                   "SET %(rate)s.%(until)s = %(intervals)s.%(until)s") % names
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        return cursor.rowcount
+
+
 class Rate(models.Model):
     rate = models.FloatField()
     date_effective = models.DateTimeField('date_effective',
@@ -167,12 +567,194 @@ class Rate(models.Model):
     service = models.ForeignKey(Service)
     service_type = models.ForeignKey(Service_Type)
     region = models.ForeignKey(Region)
-    current = models.BooleanField(default=True)
+    # when the next rate for the service takes over, None if it never does.
+    effective_until = models.DateTimeField(null=True, blank=True,
+                                           editable=False, db_index=True)
+    # kept up to date by set_new_rate and the update_current_rates command.
+    current = models.BooleanField(default=False, editable=False,
+                                  db_index=True)
+
+    objects = RateManager()
+
+    class Meta:
+        # every rate lookup is by service or by region and service_type,
+        # then by date.
+        index_together = [['service', 'date_effective'],
+                          ['region', 'service_type', 'date_effective']]
 
     def is_current(self):
-        self.current = self.service.get_current_rate().pk == self.pk
         return self.current
     is_current.boolean = True
+    is_current.admin_order_field = 'current'
 
     def __unicode__(self):
         return str(self.rate)
+
+
+class ArchivedRate(models.Model):
+    """A rate superseded long enough ago to be moved out of the Rate
+       table by the archive command, keeping its id."""
+    id = models.IntegerField(primary_key=True)
+    rate = models.FloatField()
+    date_effective = models.DateTimeField('date_effective')
+    created = models.DateTimeField(editable=False)
+    effective_until = models.DateTimeField(editable=False)
+
+    service = models.ForeignKey(Service)
+    service_type = models.ForeignKey(Service_Type)
+    region = models.ForeignKey(Region)
+
+    objects = RateHistoryManager()
+
+    class Meta:
+        index_together = [['service', 'date_effective'],
+                          ['region', 'service_type', 'date_effective']]
+
+    def __unicode__(self):
+        return str(self.rate)
+
+
+class ArchivedLogEntry(models.Model):
+    """A LogEntry old enough to be moved out of the admin log by the
+       archive command, keeping its id."""
+    id = models.IntegerField(primary_key=True)
+    action_time = models.DateTimeField(db_index=True)
+    user_id = models.IntegerField()
+    content_type_id = models.IntegerField(null=True, blank=True)
+    object_id = models.TextField(null=True, blank=True)
+    object_repr = models.CharField(max_length=200)
+    action_flag = models.PositiveSmallIntegerField()
+    change_message = models.TextField(blank=True)
+
+    def __unicode__(self):
+        return self.object_repr
+
+
+class Catalog(models.Model):
+    """A single row versioning the whole catalog of regions, service
+       types, services and rates. Bumped on every write to any of them,
+       so clients can tell whether anything has changed."""
+    version = models.PositiveIntegerField(default=0)
+    modified = models.DateTimeField(default=timezone.now)
+    # every archived rate had ended by this date, None if none have been
+    # archived.
+    archived_until = models.DateTimeField(null=True, blank=True)
+
+    @classmethod
+    def get_current(cls):
+        catalog, created = cls.objects.get_or_create(pk=1)
+        return catalog
+
+    @classmethod
+    def bump(cls):
+        """Marks the catalog as changed now."""
+        updated = cls.objects.filter(pk=1).update(
+            version=models.F('version') + 1, modified=timezone.now())
+        if updated == 0:
+            cls.objects.get_or_create(pk=1, defaults={'version': 1})
+        catalogcache.clear()
+
+    def __unicode__(self):
+        return str(self.version)
+
+
+# Keep the in-process rate timelines and the rate intervals in step
+# with writes:
+
+@receiver(post_save, sender=Rate)
+def rate_saved(sender, instance, created, raw=False, **kwargs):
+    ratecache.purge(instance.service_id)
+    if created and not raw:
+        if getattr(instance, 'patch_timeline', True):
+            timeline.add_rate(instance)
+    else:
+        # an edited rate may have moved in time or between services.
+        timeline.clear()
+        if not raw:
+            instance.service.update_rate_intervals()
+            instance.service.rate_set.update_current()
+            instance.service.update_rate_pointers()
+
+
+@receiver(post_delete, sender=Rate)
+def rate_deleted(sender, instance, **kwargs):
+    ratecache.purge(instance.service_id)
+    timeline.invalidate(instance.service_id)
+    # the rate before the deleted one now lasts until the one after it.
+    rates = Rate.objects.filter(service_id=instance.service_id)
+    previous = list(rates.filter(
+        date_effective__lte=instance.date_effective).order_by(
+        '-date_effective', '-id')[:1])
+    if len(previous) > 0:
+        following = list(rates.filter(
+            date_effective__gt=instance.date_effective).order_by(
+            'date_effective')[:1])
+        until = None
+        if len(following) > 0:
+            until = following[0].date_effective
+        rates.filter(pk=previous[0].pk).update(effective_until=until)
+    try:
+        instance.service.rate_set.update_current()
+        instance.service.update_rate_pointers()
+    except Service.DoesNotExist:
+        pass
+
+
+@receiver(post_save, sender=Service)
+def service_saved(sender, instance, created, **kwargs):
+    if created:
+        # primary keys can be reused, so never trust an older timeline.
+        timeline.invalidate(instance.pk)
+    # its region or service type may have changed.
+    resolver.clear()
+    ratecache.purge(instance.pk)
+
+
+@receiver(post_delete, sender=Service)
+def service_deleted(sender, instance, **kwargs):
+    timeline.invalidate(instance.pk)
+    resolver.clear()
+    ratecache.purge(instance.pk)
+
+
+# Forget cached names, and every cached response showing them, when a
+# region or service type is renamed or deleted. A new one only changes
+# the names using its own:
+
+@receiver(post_init, sender=Region)
+@receiver(post_init, sender=Service_Type)
+def name_loaded(sender, instance, **kwargs):
+    instance._saved_name = instance.name
+
+
+@receiver(post_save, sender=Region)
+@receiver(post_save, sender=Service_Type)
+def name_saved(sender, instance, created, **kwargs):
+    if created:
+        resolver.forget('region' if sender is Region else 'service_type',
+                        instance.name)
+    elif getattr(instance, '_saved_name', None) != instance.name:
+        resolver.clear()
+        ratecache.clear()
+    instance._saved_name = instance.name
+
+
+@receiver(post_delete, sender=Region)
+@receiver(post_delete, sender=Service_Type)
+def name_deleted(sender, **kwargs):
+    resolver.clear()
+    ratecache.clear()
+
+
+# Any write to the catalog makes it a new version:
+
+@receiver(post_save, sender=Region)
+@receiver(post_delete, sender=Region)
+@receiver(post_save, sender=Service_Type)
+@receiver(post_delete, sender=Service_Type)
+@receiver(post_save, sender=Service)
+@receiver(post_delete, sender=Service)
+@receiver(post_save, sender=Rate)
+@receiver(post_delete, sender=Rate)
+def catalog_changed(sender, **kwargs):
+    Catalog.bump()
@@ -0,0 +1,17 @@
+import csv
+
+from rest_framework.parsers import BaseParser
+from rest_framework.exceptions import ParseError
+
+from clerk.importer import read_csv
+
+
+class CSVParser(BaseParser):
+    """Parses CSV with a header row into a list of dicts, one per row."""
+    media_type = 'text/csv'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return read_csv(stream)
+        except csv.Error as e:
+            raise ParseError('CSV parse error - %s' % unicode(e))
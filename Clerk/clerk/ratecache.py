@@ -0,0 +1,99 @@
+"""A cache of rendered responses for the current and future rate views.
+
+Their answers only change when a rate is written or when the next rate
+of the service takes effect, so the rendered bytes are kept until the
+earlier of the two. Entries expire at the next rate boundary and are
+purged by the rate signal handlers in models.py when rates are written.
+
+Uses the Django cache named by CLERK_RATE_CACHE, which should be
+dedicated to it as renaming a region or service type clears it whole,
+and shared by every process, such as a file based cache, so a purge in
+one is seen by all. Keys include the catalog version, as the ETags of
+the responses do, so a write made anywhere also leaves the entries of
+the version before it unused until they expire."""
+from django.conf import settings
+from django.core.cache import get_cache
+from django.http import HttpResponse
+from django.utils import timezone
+
+from clerk import catalogcache, metrics
+
+# seconds to keep a response for a service with no future rate.
+DEFAULT_TIMEOUT = 3600
+# the views whose responses are cached.
+KINDS = ('current', 'future')
+# responses are only cached for renderers whose output doesn't depend on
+# the request, which rules out the browsable api.
+FORMATS = ('json',)
+
+
+def get_rate_cache():
+    return get_cache(getattr(settings, 'CLERK_RATE_CACHE', 'default'))
+
+
+def get_timeout():
+    return getattr(settings, 'CLERK_RATE_CACHE_TIMEOUT', DEFAULT_TIMEOUT)
+
+
+def make_key(kind, service_id, format, catalog):
+    # the catalog is recreated with version 1 if its row is ever lost,
+    # so the time of its last change tells the versions apart.
+    return 'clerk:rate:%s:%s:%s:%s:%s' % (
+        catalog.version, catalog.modified.isoformat(), kind, service_id,
+        format)
+
+
+def get_response(kind, service_id, request):
+    """Returns the cached response for the request, or None."""
+    format = request.accepted_renderer.format
+    if format not in FORMATS:
+        return None
+    cached = get_rate_cache().get(make_key(
+        kind, service_id, format, catalogcache.get_catalog(request)))
+    metrics.inc('clerk_cache_requests_total', cache='rate',
+                result='miss' if cached is None else 'hit')
+    if cached is None:
+        return None
+    content, content_type = cached
+    return HttpResponse(content, content_type=content_type)
+
+
+def set_response(kind, service_id, request, response, view, expires=None):
+    """Renders the response and caches it until expires, a datetime, or
+       for CLERK_RATE_CACHE_TIMEOUT seconds if None. Returns the
+       rendered response."""
+    format = request.accepted_renderer.format
+    if format not in FORMATS or response.status_code != 200:
+        return response
+
+    timeout = get_timeout()
+    if expires is not None:
+        timeout = min(timeout,
+                      int((expires - timezone.now()).total_seconds()))
+    if timeout <= 0:
+        # the boundary has passed or is about to.
+        return response
+
+    # the same steps APIView.finalize_response takes before rendering.
+    response.accepted_renderer = request.accepted_renderer
+    response.accepted_media_type = request.accepted_media_type
+    response.renderer_context = view.get_renderer_context()
+    response.render()
+    get_rate_cache().set(make_key(kind, service_id, format,
+                                  catalogcache.get_catalog(request)),
+                         (response.content, response['Content-Type']),
+                         timeout)
+    return response
+
+
+def purge(service_id):
+    """Drops every cached response for the given service, at the
+       catalog version known to this process."""
+    catalog = catalogcache.get_catalog()
+    get_rate_cache().delete_many([make_key(kind, service_id, format, catalog)
+                                  for kind in KINDS for format in FORMATS])
+
+
+def clear():
+    """Drops every cached response."""
+    get_rate_cache().clear()
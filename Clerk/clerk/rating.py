@@ -0,0 +1,175 @@
+"""Turns usage of services into charges.
+
+A usage row gives the quantity of a service used per hour over a period.
+The period is split wherever the rate of the service changed, and each
+segment is charged at the rate effective during it:
+
+    charge = quantity * hours * rate
+
+Services and their rate timelines are loaded for all rows at once, so
+rating costs the same few queries however many rows are given, and each
+row is split with a binary search of its service's timeline.
+
+rate_stream rates newline delimited JSON in chunks of STREAM_CHUNK_SIZE
+rows, so a run of any size is rated in constant memory."""
+import json
+import math
+
+from rest_framework.utils.encoders import JSONEncoder
+
+from clerk import timeline
+from clerk.dates import parse_date, DATE_ERROR
+from clerk.models import Service
+
+SECONDS_PER_HOUR = 3600.0
+# usage rows rated together by rate_stream, each chunk costs a query to
+# look up its services and one per LOAD_BATCH_SIZE new timelines.
+STREAM_CHUNK_SIZE = 1000
+
+
+class UsageError(ValueError):
+    """Raised for usage that can't be rated, carrying the errors
+       by parameter."""
+
+    def __init__(self, errors):
+        super(UsageError, self).__init__(errors)
+        self.errors = errors
+
+
+def parse_usage(row):
+    """Checks a usage row, returning its region, service_type, quantity,
+       start and end. Raises UsageError if any are missing or invalid.
+       - row = dict, with dates as ISO 8601 or dd/mm/yyyy strings"""
+    if not isinstance(row, dict):
+        raise UsageError({'non_field_errors': [u'Must be an object.']})
+
+    usage = dict()
+    errors = dict()
+    for key in ('region', 'service_type', 'quantity', 'start', 'end'):
+        if key not in row:
+            errors[key] = [u'Is a required parameter.']
+    if 'region' in row:
+        usage['region'] = unicode(row['region'])
+    if 'service_type' in row:
+        usage['service_type'] = unicode(row['service_type'])
+    if 'quantity' in row:
+        try:
+            usage['quantity'] = float(row['quantity'])
+            # nan isn't < 0, and neither nan nor inf can be charged.
+            if (usage['quantity'] < 0 or math.isnan(usage['quantity']) or
+                    math.isinf(usage['quantity'])):
+                raise ValueError
+        except (TypeError, ValueError):
+            errors['quantity'] = [u'Must be a valid number >= zero']
+    for key in ('start', 'end'):
+        if key in row:
+            try:
+                usage[key] = parse_date(row[key])
+            except ValueError:
+                errors[key] = [DATE_ERROR]
+    if ('start' in usage and 'end' in usage and
+            usage['start'] >= usage['end']):
+        errors['end'] = [u'Must be after start.']
+
+    if errors:
+        raise UsageError(errors)
+    return usage
+
+
+def charge(usage, rate_timeline):
+    """Rates a parsed usage row against the timeline of its service.
+       Returns the charge for each segment and in total. Raises
+       UsageError if no rate was effective for part of the period."""
+    segments = []
+    total = 0.0
+    for start, end, rate in rate_timeline.segments(usage['start'],
+                                                   usage['end']):
+        if rate is None:
+            raise UsageError({'start': [u'No rate was effective ' +
+                                        'before ' + end.isoformat()]})
+        hours = (end - start).total_seconds() / SECONDS_PER_HOUR
+        amount = usage['quantity'] * hours * rate.rate
+        segments.append({'start': start, 'end': end, 'rate': rate.rate,
+                         'hours': hours, 'charge': amount})
+        total += amount
+    return {'segments': segments, 'charge': total}
+
+
+def rate_rows(rows):
+    """Rates a list of usage rows, returning a result for each in the
+       same order: the row's parameters along with either its segments
+       and charge, or its errors."""
+    parsed = []
+    for row in rows:
+        try:
+            parsed.append(parse_usage(row))
+        except UsageError as e:
+            parsed.append(e)
+
+    services = Service.objects.get_by_names(
+        (usage['region'], usage['service_type']) for usage in parsed
+        if not isinstance(usage, UsageError))
+    timelines = timeline.get_timelines(services.values())
+
+    results = []
+    for row, usage in zip(rows, parsed):
+        results.append(rate_row(row, usage, services, timelines))
+    return results
+
+
+def rate_row(row, usage, services, timelines):
+    result = dict()
+    if isinstance(row, dict):
+        for key in ('region', 'service_type', 'quantity', 'start', 'end'):
+            result[key] = row.get(key)
+    if isinstance(usage, UsageError):
+        result['errors'] = usage.errors
+        return result
+
+    service = services.get((usage['region'], usage['service_type']))
+    if service is None:
+        result['errors'] = {'service': [u'Not found.']}
+        return result
+    try:
+        result.update(charge(usage, timelines[service.pk]))
+    except UsageError as e:
+        result['errors'] = e.errors
+    return result
+
+
+def parse_line(line):
+    """Decodes a line of newline delimited JSON into a usage row, or a
+       UsageError if it isn't valid JSON."""
+    try:
+        return json.loads(line)
+    except ValueError:
+        return UsageError({'non_field_errors': [u'Must be valid JSON.']})
+
+
+def rate_chunk(rows):
+    # rows that weren't valid JSON are answered without being rated.
+    valid = [row for row in rows if not isinstance(row, UsageError)]
+    results = iter(rate_rows(valid))
+    for row in rows:
+        if isinstance(row, UsageError):
+            yield {'errors': row.errors}
+        else:
+            yield next(results)
+
+
+def rate_stream(lines, chunk_size=STREAM_CHUNK_SIZE):
+    """Rates usage rows read from an iterable of lines of JSON, one row
+       per line, yielding a line of JSON for each in the same order.
+       Blank lines are skipped. Only chunk_size rows are held at once."""
+    encoder = JSONEncoder()
+    chunk = []
+    for line in lines:
+        if not line.strip():
+            continue
+        chunk.append(parse_line(line))
+        if len(chunk) >= chunk_size:
+            for result in rate_chunk(chunk):
+                yield encoder.encode(result) + '\n'
+            chunk = []
+    for result in rate_chunk(chunk):
+        yield encoder.encode(result) + '\n'
@@ -0,0 +1,67 @@
+"""Repricing of many services at once.
+
+Sets a new rate, either a fixed one or a percentage change of the rate
+effective at the time, for every service of a region, of a service type,
+or of any other set of services. The services and the rates they are
+priced from are read with a query each, and the new rates are written in
+one batch by importer.create_rates."""
+import math
+
+from django.utils import timezone
+
+from clerk import importer
+from clerk.models import Rate
+
+# decimal places new rates are rounded to when changed by a percentage.
+PRECISION = 6
+
+
+class RepriceError(ValueError):
+    """Raised for an invalid repricing, carrying the errors by
+       parameter."""
+
+    def __init__(self, errors):
+        super(RepriceError, self).__init__(errors)
+        self.errors = errors
+
+
+def reprice(services, date=None, percent=None, rate=None, user_id=None):
+    """Sets a new rate for each of the services from the given date.
+       Returns the number of services repriced, which excludes any with
+       no rate at the date to change by a percentage.
+       - services = queryset of services
+       - date = datetime object, defaults to now
+       - percent = number, the change to the rate effective at the date,
+         e.g. 5 for 5% more or -5 for 5% less
+       - rate = number >= zero, the new rate, if percent isn't given
+       - user_id = int, the user the changes are logged against,
+         see clerk.audit for the default"""
+    if (percent is None) == (rate is None):
+        raise RepriceError({'non_field_errors':
+                            [u'Give either a percent or a rate.']})
+    if percent is not None and (percent < -100 or math.isnan(percent) or
+                                math.isinf(percent)):
+        raise RepriceError({'percent': [u'Must be a number >= -100']})
+    if rate is not None and (rate < 0 or math.isnan(rate) or
+                             math.isinf(rate)):
+        raise RepriceError({'rate': [u'Must be a valid number >= zero']})
+    now = timezone.now()
+    if date is None:
+        date = now
+
+    queryset = services
+    services = list(queryset.select_related('region', 'service_type'))
+    if percent is None:
+        parsed = [(service, rate, date) for service in services]
+    else:
+        # of rates sharing a date, the latest created takes effect.
+        effective = dict()
+        for service_id, value in Rate.objects.effective_at(date).filter(
+                service__in=queryset.values('pk')).order_by(
+                'date_effective', 'pk').values_list('service_id', 'rate'):
+            effective[service_id] = value
+        factor = 1 + percent / 100.0
+        parsed = [(service, round(effective[service.pk] * factor, PRECISION),
+                   date)
+                  for service in services if service.pk in effective]
+    return importer.create_rates(parsed, user_id, "by repricing", now)
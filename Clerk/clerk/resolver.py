@@ -0,0 +1,100 @@
+"""A process-local cache of region, service type and service ids by name.
+
+Names change rarely, so every rate request can skip looking them up in
+the database. Unknown names are cached too, for a shorter time, so
+misconfigured clients asking for them over and over don't reach the
+database either. The cache is cleared whenever a region or service type
+is renamed or deleted, or a service is saved or deleted, and a name is
+forgotten when a region or service type is created with it (see the
+signal handlers in models.py). Entries expire so writes made by other
+processes are picked up."""
+import time
+
+from django.conf import settings
+
+from clerk import metrics
+
+# seconds a known name is trusted before being looked up again.
+DEFAULT_TIMEOUT = 300
+# seconds an unknown name is trusted before being looked up again.
+DEFAULT_NEGATIVE_TIMEOUT = 30
+# the cache is emptied rather than grown past this many names.
+MAX_ENTRIES = 10000
+
+_ids = dict()
+
+
+def get_timeout():
+    return getattr(settings, 'CLERK_RESOLVER_TIMEOUT', DEFAULT_TIMEOUT)
+
+
+def get_negative_timeout():
+    return getattr(settings, 'CLERK_RESOLVER_NEGATIVE_TIMEOUT',
+                   DEFAULT_NEGATIVE_TIMEOUT)
+
+
+def _first_pk(queryset):
+    pks = list(queryset.values_list('pk', flat=True)[:1])
+    if len(pks) > 0:
+        return pks[0]
+    return None
+
+
+def _lookup(key, queryset):
+    now = time.time()
+    entry = _ids.get(key)
+    if entry is not None and entry[1] > now:
+        metrics.inc('clerk_cache_requests_total', cache='resolver',
+                    result='hit')
+        return entry[0]
+
+    metrics.inc('clerk_cache_requests_total', cache='resolver',
+                result='miss')
+    pk = _first_pk(queryset)
+    if pk is not None:
+        expires = now + get_timeout()
+    else:
+        expires = now + get_negative_timeout()
+    if len(_ids) >= MAX_ENTRIES:
+        _ids.clear()
+    _ids[key] = (pk, expires)
+    return pk
+
+
+def get_region_id(name):
+    """Returns the pk of the region with the given name, or None."""
+    from clerk.models import Region
+    return _lookup(('region', name), Region.objects.filter(name=name))
+
+
+def get_service_type_id(name):
+    """Returns the pk of the service type with the given name, or None."""
+    from clerk.models import Service_Type
+    return _lookup(('service_type', name),
+                   Service_Type.objects.filter(name=name))
+
+
+def get_service_id(region_name, type_name):
+    """Returns the pk of the service of the given type at the given
+       region, or None."""
+    from clerk.models import Service
+    return _lookup(('service', region_name, type_name),
+                   Service.objects.filter(region__name=region_name,
+                                          service_type__name=type_name))
+
+
+def clear():
+    """Forgets every cached name."""
+    _ids.clear()
+
+
+def forget(kind, name):
+    """Forgets the cached id of the region or service type with the
+       given name, known or not, and those of its services.
+       - kind = 'region' or 'service_type'"""
+    # a service key holds the region name then the service type name.
+    index = 1 if kind == 'region' else 2
+    for key in list(_ids):
+        if key == (kind, name) or (key[0] == 'service' and
+                                   key[index] == name):
+            _ids.pop(key, None)
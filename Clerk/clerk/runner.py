@@ -0,0 +1,28 @@
+"""The test runner, which keeps the tests off the caches of any running
+instance, as clerk.ratecache clears and fills a cache that is shared by
+every process."""
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+TEST_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'rates': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'clerk-test-rates',
+    },
+}
+
+
+class TestRunner(DiscoverRunner):
+    """Runs the tests with every cache in memory."""
+
+    def setup_test_environment(self, **kwargs):
+        super(TestRunner, self).setup_test_environment(**kwargs)
+        self.caches = override_settings(CACHES=TEST_CACHES)
+        self.caches.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.caches.disable()
+        super(TestRunner, self).teardown_test_environment(**kwargs)
@@ -54,10 +54,13 @@ class ServiceTypeSerializer(serializers.ModelSerializer):
 class ServiceSerializer(serializers.ModelSerializer):
     region = serializers.Field(source='region.name')
     service_type = serializers.Field(source='service_type.name')
+    current_rate = serializers.Field(source='current_rate.rate')
+    next_rate = serializers.Field(source='next_rate.rate')
 
     class Meta:
         model = Service
-        fields = ('service_type', 'created', 'region')
+        fields = ('service_type', 'created', 'region', 'current_rate',
+                  'next_rate', 'next_change_at')
 
     def validate_name(self, attrs, source):
         if re.match(r'^[A-Za-z0-9_]+$', attrs[source]):
@@ -0,0 +1,146 @@
+"""Generation of large synthetic catalogs, for benchmarks and checking
+query plans against realistic table sizes.
+
+generate_catalog creates regions, service types, a service for every
+pair, and a rate history for each service running from years ago until
+some time in the future, so there are past, current and future rates.
+The values and spacing of the rates are drawn from a random generator
+with a fixed seed, so the same arguments always give the same catalog,
+dated relative to the day it is generated.
+
+Everything is written with bulk_create, a chunk of regions per
+transaction, with effective_until and the current flags worked out in
+memory and the rate pointers set with a single UPDATE per chunk. No
+audit log entries are written for the generated rows."""
+from datetime import timedelta
+import random
+
+from django.db import transaction
+from django.utils import timezone
+
+from clerk import ratecache, resolver, timeline
+from clerk.models import Catalog, Rate, Region, Service, Service_Type
+
+# rows written per insert, capped further by the database backend.
+GENERATE_BATCH_SIZE = 500
+# services generated per transaction, rounded to whole regions.
+GENERATE_CHUNK_SIZE = 500
+DEFAULT_SEED = 0
+
+
+class CatalogExistsError(ValueError):
+    """Raised when the names to be generated are already taken."""
+
+
+def make_history(rng, today, years, future_years, changes_per_year):
+    """Returns a list of (date_effective, rate) tuples for one service,
+       ordered by date, from years before today until future_years after.
+       - rng = random.Random object"""
+    # the mean gap between changes, in hours, drawn from half to one
+    # and a half times it.
+    gap = 365 * 24 / float(changes_per_year)
+    date = today - timedelta(days=365 * years)
+    end = today + timedelta(days=365 * future_years)
+    rate = round(rng.uniform(0.01, 10), 4)
+    history = [(date, rate)]
+    while True:
+        date += timedelta(hours=int(gap * rng.uniform(0.5, 1.5)) + 1)
+        if date > end:
+            return history
+        rate = round(rate * rng.uniform(0.9, 1.15), 4)
+        history.append((date, rate))
+
+
+def generate_catalog(regions=500, service_types=200, years=10,
+                     future_years=1, changes_per_year=4, seed=DEFAULT_SEED,
+                     prefix='gen', chunk_size=GENERATE_CHUNK_SIZE,
+                     progress=None):
+    """Generates a catalog of regions x service_types services with their
+       rate histories. Returns a dict of the number of regions, service
+       types, services and rates created. Raises CatalogExistsError if
+       any of the names are taken.
+       - years, future_years = int, how far the histories run before and
+         after now
+       - changes_per_year = int, the mean number of rates per year
+       - prefix = string, the names are <prefix>_region_<n> and
+         <prefix>_type_<n>
+       - progress = function, optional, called with the counts so far
+         after each chunk"""
+    if regions < 1 or service_types < 1 or changes_per_year < 1:
+        raise ValueError("Regions, service types and changes per year "
+                         "must be at least 1.")
+    if years < 0 or future_years < 0:
+        raise ValueError("Years can't be negative.")
+    region_names = ['%s_region_%04d' % (prefix, i) for i in range(regions)]
+    type_names = ['%s_type_%04d' % (prefix, i) for i in range(service_types)]
+    if (Region.objects.filter(name__startswith=prefix + '_region_').exists()
+            or Service_Type.objects.filter(
+                name__startswith=prefix + '_type_').exists()):
+        raise CatalogExistsError("A catalog with the prefix '%s' has "
+                                 "already been generated." % prefix)
+
+    rng = random.Random(seed)
+    now = timezone.now()
+    # rates are dated from the start of the day, so a catalog generated
+    # twice on one day is the same.
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    counts = {'regions': 0, 'service_types': 0, 'services': 0, 'rates': 0}
+
+    with transaction.atomic():
+        Service_Type.objects.bulk_create([
+            Service_Type(name=name, pretty_name=name.replace('_', ' '),
+                         description="Generated service type.")
+            for name in type_names], batch_size=GENERATE_BATCH_SIZE)
+    types = list(Service_Type.objects.filter(
+        name__in=type_names).order_by('name').values_list('pk', flat=True))
+    counts['service_types'] = len(types)
+
+    per_chunk = max(1, chunk_size // service_types)
+    for start in range(0, regions, per_chunk):
+        names = region_names[start:start + per_chunk]
+        with transaction.atomic():
+            Region.objects.bulk_create([
+                Region(name=name, description="Generated region.")
+                for name in names])
+            region_pks = list(Region.objects.filter(
+                name__in=names).order_by('name').values_list(
+                'pk', flat=True))
+            Service.objects.bulk_create([
+                Service(region_id=region, service_type_id=service_type)
+                for region in region_pks for service_type in types],
+                batch_size=GENERATE_BATCH_SIZE)
+            services = list(Service.objects.filter(
+                region__in=region_pks).order_by(
+                'region__name', 'service_type__name').values_list(
+                'pk', 'region_id', 'service_type_id'))
+
+            rates = []
+            for pk, region, service_type in services:
+                history = make_history(rng, today, years, future_years,
+                                       changes_per_year)
+                for i, (date, rate) in enumerate(history):
+                    until = (history[i + 1][0] if i + 1 < len(history)
+                             else None)
+                    rates.append(Rate(
+                        rate=rate, date_effective=date, created=now,
+                        effective_until=until, service_id=pk,
+                        service_type_id=service_type, region_id=region,
+                        current=date <= now and (until is None or
+                                                 until > now)))
+            Rate.objects.bulk_create(rates, batch_size=GENERATE_BATCH_SIZE)
+
+            pks = [service[0] for service in services]
+            for offset in range(0, len(pks), GENERATE_BATCH_SIZE):
+                Service.objects.update_rate_pointers(
+                    pks[offset:offset + GENERATE_BATCH_SIZE], now)
+        counts['regions'] += len(region_pks)
+        counts['services'] += len(services)
+        counts['rates'] += len(rates)
+        if progress is not None:
+            progress(counts)
+
+    timeline.clear()
+    resolver.clear()
+    ratecache.clear()
+    Catalog.bump()
+    return counts
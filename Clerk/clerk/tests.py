@@ -1,9 +1,21 @@
 import datetime
-from django.test import TestCase
+import json
+import os
+import tempfile
+from django.contrib.admin.models import DELETION, LogEntry
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.utils import timezone
 import time
 
-from clerk.models import Region, Service, Service_Type
+from clerk import (archive, audit, benchmark, compaction, importer,
+                   metrics, rating, repricing, synthetic, timeline)
+from clerk.models import (ArchivedLogEntry, ArchivedRate, Catalog, Region,
+                          Service, Service_Type, Rate)
 
 
 def create_date(days=0, hours=0, minutes=0):
@@ -14,6 +26,16 @@ def create_date(days=0, hours=0, minutes=0):
             )
 
 
+def create_service(start_rate=None):
+    serv1 = Service_Type.objects.create(name="things",
+                                        pretty_name="Things",
+                                        description="stuff")
+    loc = Region.objects.create(name="place")
+    if start_rate is not None:
+        return loc.set_new_service(serv1, start_rate=start_rate)
+    return Service.objects.create(service_type=serv1, region=loc)
+
+
 class RegionFunctionTests(TestCase):
 
     def test_set_new_service_1(self):
@@ -62,6 +84,56 @@ class RegionFunctionTests(TestCase):
             loc.set_new_service(name="things", description="stuff",
                                 start_rate=(-5))
 
+    def test_set_new_services(self):
+        """Adding services should cost the same queries however many
+           service types there are, and set up each as set_new_service
+           would."""
+        def add_region(name):
+            loc = Region.objects.create(name=name)
+            rates = dict((service_type, 0.5)
+                         for service_type in Service_Type.objects.all())
+            with CaptureQueriesContext(connection) as context:
+                loc.set_new_services(rates)
+            return len(context.captured_queries)
+
+        for i in range(2):
+            Service_Type.objects.create(name="things%d" % i,
+                                        pretty_name="Things %d" % i,
+                                        description="stuff")
+        count = add_region("place1")
+        for i in range(2, 20):
+            Service_Type.objects.create(name="things%d" % i,
+                                        pretty_name="Things %d" % i,
+                                        description="stuff")
+        self.assertEquals(add_region("place2"), count)
+
+        service = Region.objects.get(name="place2").get_service_by_type_name(
+            "things19")
+        self.assertEquals(service.get_current_rate().rate, 0.5)
+        self.assertEquals(service.current_rate.rate, 0.5)
+        self.assertTrue(service.current_rate.current)
+        self.assertEquals(LogEntry.objects.filter(
+            change_message__startswith="New service created @ place2"
+        ).count(), 20)
+        self.assertEquals(LogEntry.objects.filter(
+            change_message__startswith="New rate created for things19 @ " +
+            "place2").count(), 1)
+
+    def test_set_new_services_fail(self):
+        """Adding a service a region already has should add none."""
+        serv1 = Service_Type.objects.create(name="things",
+                                            pretty_name="Things",
+                                            description="stuff")
+        serv2 = Service_Type.objects.create(name="things2",
+                                            pretty_name="things 2",
+                                            description="stuff")
+        loc = Region.objects.create(name="place")
+        loc.set_new_service(serv1, start_rate=0.5)
+        with self.assertRaises(AttributeError):
+            loc.set_new_services({serv1: 0.5, serv2: 0.5})
+        self.assertEquals(loc.service_set.count(), 1)
+        self.assertEquals(Rate.objects.count(), 1)
+
     def test_get_service_by_type_name(self):
         """Checks that the services being added are the same
            as the ones being returned."""
@@ -217,3 +289,1062 @@ class ServiceFunctionTests(TestCase):
         service = Service.objects.create(service_type=serv1, region=loc)
         service.set_new_rate(new_rate=1.1)
         self.assertEquals(service.get_next_future_rate().rate, 1.1)
+
+
+class RateTimelineTests(TestCase):
+
+    def test_edited_rate(self):
+        """Editing a rate should be reflected by the lookups."""
+        service = create_service()
+        service.set_new_rate(new_rate=0.3, start_date=create_date(-3))
+        rate = service.set_new_rate(new_rate=0.6, start_date=create_date(3))
+        self.assertEquals(service.get_current_rate().rate, 0.3)
+        rate = Rate.objects.get(pk=rate.pk)
+        rate.date_effective = create_date(-1)
+        rate.save()
+        self.assertEquals(service.get_current_rate().rate, 0.6)
+        rate.delete()
+        self.assertEquals(service.get_current_rate().rate, 0.3)
+
+    def test_same_date_effective(self):
+        """The most recently created of two rates with the same
+           date_effective should be used."""
+        service = create_service()
+        date = create_date(-1)
+        service.set_new_rate(new_rate=0.3, start_date=date)
+        service.set_new_rate(new_rate=0.4, start_date=date)
+        self.assertEquals(service.get_current_rate().rate, 0.4)
+
+
+class RateTimelineCommitTests(TransactionTestCase):
+    # rates are only patched in once committed, so these can't run in
+    # the transaction of a TestCase.
+
+    def setUp(self):
+        timeline.clear()
+        self.service = create_service()
+
+    def test_lookups_without_queries(self):
+        """Once loaded, rate lookups should not touch the database,
+           and newly set rates should be patched in."""
+        service = self.service
+        date = create_date(3)
+        service.set_new_rate(new_rate=0.3, start_date=create_date(-3))
+        service.get_current_rate()
+        service.set_new_rate(new_rate=0.5, start_date=create_date(-1))
+        service.set_new_rate(new_rate=0.6, start_date=date)
+        with self.assertNumQueries(0):
+            self.assertEquals(service.get_current_rate().rate, 0.5)
+            self.assertEquals(service.get_next_future_rate().rate, 0.6)
+            near_rate = service.get_rate_nearest_to(date=create_date(-2))
+            self.assertEquals(near_rate.rate, 0.3)
+        self.assertEquals(service.get_current_rate().effective_until, date)
+
+    def test_rollback(self):
+        """A rate rolled back should never be seen."""
+        service = self.service
+        service.set_new_rate(new_rate=0.3, start_date=create_date(-3))
+        self.assertEquals(service.get_current_rate().rate, 0.3)
+        try:
+            with transaction.atomic():
+                service.set_new_rate(new_rate=0.5,
+                                     start_date=create_date(-1))
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEquals(service.get_current_rate().rate, 0.3)
+        self.assertEquals(service.get_current_rate().effective_until, None)
+
+    @override_settings(CLERK_TIMELINE_MAX_ENTRIES=2)
+    def test_max_entries(self):
+        """The least recently used timeline should be dropped once more
+           than CLERK_TIMELINE_MAX_ENTRIES are loaded."""
+        services = [self.service]
+        for name in ("place2", "place3"):
+            services.append(Service.objects.create(
+                service_type=self.service.service_type,
+                region=Region.objects.create(name=name)))
+        for service in services:
+            service.set_new_rate(new_rate=0.3)
+            service.get_current_rate()
+        services[1].get_current_rate()
+        with self.assertNumQueries(0):
+            services[1].get_current_rate()
+            services[2].get_current_rate()
+        with self.assertNumQueries(1):
+            services[0].get_current_rate()
+
+
+class RateEffectiveAtTests(TestCase):
+
+    def test_effective_at(self):
+        """Should return the rate effective at the given date for
+           every service at every region, in one query."""
+        serv1 = Service_Type.objects.create(name="things",
+                                            pretty_name="Things",
+                                            description="stuff")
+        serv2 = Service_Type.objects.create(name="things2",
+                                            pretty_name="things 2",
+                                            description="stuff")
+        for name in ("place", "place2"):
+            loc = Region.objects.create(name=name)
+            loc.set_new_service(serv1, start_rate=0.5)
+            service = loc.set_new_service(serv2, start_rate=0.1)
+            service.set_new_rate(new_rate=0.2, start_date=create_date(-2))
+            service.set_new_rate(new_rate=0.3, start_date=create_date(2))
+
+        with self.assertNumQueries(1):
+            rates = list(Rate.objects.effective_at(create_date(-1)))
+        self.assertEquals(sorted(rate.rate for rate in rates),
+                          [0.2, 0.2])
+        rates = Rate.objects.effective_at(create_date(3))
+        self.assertEquals(sorted(rate.rate for rate in rates),
+                          [0.3, 0.3, 0.5, 0.5])
+
+
+class RateIntervalTests(TestCase):
+
+    def assertIntervals(self, service, expected):
+        rates = service.rate_set.order_by('date_effective', 'id')
+        self.assertEquals([(rate.date_effective, rate.effective_until)
+                           for rate in rates], expected)
+
+    def test_set_new_rate_intervals(self):
+        """Rates set in any order should last until the next one starts."""
+        service = create_service()
+        dates = [create_date(-5), create_date(-1), create_date(2),
+                 create_date(4)]
+        service.set_new_rate(new_rate=0.1, start_date=dates[1])
+        service.set_new_rate(new_rate=0.2, start_date=dates[3])
+        # back-dated:
+        service.set_new_rate(new_rate=0.3, start_date=dates[0])
+        # in between two others:
+        service.set_new_rate(new_rate=0.4, start_date=dates[2])
+        self.assertIntervals(service, [(dates[0], dates[1]),
+                                       (dates[1], dates[2]),
+                                       (dates[2], dates[3]),
+                                       (dates[3], None)])
+        rates = Rate.objects.effective_at(create_date(1))
+        self.assertEquals([rate.rate for rate in rates], [0.1])
+        rates = Rate.objects.overlapping(create_date(-2), create_date(3))
+        self.assertEquals(sorted(rate.rate for rate in rates),
+                          [0.1, 0.3, 0.4])
+
+    def test_edited_and_deleted_rate_intervals(self):
+        """Editing or deleting a rate should keep the intervals whole."""
+        service = create_service()
+        dates = [create_date(-5), create_date(-1), create_date(2)]
+        for date in dates:
+            rate = service.set_new_rate(new_rate=0.1, start_date=date)
+        rate.date_effective = create_date(-3)
+        rate.save()
+        self.assertIntervals(service, [(dates[0], rate.date_effective),
+                                       (rate.date_effective, dates[1]),
+                                       (dates[1], None)])
+        rate.delete()
+        self.assertIntervals(service, [(dates[0], dates[1]),
+                                       (dates[1], None)])
+
+
+class RateCurrentFlagTests(TestCase):
+
+    def test_set_new_rate_current(self):
+        """Only the rate effective now should be flagged as current,
+           whatever order rates are set in."""
+        service = create_service()
+        service.set_new_rate(new_rate=0.1, start_date=create_date(-1))
+        service.set_new_rate(new_rate=0.2, start_date=create_date(2))
+        service.set_new_rate(new_rate=0.3, start_date=create_date(-3))
+        rates = service.rate_set.filter(current=True)
+        self.assertEquals([rate.rate for rate in rates], [0.1])
+        service.set_new_rate(new_rate=0.4)
+        rates = service.rate_set.filter(current=True)
+        self.assertEquals([rate.rate for rate in rates], [0.4])
+
+    def test_update_current(self):
+        """Future rates should become current once their date passes."""
+        service = create_service()
+        service.set_new_rate(new_rate=0.1, start_date=create_date(-1))
+        service.set_new_rate(new_rate=0.2, start_date=create_date(2))
+        self.assertEquals(Rate.objects.update_current(), 0)
+        self.assertEquals(Rate.objects.update_current(create_date(3)), 2)
+        rates = Rate.objects.filter(current=True)
+        self.assertEquals([rate.rate for rate in rates], [0.2])
+
+    def test_update_current_without_subqueries(self):
+        """The updates shouldn't select from the rate table they update,
+           which MySQL refuses."""
+        service = create_service()
+        service.set_new_rate(new_rate=0.1, start_date=create_date(-1))
+        service.set_new_rate(new_rate=0.2, start_date=create_date(2))
+        with CaptureQueriesContext(connection) as context:
+            Rate.objects.update_current(create_date(3),
+                                        service_ids=[service.pk])
+        updates = [query['sql'] for query in context.captured_queries
+                   if 'UPDATE' in query['sql']]
+        self.assertEquals(len(updates), 2)
+        for sql in updates:
+            self.assertFalse('SELECT' in sql, sql)
+
+
+class ServiceRatePointerTests(TestCase):
+
+    def test_set_new_rate_pointers(self):
+        """The current and next rates should follow new rates."""
+        service = create_service()
+        service.set_new_rate(new_rate=0.1, start_date=create_date(-1))
+        service.set_new_rate(new_rate=0.3, start_date=create_date(4))
+        date = create_date(2)
+        service.set_new_rate(new_rate=0.2, start_date=date)
+        service = Service.objects.select_related(
+            'current_rate', 'next_rate').get(pk=service.pk)
+        with self.assertNumQueries(0):
+            self.assertEquals(service.current_rate.rate, 0.1)
+            self.assertEquals(service.next_rate.rate, 0.2)
+            self.assertEquals(service.next_change_at, date)
+
+    def test_update_rate_pointers(self):
+        """The pointers should move on once the next rate takes over,
+           and follow rates being deleted."""
+        service = create_service()
+        service.set_new_rate(new_rate=0.1, start_date=create_date(-1))
+        rate = service.set_new_rate(new_rate=0.2, start_date=create_date(2))
+        service.update_rate_pointers(create_date(3))
+        service = Service.objects.get(pk=service.pk)
+        self.assertEquals(service.current_rate.rate, 0.2)
+        self.assertEquals(service.next_rate, None)
+        self.assertEquals(service.next_change_at, None)
+        rate.delete()
+        service = Service.objects.get(pk=service.pk)
+        self.assertEquals(service.current_rate.rate, 0.1)
+
+    def test_update_due_rate_pointers(self):
+        """Only the services whose next rate has taken effect should be
+           updated, with a single query."""
+        service = create_service()
+        service.set_new_rate(new_rate=0.1, start_date=create_date(-1))
+        service.set_new_rate(new_rate=0.2, start_date=create_date(2))
+        other = Service.objects.create(service_type=service.service_type,
+                                       region=Region.objects.create(
+                                           name="other"))
+        other.set_new_rate(new_rate=0.5, start_date=create_date(-1))
+        date = create_date(5)
+        other.set_new_rate(new_rate=0.6, start_date=date)
+        with self.assertNumQueries(1):
+            count = Service.objects.update_due_rate_pointers(create_date(3))
+        self.assertEquals(count, 1)
+        service = Service.objects.get(pk=service.pk)
+        self.assertEquals(service.current_rate.rate, 0.2)
+        self.assertEquals(service.next_change_at, None)
+        other = Service.objects.get(pk=other.pk)
+        self.assertEquals(other.current_rate.rate, 0.5)
+        self.assertEquals(other.next_change_at, date)
+
+    def test_delete_service(self):
+        """Services with rates should still be deletable."""
+        service = create_service()
+        service.set_new_rate(new_rate=0.1, start_date=create_date(-1))
+        service.set_new_rate(new_rate=0.2, start_date=create_date(2))
+        service.delete()
+        self.assertEquals(Rate.objects.count(), 0)
+
+
+class AdminChangelistTests(TestCase):
+
+    def setUp(self):
+        User.objects.create_superuser(username='lauren', password='secret',
+                                      email='')
+        self.client.login(username='lauren', password='secret')
+        self.serv1 = Service_Type.objects.create(name="things",
+                                                 pretty_name="Things",
+                                                 description="stuff")
+
+    def create_services(self, start, end):
+        for i in range(start, end):
+            loc = Region.objects.create(name="place" + str(i))
+            service = loc.set_new_service(self.serv1, start_rate=0.5)
+            service.set_new_rate(new_rate=0.6, start_date=create_date(2))
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEquals(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_changelist_queries(self):
+        """The number of queries for a changelist page should not grow
+           with the number of rows, however it is sorted or filtered."""
+        urls = ['/admin/clerk/service/', '/admin/clerk/service/?o=3',
+                '/admin/clerk/service/?has_next_rate=True',
+                '/admin/clerk/rate/', '/admin/clerk/rate/?current=True',
+                '/admin/clerk/rate/?o=4']
+        self.create_services(0, 2)
+        counts = [self.count_queries(url) for url in urls]
+        self.create_services(2, 40)
+        self.assertEquals([self.count_queries(url) for url in urls], counts)
+
+
+class RatingTests(TestCase):
+
+    def test_rate_rows(self):
+        """Usage should be charged at each rate effective during it."""
+        service = create_service(start_rate=0.5)
+        start = create_date()
+        service.set_new_rate(1.0, start + datetime.timedelta(hours=2))
+        service.set_new_rate(2.0, start + datetime.timedelta(hours=3))
+        end = start + datetime.timedelta(hours=4)
+        rows = [{'region': 'place', 'service_type': 'things',
+                 'quantity': 2, 'start': start.isoformat(),
+                 'end': end.isoformat()}]
+        result = rating.rate_rows(rows)[0]
+        self.assertEquals([segment['rate']
+                           for segment in result['segments']],
+                          [0.5, 1.0, 2.0])
+        self.assertEquals([segment['hours']
+                           for segment in result['segments']],
+                          [2, 1, 1])
+        self.assertAlmostEquals(result['charge'],
+                                2 * (2 * 0.5 + 1 * 1.0 + 1 * 2.0))
+
+    def test_rate_rows_fail(self):
+        """Usage that can't be rated should be reported per row."""
+        service = create_service(start_rate=0.5)
+        start = service.get_current_rate().date_effective
+        rows = [{'region': 'place', 'service_type': 'things',
+                 'quantity': 1, 'start': start.isoformat(),
+                 'end': start.isoformat()},
+                {'region': 'place', 'service_type': 'things',
+                 'quantity': -1, 'start': 'yesterday',
+                 'end': create_date(1).isoformat()},
+                {'region': 'place', 'service_type': 'things',
+                 'quantity': 1, 'start': create_date(-1).isoformat(),
+                 'end': create_date(1).isoformat()},
+                {'region': 'place2', 'service_type': 'things',
+                 'quantity': 1, 'start': start.isoformat(),
+                 'end': create_date(1).isoformat()}]
+        rows += [{'region': 'place', 'service_type': 'things',
+                  'quantity': quantity, 'start': start.isoformat(),
+                  'end': create_date(1).isoformat()}
+                 for quantity in ('nan', 'inf', float('nan'))]
+        results = rating.rate_rows(rows)
+        self.assertEquals(results[0]['errors'].keys(), ['end'])
+        self.assertEquals(sorted(results[1]['errors'].keys()),
+                          ['quantity', 'start'])
+        self.assertEquals(results[2]['errors'].keys(), ['start'])
+        self.assertEquals(results[3]['errors'].keys(), ['service'])
+        for result in results[4:]:
+            self.assertEquals(result['errors'].keys(), ['quantity'])
+
+    def test_rate_stream(self):
+        """Streamed usage should be answered line by line, in order,
+           whatever the chunk size."""
+        create_service(start_rate=0.5)
+        start = create_date()
+        row = json.dumps({'region': 'place', 'service_type': 'things',
+                          'quantity': 1, 'start': start.isoformat(),
+                          'end': create_date(hours=2).isoformat()})
+        lines = [row + '\n', '\n', '{"region": \n', row + '\n', row]
+        results = [json.loads(line)
+                   for line in rating.rate_stream(lines, chunk_size=2)]
+        self.assertEquals(len(results), 4)
+        self.assertAlmostEquals(results[0]['charge'], 1.0, places=3)
+        self.assertEquals(results[1]['errors'].keys(), ['non_field_errors'])
+        self.assertEquals(results[0], results[2])
+        self.assertEquals(results[0], results[3])
+
+
+class RateImportTests(TestCase):
+
+    def test_import_rates(self):
+        """Imported rates should be in step as if each had been set
+           with set_new_rate."""
+        service = create_service()
+        dates = [create_date(-5), create_date(-1), create_date(2),
+                 create_date(4)]
+        service.set_new_rate(new_rate=0.1, start_date=dates[1])
+        service.set_new_rate(new_rate=0.2, start_date=dates[3])
+        self.assertEquals(timeline.get_timeline(service.pk).rate_at(
+            create_date()).rate, 0.1)
+        count = importer.import_rates([
+            {'region': 'place', 'service_type': 'things', 'rate': '0.3',
+             'date': dates[0].isoformat()},
+            {'region': 'place', 'service_type': 'things', 'rate': 0.4,
+             'date': dates[2].isoformat()},
+            {'region': 'place', 'service_type': 'things', 'rate': 0.5}])
+        self.assertEquals(count, 3)
+
+        rates = list(service.rate_set.order_by('date_effective', 'id'))
+        self.assertEquals([rate.rate for rate in rates],
+                          [0.3, 0.1, 0.5, 0.4, 0.2])
+        intervals = [(rate.date_effective, rate.effective_until)
+                     for rate in rates]
+        service.update_rate_intervals()
+        rates = service.rate_set.order_by('date_effective', 'id')
+        self.assertEquals(intervals, [(rate.date_effective,
+                                       rate.effective_until)
+                                      for rate in rates])
+        self.assertEquals([rate.rate for rate in rates if rate.current],
+                          [0.5])
+
+        service = Service.objects.get(pk=service.pk)
+        self.assertEquals(service.current_rate.rate, 0.5)
+        self.assertEquals(service.next_rate.rate, 0.4)
+        self.assertEquals(service.get_current_rate().rate, 0.5)
+        self.assertEquals(LogEntry.objects.filter(
+            change_message__endswith="by import.").count(), 3)
+
+    def test_import_rates_queries(self):
+        """Importing should cost the same queries however many services
+           the rates are for."""
+        def import_rates(start, end):
+            for i in range(start, end):
+                loc = Region.objects.create(name="place%d" % i)
+                service = Service.objects.create(service_type=serv1,
+                                                 region=loc)
+                service.set_new_rate(new_rate=0.1, start_date=dates[0])
+                service.set_new_rate(new_rate=0.2, start_date=dates[2])
+            rows = [{'region': "place%d" % i, 'service_type': 'things',
+                     'rate': 0.3, 'date': dates[1].isoformat()}
+                    for i in range(start, end)]
+            with CaptureQueriesContext(connection) as context:
+                importer.import_rates(rows)
+            return len(context.captured_queries)
+
+        serv1 = Service_Type.objects.create(name="things",
+                                            pretty_name="Things",
+                                            description="stuff")
+        dates = [create_date(-1), create_date(2), create_date(4)]
+        count = import_rates(0, 2)
+        self.assertEquals(import_rates(2, 30), count)
+        service = Region.objects.get(name="place29").service_set.get()
+        self.assertEquals([(rate.rate, rate.effective_until) for rate in
+                           service.rate_set.order_by('date_effective')],
+                          [(0.1, dates[1]), (0.3, dates[2]), (0.2, None)])
+        self.assertEquals(service.next_rate.rate, 0.3)
+
+    def test_import_rates_fail(self):
+        """A batch with any invalid row should import nothing."""
+        create_service()
+        rows = [{'region': 'place', 'service_type': 'things', 'rate': 1},
+                {'region': 'place', 'service_type': 'things', 'rate': -1},
+                {'region': 'place', 'service_type': 'nothing', 'rate': 1,
+                 'date': 'soon'},
+                'rate']
+        with self.assertRaises(importer.RateImportError) as context:
+            importer.import_rates(rows)
+        self.assertEquals([sorted(error.keys())
+                           for error in context.exception.errors],
+                          [['rate', 'row'], ['date', 'row', 'service'],
+                           ['non_field_errors', 'row']])
+        self.assertEquals(Rate.objects.count(), 0)
+
+    def test_import_rates_not_finite(self):
+        """Rates that aren't finite numbers should be row errors."""
+        create_service()
+        rows = [{'region': 'place', 'service_type': 'things', 'rate': rate}
+                for rate in ('nan', 'inf', '-inf', float('nan'))]
+        with self.assertRaises(importer.RateImportError) as context:
+            importer.import_rates(rows)
+        self.assertEquals([(error['row'], sorted(error.keys())) for error in
+                           context.exception.errors],
+                          [(i, ['rate', 'row']) for i in range(4)])
+        self.assertEquals(Rate.objects.count(), 0)
+
+    def test_import_rates_command(self):
+        """The command should import rates from a CSV file."""
+        service = create_service()
+        User.objects.create_user('importer', 'importer@example.com', 'pass')
+        path = tempfile.mktemp(suffix='.csv')
+        with open(path, 'w') as stream:
+            stream.write("region,service_type,rate,date\n"
+                         "place,things,0.1,01/01/2014\n"
+                         "place,things,0.2,\n")
+        try:
+            call_command('import_rates', path, user='importer',
+                         stdout=open(os.devnull, 'w'))
+        finally:
+            os.remove(path)
+        self.assertEquals(service.get_current_rate().rate, 0.2)
+        self.assertEquals(LogEntry.objects.filter(
+            user__username='importer').count(), 2)
+        self.assertRaises(CommandError, call_command, 'import_rates',
+                          path, stdout=open(os.devnull, 'w'))
+
+
+class RepricingTests(TestCase):
+
+    def setUp(self):
+        self.things = Service_Type.objects.create(name="things",
+                                                  pretty_name="Things",
+                                                  description="stuff")
+        self.stuff = Service_Type.objects.create(name="stuff",
+                                                 pretty_name="Stuff",
+                                                 description="things")
+        for name in ('place', 'place2'):
+            loc = Region.objects.create(name=name)
+            loc.set_new_service(self.things, start_rate=1.0)
+            loc.set_new_service(self.stuff, start_rate=2.0)
+
+    def rates_at(self, date):
+        return sorted((rate.service.__unicode__(), rate.rate)
+                      for rate in Rate.objects.effective_at(date))
+
+    def test_reprice_percent(self):
+        """Every service of a region should change by the percentage."""
+        date = create_date(1)
+        count = repricing.reprice(Service.objects.filter(
+            region__name='place'), date, percent=5)
+        self.assertEquals(count, 2)
+        self.assertEquals(self.rates_at(create_date(2)),
+                          [('stuff @ place', 2.1), ('stuff @ place2', 2.0),
+                           ('things @ place', 1.05),
+                           ('things @ place2', 1.0)])
+        service = Service.objects.get(region__name='place',
+                                      service_type=self.things)
+        self.assertEquals(service.next_rate.rate, 1.05)
+        self.assertEquals(service.get_current_rate().rate, 1.0)
+
+    def test_reprice_rate(self):
+        """Every service of a service type should get the new rate."""
+        count = repricing.reprice(Service.objects.filter(
+            service_type=self.stuff), rate=3)
+        self.assertEquals(count, 2)
+        self.assertEquals(self.rates_at(create_date(1)),
+                          [('stuff @ place', 3.0), ('stuff @ place2', 3.0),
+                           ('things @ place', 1.0),
+                           ('things @ place2', 1.0)])
+        # back dated before any rate, so nothing to change.
+        self.assertEquals(repricing.reprice(
+            Service.objects.all(), create_date(-1), percent=10), 0)
+
+    def test_reprice_queries(self):
+        """Repricing should cost the same queries however many services
+           there are, with rates after the date to cut short."""
+        def reprice():
+            for loc in Region.objects.all():
+                for service in loc.service_set.all():
+                    service.set_new_rate(new_rate=4.0,
+                                         start_date=create_date(3))
+            with CaptureQueriesContext(connection) as context:
+                repricing.reprice(Service.objects.filter(
+                    service_type=self.things), create_date(1), percent=5)
+            return len(context.captured_queries)
+
+        count = reprice()
+        for i in range(3, 30):
+            Region.objects.create(name="place%d" % i).set_new_service(
+                self.things, start_rate=1.0)
+        self.assertEquals(reprice(), count)
+        service = Service.objects.get(region__name='place29')
+        self.assertEquals([rate.rate for rate in service.rate_set.filter(
+            effective_until__isnull=False).order_by('date_effective')],
+            [1.0, 1.05])
+        self.assertEquals(service.next_rate.rate, 1.05)
+
+    def test_reprice_fail(self):
+        """Should need exactly one of percent or rate."""
+        for kwargs in [{}, {'percent': 5, 'rate': 1}, {'percent': -101},
+                       {'rate': -1}, {'percent': float('inf')},
+                       {'rate': float('nan')}]:
+            self.assertRaises(repricing.RepriceError, repricing.reprice,
+                              Service.objects.all(), **kwargs)
+        self.assertEquals(Rate.objects.count(), 4)
+
+    def test_reprice_admin_action(self):
+        """The admin action should ask for the change, then make it."""
+        User.objects.create_superuser(username='lauren', password='secret',
+                                      email='')
+        self.client.login(username='lauren', password='secret')
+        selected = Service.objects.filter(service_type=self.things)
+        data = {'action': 'reprice_selected',
+                '_selected_action': [service.pk for service in selected]}
+        response = self.client.post('/admin/clerk/service/', data)
+        self.assertEquals(response.status_code, 200)
+        self.assertTemplateUsed(response, 'admin/clerk/action_form.html')
+
+        date = create_date(1)
+        data.update({'apply': 'yes', 'percent': 'nan',
+                     'date_0': date.strftime('%Y-%m-%d'),
+                     'date_1': date.strftime('%H:%M:%S')})
+        response = self.client.post('/admin/clerk/service/', data)
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue(response.context['form'].errors['percent'])
+
+        data['percent'] = '-50'
+        response = self.client.post('/admin/clerk/service/', data)
+        self.assertEquals(response.status_code, 302)
+        self.assertEquals(self.rates_at(create_date(2)),
+                          [('stuff @ place', 2.0), ('stuff @ place2', 2.0),
+                           ('things @ place', 0.5),
+                           ('things @ place2', 0.5)])
+        self.assertEquals(LogEntry.objects.filter(
+            user__username='lauren',
+            change_message__endswith="by repricing.").count(), 2)
+
+
+class RegionCloneTests(TestCase):
+
+    def setUp(self):
+        self.source = Region.objects.create(name="place",
+                                            description="somewhere")
+
+    def add_services(self, start, end):
+        for i in range(start, end):
+            service_type = Service_Type.objects.create(
+                name="things%d" % i, pretty_name="Things %d" % i,
+                description="stuff")
+            service = self.source.set_new_service(service_type, 1.0)
+            service.set_new_rate(2.0, create_date(2))
+            service.set_new_rate(3.0, create_date(4))
+
+    def test_clone(self):
+        """The copy should be priced now and from then on as the
+           source is."""
+        self.add_services(0, 2)
+        Service.objects.get(service_type__name="things1").set_new_rate(0.5)
+        region = self.source.clone("place2")
+        self.assertEquals(region.description, "somewhere")
+        for date, expected in [(create_date(1), [0.5, 1.0]),
+                               (create_date(3), [2.0, 2.0]),
+                               (create_date(5), [3.0, 3.0])]:
+            self.assertEquals(sorted(
+                rate.rate for rate in Rate.objects.effective_at(date).filter(
+                    region=region)), expected)
+        # the superseded rate isn't copied.
+        self.assertEquals(region.rate_set.count(), 6)
+        service = Service.objects.get(region=region,
+                                      service_type__name="things1")
+        self.assertEquals(service.current_rate.rate, 0.5)
+        self.assertTrue(service.current_rate.current)
+        self.assertEquals(service.next_rate.rate, 2.0)
+        self.assertEquals(service.get_current_rate().rate, 0.5)
+        self.assertEquals(self.source.rate_set.count(), 7)
+        self.assertEquals(LogEntry.objects.filter(
+            change_message__endswith="by cloning place.").count(), 8)
+
+    def test_clone_queries(self):
+        """Cloning should cost the same queries however many services
+           there are."""
+        def clone(name):
+            with CaptureQueriesContext(connection) as context:
+                self.source.clone(name)
+            return len(context.captured_queries)
+
+        self.add_services(0, 2)
+        count = clone("place2")
+        self.add_services(2, 20)
+        self.assertEquals(clone("place3"), count)
+        self.assertEquals(Rate.objects.filter(
+            region__name="place3").count(), 60)
+
+    def test_clone_admin_action(self):
+        """The admin action should ask for the name, then clone."""
+        self.add_services(0, 1)
+        User.objects.create_superuser(username='lauren', password='secret',
+                                      email='')
+        self.client.login(username='lauren', password='secret')
+        data = {'action': 'clone_selected',
+                '_selected_action': [self.source.pk]}
+        response = self.client.post('/admin/clerk/region/', data)
+        self.assertEquals(response.status_code, 200)
+        self.assertTemplateUsed(response, 'admin/clerk/action_form.html')
+        data.update({'apply': 'yes', 'name': 'place'})
+        response = self.client.post('/admin/clerk/region/', data)
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue(response.context['form'].errors['name'])
+        data.update({'name': 'place2', 'description': 'elsewhere'})
+        response = self.client.post('/admin/clerk/region/', data)
+        self.assertEquals(response.status_code, 302)
+        region = Region.objects.get(name='place2')
+        self.assertEquals(region.description, 'elsewhere')
+        self.assertEquals(region.service_set.count(), 1)
+
+
+@override_settings(CLERK_AUDIT_MODE='sync')
+class AuditTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_superuser(username='lauren',
+                                                  password='secret',
+                                                  email='')
+        serv1 = Service_Type.objects.create(name="things",
+                                            pretty_name="Things",
+                                            description="stuff")
+        self.service = Region.objects.create(name="place").set_new_service(
+            serv1, start_rate=0.5, user_id=self.user.pk)
+
+    def test_acting_user(self):
+        """Changes should be logged against the user making them."""
+        rate = self.service.set_new_rate(0.6, user_id=self.user.pk)
+        self.assertEquals(LogEntry.objects.get(
+            object_id=rate.pk).user, self.user)
+        self.assertEquals(LogEntry.objects.filter(
+            user=self.user).count(), 3)
+
+    def test_acting_user_of_request(self):
+        """Changes made in a request should be logged against its user."""
+        self.client.login(username='lauren', password='secret')
+        date = create_date(1)
+        response = self.client.post('/admin/clerk/service/%d/' %
+                                    self.service.pk,
+                                    {'new_rate': '0.7',
+                                     'date_0': date.strftime('%Y-%m-%d'),
+                                     'date_1': date.strftime('%H:%M:%S')})
+        self.assertEquals(response.status_code, 302)
+        entry = LogEntry.objects.get(
+            change_message="New rate created for things @ place, " +
+            "automatically.", object_repr="0.7")
+        self.assertEquals(entry.user, self.user)
+
+    def test_file(self):
+        """Entries should be appended to the audit file as JSON lines."""
+        path = tempfile.mktemp(suffix='.jsonl')
+        try:
+            with self.settings(CLERK_AUDIT_FILE=path,
+                               CLERK_AUDIT_DATABASE=False):
+                count = LogEntry.objects.count()
+                rate = self.service.set_new_rate(0.6, user_id=self.user.pk)
+                rate = self.service.set_new_rate(0.7, user_id=self.user.pk)
+                self.assertEquals(LogEntry.objects.count(), count)
+            with open(path) as stream:
+                entries = [json.loads(line) for line in stream]
+        finally:
+            os.remove(path)
+        self.assertEquals(len(entries), 2)
+        self.assertEquals(entries[1]['object_id'], rate.pk)
+        self.assertEquals(entries[1]['user_id'], self.user.pk)
+
+
+@override_settings(CLERK_AUDIT_MODE='async', CLERK_AUDIT_FLUSH_INTERVAL=60)
+class AuditAsyncTests(TransactionTestCase):
+    # changes made in a transaction are logged in it, so these can't run
+    # in the transaction of a TestCase.
+
+    def setUp(self):
+        self.service = create_service()
+
+    def test_async(self):
+        """Entries should be queued until flushed."""
+        count = LogEntry.objects.count()
+        self.service.set_new_rate(0.6)
+        self.assertEquals(LogEntry.objects.count(), count)
+        audit.flush()
+        self.assertEquals(LogEntry.objects.count(), count + 1)
+
+    def test_async_rollback(self):
+        """Entries of changes rolled back should never be written."""
+        count = LogEntry.objects.count()
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                self.service.set_new_rate(0.6)
+                raise ValueError
+        audit.flush()
+        self.assertEquals(LogEntry.objects.count(), count)
+        self.assertEquals(Rate.objects.count(), 0)
+
+
+class ArchiveTests(TestCase):
+
+    def setUp(self):
+        self.service = create_service()
+        for rate, days in [(0.1, -400), (0.2, -390), (0.3, -380),
+                           (0.4, -10), (0.5, 5)]:
+            self.service.set_new_rate(rate, create_date(days))
+
+    def test_archive_rates(self):
+        """Rates superseded before the cutoff should be archived a chunk
+           at a time, and still be found by date."""
+        count = archive.archive_rates(create_date(-375), chunk_size=2)
+        self.assertEquals(count, 2)
+        self.assertEquals(sorted(ArchivedRate.objects.values_list(
+            'rate', flat=True)), [0.1, 0.2])
+        self.assertEquals(sorted(self.service.rate_set.values_list(
+            'rate', flat=True)), [0.3, 0.4, 0.5])
+        self.assertEquals(Catalog.get_current().archived_until.date(),
+                          create_date(-375).date())
+
+        for days, rate in [(-395, 0.1), (-385, 0.2), (-375, 0.3),
+                           (-1, 0.4), (6, 0.5)]:
+            self.assertEquals(self.service.get_rate_nearest_to(
+                create_date(days)).rate, rate)
+        self.assertEquals(self.service.get_rate_nearest_to(
+            create_date(-500)), None)
+        self.assertEquals(self.service.get_current_rate().rate, 0.4)
+
+    def test_archive_log(self):
+        """Old log entries should be archived, or pruned."""
+        count = LogEntry.objects.count()
+        LogEntry.objects.filter(pk__in=list(LogEntry.objects.values_list(
+            'pk', flat=True)[:3])).update(action_time=create_date(-400))
+        self.assertEquals(archive.archive_log(create_date(-365),
+                                              chunk_size=2), 3)
+        self.assertEquals(ArchivedLogEntry.objects.count(), 3)
+        self.assertEquals(LogEntry.objects.count(), count - 3)
+        LogEntry.objects.update(action_time=create_date(-400))
+        self.assertEquals(archive.archive_log(create_date(-365),
+                                              prune=True), count - 3)
+        self.assertEquals(ArchivedLogEntry.objects.count(), 3)
+        self.assertEquals(LogEntry.objects.count(), 0)
+
+    def test_archive_command(self):
+        """The command should archive rates and log entries by age."""
+        call_command('archive', rate_days=375, log_days=0,
+                     stdout=open(os.devnull, 'w'))
+        self.assertEquals(ArchivedRate.objects.count(), 2)
+        self.assertEquals(LogEntry.objects.count(), 0)
+
+
+class CompactionTests(TestCase):
+
+    def setUp(self):
+        self.service = create_service()
+        self.start = create_date(-10)
+        for rate, days in [(1.0, 0), (1.0, 2), (2.0, 4), (2.0, 6), (2.0, 8),
+                           (1.0, 12), (1.0, 14), (1.0, 14)]:
+            self.service.set_new_rate(
+                rate, self.start + datetime.timedelta(days=days))
+
+    def get_rates_at(self):
+        return [self.service.get_rate_nearest_to(
+            self.start + datetime.timedelta(days=days, hours=12)).rate
+            for days in range(16)]
+
+    def test_compact_rates(self):
+        """Repeated rates should be removed without changing the rate
+           effective at any date."""
+        before = self.get_rates_at()
+        self.assertEquals(compaction.compact_rates(), 5)
+        self.assertEquals(self.get_rates_at(), before)
+
+        rates = list(self.service.rate_set.order_by('date_effective'))
+        self.assertEquals([rate.rate for rate in rates], [1.0, 2.0, 1.0])
+        self.assertEquals([rate.effective_until for rate in rates],
+                          [rates[1].date_effective, rates[2].date_effective,
+                           None])
+        self.assertEquals([rate.current for rate in rates],
+                          [False, True, False])
+        service = Service.objects.get(pk=self.service.pk)
+        self.assertEquals(service.current_rate, rates[1])
+        self.assertEquals(service.next_rate, rates[2])
+        self.assertEquals(LogEntry.objects.filter(
+            action_flag=DELETION).count(), 5)
+
+        self.assertEquals(compaction.compact_rates(), 0)
+
+    def test_compact_rates_queries(self):
+        """Compacting a chunk should cost the same queries however many
+           services or repeated rates it has."""
+        def compact(names):
+            for name in names:
+                service = Service.objects.create(
+                    service_type=self.service.service_type,
+                    region=Region.objects.create(name=name))
+                for days in range(len(names)):
+                    service.set_new_rate(
+                        1.0, self.start + datetime.timedelta(days=days))
+            with CaptureQueriesContext(connection) as context:
+                compaction.compact_rates(Service.objects.filter(
+                    region__name__in=names))
+            return len(context.captured_queries)
+
+        count = compact(["a0", "a1"])
+        self.assertEquals(compact(["b%d" % i for i in range(10)]), count)
+        service = Region.objects.get(name="b9").service_set.get()
+        self.assertEquals([(rate.effective_until, rate.current)
+                           for rate in service.rate_set.all()],
+                          [(None, True)])
+
+    def test_set_new_rate_dedupe(self):
+        """With dedupe, a rate equal to the one in effect at its date
+           should not be written."""
+        count = self.service.rate_set.count()
+        current = self.service.get_current_rate()
+        self.assertEquals(self.service.set_new_rate(2.0, dedupe=True),
+                          current)
+        self.assertEquals(self.service.rate_set.count(), count)
+        # it would change the rate from its date until the next one.
+        self.service.set_new_rate(1.0, dedupe=True)
+        self.service.set_new_rate(2.0, self.start, dedupe=True)
+        self.assertEquals(self.service.rate_set.count(), count + 2)
+        with self.settings(CLERK_RATE_DEDUPE=True):
+            self.service.set_new_rate(2.0, self.start)
+        self.assertEquals(self.service.rate_set.count(), count + 2)
+        self.service.set_new_rate(2.0, self.start)
+        self.assertEquals(self.service.rate_set.count(), count + 3)
+
+    def test_compact_rates_command(self):
+        """The command should only compact the services asked for."""
+        call_command('compact_rates', region='elsewhere',
+                     stdout=open(os.devnull, 'w'))
+        self.assertEquals(self.service.rate_set.count(), 8)
+        call_command('compact_rates', region='place', chunk_size=1,
+                     stdout=open(os.devnull, 'w'))
+        self.assertEquals(self.service.rate_set.count(), 3)
+
+
+class SyntheticCatalogTests(TestCase):
+
+    def test_generate_catalog(self):
+        """The same seed should generate the same catalog, with current
+           and future rates for every service."""
+        counts = synthetic.generate_catalog(
+            regions=3, service_types=2, years=2, prefix='a', chunk_size=4)
+        self.assertEquals(counts['regions'], 3)
+        self.assertEquals(counts['service_types'], 2)
+        self.assertEquals(counts['services'], 6)
+        self.assertEquals(Rate.objects.count(), counts['rates'])
+        synthetic.generate_catalog(regions=3, service_types=2, years=2,
+                                   prefix='b')
+
+        def get_rates(prefix):
+            return list(Rate.objects.filter(
+                region__name__startswith=prefix).order_by(
+                'region__name', 'service_type__name',
+                'date_effective').values_list('rate', 'date_effective'))
+        self.assertEquals(get_rates('a_'), get_rates('b_'))
+
+        now = timezone.now()
+        for service in Service.objects.all():
+            self.assertEquals(service.current_rate,
+                              service.get_current_rate())
+            self.assertEquals(service.next_rate.date_effective,
+                              service.next_change_at)
+            self.assertTrue(service.next_change_at > now)
+            self.assertTrue(service.current_rate.current)
+        self.assertEquals(Rate.objects.filter(current=True).count(), 12)
+        for service in Service.objects.all()[:2]:
+            rates = list(service.rate_set.order_by('date_effective'))
+            self.assertEquals([rate.effective_until for rate in rates],
+                              [rate.date_effective for rate in rates[1:]]
+                              + [None])
+
+        self.assertRaises(synthetic.CatalogExistsError,
+                          synthetic.generate_catalog, 1, 1, prefix='a')
+
+    def test_generate_catalog_command(self):
+        """The command should generate the catalog asked for."""
+        call_command('generate_catalog', regions=2, service_types=3,
+                     years=1, stdout=open(os.devnull, 'w'))
+        self.assertEquals(Service.objects.filter(
+            region__name__startswith='gen_').count(), 6)
+        self.assertRaises(CommandError, call_command, 'generate_catalog',
+                          regions=0, stdout=open(os.devnull, 'w'))
+
+
+class BenchmarkTests(TestCase):
+
+    def setUp(self):
+        synthetic.generate_catalog(regions=2, service_types=2, years=1)
+        self.counts = (Region.objects.count(), Service.objects.count(),
+                       Rate.objects.count())
+
+    def test_summarize(self):
+        """Checks the percentiles and means of a run."""
+        result = benchmark.summarize([0.001 * i for i in range(100, 0, -1)],
+                                     [2, 4, None], 2.0, 1)
+        self.assertEquals(result['requests'], 100)
+        self.assertEquals(result['errors'], 1)
+        self.assertEquals(result['throughput'], 50)
+        self.assertEquals(result['latency_ms']['p50'], 50)
+        self.assertEquals(result['latency_ms']['p99'], 99)
+        self.assertEquals(result['latency_ms']['max'], 100)
+        self.assertEquals(result['queries'], {'mean': 3, 'max': 4})
+        self.assertEquals(benchmark.compare(
+            {'a': result}, {'a': dict(result, throughput=100)}),
+            [('a', 1, 1, 0.5, 0)])
+
+    def test_run(self):
+        """Every scenario should run without errors, and the writes
+           should be undone."""
+        dataset = benchmark.Dataset(sample=3)
+        results = benchmark.run(dataset, requests=3, write_requests=2,
+                                warmup=1)
+        for name, function in (benchmark.API_SCENARIOS +
+                               benchmark.MODEL_SCENARIOS):
+            self.assertEquals(results[name]['errors'], 0)
+            self.assertTrue(results[name]['queries'] is not None)
+        self.assertEquals(results['rate_list']['requests'], 3)
+        self.assertEquals(results['set_new_rate']['requests'], 2)
+        self.assertEquals((Region.objects.count(), Service.objects.count(),
+                           Rate.objects.count()), self.counts)
+
+    def test_benchmark_command(self):
+        """The command should save its results, and compare them."""
+        path = tempfile.mktemp(suffix='.json')
+        try:
+            call_command('benchmark', requests=2, write_requests=1,
+                         warmup=0, scenarios=['rate_current'], output=path,
+                         stdout=open(os.devnull, 'w'))
+            with open(path) as stream:
+                results = json.load(stream)
+            self.assertEquals(results['scenarios'].keys(), ['rate_current'])
+            self.assertEquals(results['dataset']['services'], 4)
+            call_command('benchmark', requests=2, scenarios=['rate_current'],
+                         compare=path, stdout=open(os.devnull, 'w'))
+        finally:
+            os.remove(path)
+        self.assertRaises(CommandError, call_command, 'benchmark',
+                          prefix='missing', stdout=open(os.devnull, 'w'))
+
+
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        metrics.clear()
+
+    def tearDown(self):
+        metrics.clear()
+
+    def test_render(self):
+        """Counters and histograms should be rendered in the Prometheus
+           text format."""
+        metrics.inc('clerk_db_queries_total', 3, view='RateList')
+        metrics.inc('clerk_db_queries_total', 2, view='RateList')
+        metrics.observe('clerk_request_duration_seconds', 0.02,
+                        view='RateList')
+        metrics.observe('clerk_request_duration_seconds', 20,
+                        view='RateList')
+        lines = metrics.render().splitlines()
+        self.assertTrue('# TYPE clerk_db_queries_total counter' in lines)
+        self.assertTrue('clerk_db_queries_total{view="RateList"} 5' in lines)
+        for line in ['clerk_request_duration_seconds_bucket{view="RateList"'
+                     ',le="0.01"} 0',
+                     'clerk_request_duration_seconds_bucket{view="RateList"'
+                     ',le="0.025"} 1',
+                     'clerk_request_duration_seconds_bucket{view="RateList"'
+                     ',le="10.0"} 1',
+                     'clerk_request_duration_seconds_bucket{view="RateList"'
+                     ',le="+Inf"} 2',
+                     'clerk_request_duration_seconds_sum{view="RateList"} '
+                     '20.02',
+                     'clerk_request_duration_seconds_count{view="RateList"} '
+                     '2']:
+            self.assertTrue(line in lines, line)
+
+    def test_processes(self):
+        """The metrics of every process sharing the directory should be
+           added up."""
+        directory = tempfile.mkdtemp()
+        try:
+            with self.settings(CLERK_METRICS_DIR=directory):
+                metrics.inc('clerk_cache_requests_total', cache='rate',
+                            result='hit')
+                metrics.observe('clerk_db_duration_seconds', 0.002,
+                                view='RateCurrent')
+                metrics.flush()
+                self.assertTrue(os.path.exists(metrics.get_path(os.getpid())))
+                # as if written by another process, which then exited.
+                os.rename(metrics.get_path(os.getpid()),
+                          os.path.join(directory, '1.json'))
+                metrics.clear()
+                metrics.inc('clerk_cache_requests_total', cache='rate',
+                            result='hit')
+                lines = metrics.render().splitlines()
+        finally:
+            for filename in os.listdir(directory):
+                os.remove(os.path.join(directory, filename))
+            os.rmdir(directory)
+        self.assertTrue('clerk_cache_requests_total{cache="rate",'
+                        'result="hit"} 2' in lines)
+        self.assertTrue('clerk_db_duration_seconds_count{view="RateCurrent"} '
+                        '1' in lines)
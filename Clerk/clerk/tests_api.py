@@ -1,6 +1,20 @@
+import datetime
+import json
+import logging
+import re
+from StringIO import StringIO
 from rest_framework.test import APITestCase
 from django.contrib.auth.models import User
 from rest_framework import status
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.urlresolvers import RegexURLPattern
+from django.db import connection
+from django.db.models import F
+from django.test.utils import CaptureQueriesContext
+from clerk import (archive, catalogcache, metrics, ratecache, resolver,
+                   synthetic, timeline, urls)
+from clerk.instrumentation import QUERIES_HEADER
+from clerk.models import Catalog, Region, Service, Service_Type, Rate
 from clerk.tests import create_date
 
 
@@ -16,6 +30,19 @@ def login_client(testcase):
     testcase.login(username='lauren', password='secret')
 
 
+def assert_query_budget(testcase, response, budget, label):
+    """Fails if the response took more queries than its budget, as
+       counted by clerk.instrumentation, along with those made reading
+       a streamed response through."""
+    queries = int(response[QUERIES_HEADER])
+    if response.streaming:
+        with CaptureQueriesContext(connection) as context:
+            ''.join(response.streaming_content)
+        queries += len(context.captured_queries)
+    testcase.assertTrue(queries <= budget, "%s took %d queries, its budget "
+                        "is %d." % (label, queries, budget))
+
+
 def create_region_and_services(testcase, servName, locName, rate):
     data = {'name': servName, 'pretty_name': servName,
             'description': 'this is a service type'}
@@ -213,6 +240,29 @@ class Region_List_Tests(APITestCase):
                                    'rates/current/')
         self.assertEqual(response.data['rate'], 5)
 
+    def test_post_regions_list_atomic(self):
+        """Should create neither the region nor any of its services if
+           creating them fails part way."""
+        login_client(self.client)
+        create_region_and_services(self, 'serv1', 'loc1', 5)
+        data = {'name': 'loc2', 'description': 'this is a region',
+                'serv1_rate': '5'}
+        # as if a service had been added by another request meanwhile.
+        original = Region.set_new_services
+
+        def set_new_services(region, *args, **kwargs):
+            Service.objects.create(region=region,
+                                   service_type=Service_Type.objects.get())
+            return original(region, *args, **kwargs)
+        Region.set_new_services = set_new_services
+        try:
+            self.assertRaises(AttributeError, self.client.post, '/regions/',
+                              data, format='json')
+        finally:
+            Region.set_new_services = original
+        self.assertFalse(Region.objects.filter(name='loc2').exists())
+        self.assertEqual(Service.objects.count(), 1)
+
     def test_post_regions_list_fail_1(self):
         """Should return a bad request if trying to create a new
            region with the same name"""
@@ -275,6 +325,37 @@ class Region_List_Tests(APITestCase):
                          ['name', 'description'])
 
 
+class Region_Clone_Tests(APITestCase):
+
+    def test_clone(self):
+        """Checks that a region can be cloned with its rates."""
+        login_client(self.client)
+        create_region_and_services(self, 'serv1', 'loc1', 5)
+        data = {'name': 'loc2'}
+        response = self.client.post('/regions/loc1/clone/', data,
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['name'], 'loc2')
+        response = self.client.get('/regions/loc2/services/serv1/' +
+                                   'rates/current/')
+        self.assertEqual(response.data['rate'], 5)
+
+    def test_clone_fail(self):
+        """Should return a bad request for a taken or invalid name, and
+           not found for an unknown region."""
+        login_client(self.client)
+        create_region_and_services(self, 'serv1', 'loc1', 5)
+        for data in [{}, {'name': 'loc1'}, {'name': 'loc 2'}]:
+            response = self.client.post('/regions/loc1/clone/', data,
+                                        format='json')
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+        response = self.client.post('/regions/loc3/clone/', {'name': 'loc2'},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(Region.objects.count(), 1)
+
+
 class Region_Detail_Tests(APITestCase):
 
     def test_put_region_detail(self):
@@ -396,6 +477,14 @@ class Service_List_Tests(APITestCase):
         for service in services:
             self.assertTrue(service_list.__contains__(service))
 
+    def test_get_services_list_rates(self):
+        """Tests that services are listed with their current rate."""
+        login_client(self.client)
+        create_region_and_services(self, 'serv1', 'loc1', 0.7)
+        response = self.client.get('/regions/loc1/services/')
+        self.assertEqual(response.data[0]['current_rate'], 0.7)
+        self.assertEqual(response.data[0]['next_rate'], None)
+
 
 class Service_Detail_Tests(APITestCase):
 
@@ -494,6 +583,195 @@ class Rate_List_Tests(APITestCase):
         for i in range(21):
             self.assertEqual(str(response.data[i]['rate']), rates[i]['rate'])
 
+    def test_get_rate_list_pages(self):
+        """Checks that rates are paged through in date order,
+           a query per page."""
+        login_client(self.client)
+        create_region_and_services(self, 'serv1', 'loc1', 5)
+        service = Service.objects.get()
+        start = create_date(days=1)
+        for i in range(11):
+            service.set_new_rate(float(i), start + datetime.timedelta(days=i))
+        self.client.logout()
+        resolver.get_service_id('loc1', 'serv1')
+
+        url = '/regions/loc1/services/serv1/rates/?limit=5'
+        rates = []
+        while True:
+            # a query for the page.
+            with self.assertNumQueries(1):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(len(response.data) <= 5)
+            rates += [rate['rate'] for rate in response.data]
+            if not response.has_header('Link'):
+                break
+            url = response['Link'][1:response['Link'].index('>')]
+        self.assertEqual(rates, [5.0] + [float(i) for i in range(11)])
+
+    def test_get_rate_list_range(self):
+        """Checks that only rates effective between from and to are
+           listed."""
+        login_client(self.client)
+        create_region_and_services(self, 'serv1', 'loc1', 5)
+        service = Service.objects.get()
+        start = create_date(days=1)
+        for i in range(5):
+            service.set_new_rate(float(i), start + datetime.timedelta(days=i))
+        response = self.client.get(
+            '/regions/loc1/services/serv1/rates/',
+            {'from': (start + datetime.timedelta(hours=36)).isoformat(),
+             'to': (start + datetime.timedelta(days=3)).isoformat()})
+        self.assertEqual([rate['rate'] for rate in response.data],
+                         [1.0, 2.0, 3.0])
+        self.assertFalse(response.has_header('Link'))
+
+    def test_get_rate_list_fail(self):
+        """Should return a bad request for invalid parameters."""
+        login_client(self.client)
+        create_region_and_services(self, 'serv1', 'loc1', 5)
+        for params in [{'from': 'yesterday'}, {'to': '31/02/2014'},
+                       {'cursor': 'nope'}, {'limit': '0'},
+                       {'limit': 'many'}]:
+            response = self.client.get('/regions/loc1/services/serv1/rates/',
+                                       params)
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(response.data.keys(), params.keys())
+
+
+class Rate_Import_Tests(APITestCase):
+
+    def test_import(self):
+        """Checks that rates can be imported as JSON or CSV."""
+        login_client(self.client)
+        create_region_and_services(self, 'serv1', 'loc1', 0.5)
+        date = create_date(days=1)
+        data = [{'region': 'loc1', 'service_type': 'serv1', 'rate': 0.7,
+                 'date': date.isoformat()}]
+        response = self.client.post('/rates/import/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data, {'imported': 1})
+        response = self.client.post(
+            '/rates/import/', 'region,service_type,rate\nloc1,serv1,0.6\n',
+            content_type='text/csv')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.get('/regions/loc1/services/serv1/' +
+                                   'rates/future/')
+        self.assertEqual(response.data['rate'], 0.7)
+        response = self.client.get('/regions/loc1/services/serv1/' +
+                                   'rates/current/')
+        self.assertEqual(response.data['rate'], 0.6)
+
+    def test_import_fail(self):
+        """Should import nothing from a batch with invalid rows, or for
+           anonymous users."""
+        login_client(self.client)
+        create_region_and_services(self, 'serv1', 'loc1', 0.5)
+        data = [{'region': 'loc1', 'service_type': 'serv1', 'rate': 0.7},
+                {'region': 'loc1', 'service_type': 'serv2', 'rate': 0.7}]
+        response = self.client.post('/rates/import/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['errors'][0]['row'], 1)
+        response = self.client.post(
+            '/rates/import/', 'region,service_type,rate\nloc1,serv1,nan\n',
+            content_type='text/csv')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(sorted(response.data['errors'][0].keys()),
+                         ['rate', 'row'])
+        self.assertEqual(Rate.objects.count(), 1)
+        self.client.logout()
+        response = self.client.post('/rates/import/', data[:1],
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class Rate_Reprice_Tests(APITestCase):
+
+    def test_reprice(self):
+        """Checks that a region's services can be repriced together."""
+        login_client(self.client)
+        create_region_and_services(self, 'serv1', 'loc1', 0.5)
+        data = {'region': 'loc1', 'percent': 10}
+        response = self.client.post('/rates/reprice/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data, {'repriced': 1})
+        response = self.client.get('/regions/loc1/services/serv1/' +
+                                   'rates/current/')
+        self.assertEqual(response.data['rate'], 0.55)
+
+    def test_reprice_fail(self):
+        """Should return a bad request for invalid parameters."""
+        login_client(self.client)
+        create_region_and_services(self, 'serv1', 'loc1', 0.5)
+        for data in [{'percent': 10}, {'region': 'loc1'},
+                     {'region': 'loc1', 'rate': 'free'},
+                     {'region': 'loc1', 'rate': 'nan'},
+                     {'region': 'loc1', 'rate': 'inf'},
+                     {'region': 'loc1', 'percent': 'nan'},
+                     {'region': 'loc1', 'percent': '-inf'},
+                     {'region': 'loc1', 'rate': 1, 'date': 'soon'}]:
+            response = self.client.post('/rates/reprice/', data,
+                                        format='json')
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Rate.objects.count(), 1)
+
+
+class Rate_Archive_Tests(APITestCase):
+
+    def setUp(self):
+        login_client(self.client)
+        create_region_and_services(self, 'serv1', 'loc1', 0.5)
+        self.service = Service.objects.get()
+        self.dates = [create_date(days=-400 + i) for i in range(5)]
+        for i, date in enumerate(self.dates):
+            self.service.set_new_rate(float(i), date)
+        archive.archive_rates(create_date(days=-300))
+        self.client.logout()
+
+    def test_list(self):
+        """Checks that archived rates are listed before the live ones."""
+        url = '/regions/loc1/services/serv1/rates/?limit=2'
+        rates = []
+        while url:
+            response = self.client.get(url)
+            rates += [rate['rate'] for rate in response.data]
+            url = None
+            if response.has_header('Link'):
+                url = response['Link'][1:response['Link'].index('>')]
+        self.assertEqual(rates, [0.0, 1.0, 2.0, 3.0, 4.0, 0.5])
+        date = self.dates[2] + datetime.timedelta(hours=1)
+        response = self.client.get('/regions/loc1/services/serv1/rates/',
+                                   {'from': date.isoformat()})
+        self.assertEqual([rate['rate'] for rate in response.data],
+                         [2.0, 3.0, 4.0, 0.5])
+
+    def test_resolve_and_ratecard(self):
+        """Checks that old dates are answered from the archive."""
+        date = self.dates[2] + datetime.timedelta(hours=1)
+        data = [{'region': 'loc1', 'service_type': 'serv1',
+                 'date': date.isoformat()}]
+        response = self.client.post('/rates/resolve/', data, format='json')
+        self.assertEqual(response.data[0]['rate'], 2.0)
+        response = self.client.get('/ratecard/', {'at': date.isoformat()})
+        self.assertEqual(response.data['regions'], {'loc1': {'serv1': 2.0}})
+
+    def test_resolve_queries(self):
+        """Checks that rows answered from the archive are resolved with
+           one more query, however many there are."""
+        rows = [{'region': 'loc1', 'service_type': 'serv1',
+                 'date': date.isoformat()}
+                for date in self.dates + [create_date(days=-500),
+                                          create_date()]]
+        catalogcache.clear()
+        response = self.client.post('/rates/resolve/', rows, format='json')
+        self.assertEqual([row.get('rate') for row in response.data],
+                         [0.0, 1.0, 2.0, 3.0, 4.0, None, 0.5])
+        self.assertEqual(response.data[5]['errors'],
+                         {'rate': [u'No rate effective at date.']})
+        assert_query_budget(self, response, 5, 'POST /rates/resolve/')
+
 
 class Rate_detail_Tests(APITestCase):
 
@@ -521,3 +799,465 @@ class Rate_detail_Tests(APITestCase):
         response = self.client.get('/regions/loc1/services/serv1/' +
                                    'rates/future/')
         self.assertEqual(response.data['rate'], 17)
+
+
+class Rate_Cache_Tests(APITestCase):
+
+    def test_cache_in_memory(self):
+        """Checks that tests don't share the rate cache of a running
+           instance."""
+        self.assertTrue(isinstance(ratecache.get_rate_cache(),
+                                   LocMemCache))
+
+    def test_get_current_cached(self):
+        """Checks that current and future rates are served from the cache,
+           and that new rates are seen at once."""
+        login_client(self.client)
+        create_region_and_services(self, 'serv1', 'loc1', 0.7)
+        self.client.logout()
+        for kind in ('current', 'future'):
+            url = '/regions/loc1/services/serv1/rates/' + kind + '/'
+            self.client.get(url)
+            with self.assertNumQueries(0):
+                response = self.client.get(url)
+            self.assertEqual(json.loads(response.content)['rate'], 0.7)
+
+        Service.objects.get().set_new_rate(17)
+        for kind in ('current', 'future'):
+            url = '/regions/loc1/services/serv1/rates/' + kind + '/'
+            response = self.client.get(url)
+            self.assertEqual(response.data['rate'], 17)
+
+    def test_get_current_expires(self):
+        """Checks that nothing is cached past the next rate taking over."""
+        login_client(self.client)
+        create_region_and_services(self, 'serv1', 'loc1', 0.7)
+        self.client.logout()
+        # as if the next rate took over before the pointers were updated:
+        Service.objects.update(next_change_at=create_date(days=-1))
+        url = '/regions/loc1/services/serv1/rates/current/'
+        self.client.get(url)
+        # changed behind the back of every cache:
+        Rate.objects.update(rate=0.8)
+        timeline.clear()
+        response = self.client.get(url)
+        self.assertEqual(response.data['rate'], 0.8)
+
+    def test_get_current_versioned(self):
+        """Checks that a write made by another process is seen once the
+           catalog version is read again."""
+        login_client(self.client)
+        create_region_and_services(self, 'serv1', 'loc1', 0.7)
+        self.client.logout()
+        url = '/regions/loc1/services/serv1/rates/current/'
+        etag = self.client.get(url)['ETag']
+        # as if written by another process:
+        Rate.objects.update(rate=0.8)
+        Catalog.objects.update(version=F('version') + 1)
+        timeline.clear()
+        response = self.client.get(url)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(json.loads(response.content)['rate'], 0.7)
+
+        catalogcache.clear()
+        response = self.client.get(url)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data['rate'], 0.8)
+
+
+class Conditional_Get_Tests(APITestCase):
+
+    def test_not_modified(self):
+        """Checks that unchanged resources aren't sent again,
+           until something is written."""
+        login_client(self.client)
+        create_region_and_services(self, 'serv1', 'loc1', 0.7)
+        for url in ['/regions/', '/regions/loc1/services/',
+                    '/regions/loc1/services/serv1/rates/',
+                    '/regions/loc1/services/serv1/rates/current/']:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.get(url,
+                                       HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(response.status_code,
+                             status.HTTP_304_NOT_MODIFIED)
+
+        url = '/regions/'
+        etag = self.client.get(url)['ETag']
+        self.client.patch('/regions/loc1/', {'description': 'changed'},
+                          format='json')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_non_ascii_path(self):
+        """Checks that paths with any characters get an ETag, or a 404,
+           rather than an error."""
+        response = self.client.get('/regions/%C3%BC/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get('/regions/', {'name': u'\xfc'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.has_header('ETag'))
+
+    def test_current_max_age(self):
+        """Checks that current rates may be cached until the next rate
+           takes effect, and no longer."""
+        login_client(self.client)
+        create_region_and_services(self, 'serv1', 'loc1', 0.7)
+        url = '/regions/loc1/services/serv1/rates/current/'
+        response = self.client.get(url)
+        self.assertTrue('no-cache' in response['Cache-Control'])
+        Service.objects.get().set_new_rate(1.5, create_date(minutes=10))
+        response = self.client.get(url)
+        max_age = int(response['Cache-Control'].split('max-age=')[1])
+        self.assertTrue(590 <= max_age <= 600)
+
+
+class Usage_Rating_Tests(APITestCase):
+
+    def test_rate_usage(self):
+        """Checks that usage is charged across rate changes."""
+        login_client(self.client)
+        create_region_and_services(self, 'serv1', 'loc1', 0.5)
+        self.client.logout()
+        start = create_date(days=1)
+        end = start + datetime.timedelta(days=2)
+        Service.objects.get().set_new_rate(
+            1.0, start + datetime.timedelta(days=1))
+        data = [{'region': 'loc1', 'service_type': 'serv1', 'quantity': 1,
+                 'start': start.isoformat(), 'end': end.isoformat()},
+                {'region': 'loc1', 'service_type': 'serv2', 'quantity': 1,
+                 'start': start.isoformat(), 'end': end.isoformat()}]
+        response = self.client.post('/usage/rate/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertAlmostEqual(response.data[0]['charge'],
+                               24 * 0.5 + 24 * 1.0)
+        self.assertTrue('service' in response.data[1]['errors'])
+
+    def test_rate_usage_fail(self):
+        """Should return a bad request if not given a list."""
+        response = self.client.post('/usage/rate/', {'region': 'loc1'},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_rate_usage_stream(self):
+        """Checks that newline delimited usage is streamed back rated."""
+        login_client(self.client)
+        create_region_and_services(self, 'serv1', 'loc1', 0.5)
+        self.client.logout()
+        start = create_date(days=1)
+        row = {'region': 'loc1', 'service_type': 'serv1', 'quantity': 2,
+               'start': start.isoformat(),
+               'end': (start + datetime.timedelta(hours=3)).isoformat()}
+        body = '\n'.join([json.dumps(row), 'not json', json.dumps(row)])
+        response = self.client.post('/usage/rate/stream/', body,
+                                    content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        results = [json.loads(line) for line in
+                   ''.join(response.streaming_content).splitlines()]
+        self.assertEqual(len(results), 3)
+        self.assertAlmostEqual(results[0]['charge'], 3.0)
+        self.assertTrue('errors' in results[1])
+        self.assertEqual(results[0], results[2])
+
+    def test_rate_usage_stream_fail(self):
+        """Only posts should be accepted."""
+        response = self.client.get('/usage/rate/stream/')
+        self.assertEqual(response.status_code,
+                         status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+class Name_Resolver_Tests(APITestCase):
+
+    def test_resolved_names_cached(self):
+        """Checks that repeated requests for the same service,
+           known or not, don't look names up again."""
+        login_client(self.client)
+        create_region_and_services(self, 'serv1', 'loc1', 0.7)
+        self.client.logout()
+        url = '/regions/loc1/services/serv1/'
+        self.client.get(url)
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual(response.data['service_type'], 'serv1')
+
+        url = '/regions/loc2/services/serv1/'
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_resolved_names_invalidated(self):
+        """Checks that renaming or creating regions is seen at once."""
+        login_client(self.client)
+        create_region_and_services(self, 'serv1', 'loc1', 0.7)
+        response = self.client.get('/regions/loc2/services/serv1/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.client.patch('/regions/loc1/', {'name': 'loc2'}, format='json')
+        response = self.client.get('/regions/loc2/services/serv1/')
+        self.assertEqual(response.data['region'], 'loc2')
+        response = self.client.get('/regions/loc1/services/serv1/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_resolved_names_kept(self):
+        """Checks that creating regions, or editing anything but names,
+           keeps cached names."""
+        login_client(self.client)
+        create_region_and_services(self, 'serv1', 'loc1', 0.7)
+        self.assertEqual(resolver.get_region_id('loc2'), None)
+        resolver.get_service_id('loc1', 'serv1')
+
+        region = Region.objects.create(name='loc2')
+        self.assertEqual(resolver.get_region_id('loc2'), region.pk)
+        region = Region.objects.get(name='loc1')
+        region.description = 'changed'
+        region.save()
+        service_type = Service_Type.objects.get()
+        service_type.description = 'changed'
+        service_type.save()
+        service = Service.objects.get()
+        with self.assertNumQueries(0):
+            self.assertEqual(resolver.get_service_id('loc1', 'serv1'),
+                             service.pk)
+
+
+class Rate_Card_Tests(APITestCase):
+
+    def test_get_rate_card(self):
+        """Checks that the rate card has every service at every region,
+           at the given date."""
+        login_client(self.client)
+        create_region_and_services(self, 'serv1', 'loc1', 0.7)
+        data = {'name': 'loc2', 'description': 'this is a region',
+                'serv1_rate': 0.9}
+        self.client.post('/regions/', data, format='json')
+        now = create_date(days=5)
+        date = str(now.day) + '/' + str(now.month) + '/' + str(now.year)
+        data = {'rate': '17', 'date': date}
+        self.client.post('/regions/loc1/services/serv1/' +
+                         'rates/', data, format='json')
+
+        response = self.client.get('/ratecard/')
+        self.assertEqual(response.data['regions'],
+                         {'loc1': {'serv1': 0.7}, 'loc2': {'serv1': 0.9}})
+        response = self.client.get('/ratecard/',
+                                   {'at': create_date(days=6).isoformat()})
+        self.assertEqual(response.data['regions'],
+                         {'loc1': {'serv1': 17}, 'loc2': {'serv1': 0.9}})
+
+    def test_get_rate_card_fail(self):
+        """Should return a bad request if given an invalid date."""
+        response = self.client.get('/ratecard/', {'at': 'tomorrow'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class Rate_Resolve_Tests(APITestCase):
+
+    def test_resolve_rates(self):
+        """Checks that rows are resolved in the order given,
+           at the date given for each."""
+        login_client(self.client)
+        create_region_and_services(self, 'serv1', 'loc1', 0.7)
+        now = create_date(days=5)
+        date = str(now.day) + '/' + str(now.month) + '/' + str(now.year)
+        data = {'rate': '17', 'date': date}
+        self.client.post('/regions/loc1/services/serv1/' +
+                         'rates/', data, format='json')
+        self.client.logout()
+        data = [{'region': 'loc1', 'service_type': 'serv1'},
+                {'region': 'loc1', 'service_type': 'serv1',
+                 'date': create_date(days=6).isoformat()},
+                {'region': 'loc1', 'service_type': 'serv1',
+                 'date': create_date(days=1).strftime("%d/%m/%Y")}]
+        response = self.client.post('/rates/resolve/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row['rate'] for row in response.data],
+                         [0.7, 17, 0.7])
+
+    def test_resolve_rates_missing(self):
+        """Checks that missing or invalid rows are reported
+           without failing the other rows."""
+        login_client(self.client)
+        create_region_and_services(self, 'serv1', 'loc1', 0.7)
+        data = [{'region': 'loc2', 'service_type': 'serv1'},
+                {'region': 'loc1', 'service_type': 'serv1'},
+                {'region': 'loc1', 'service_type': 'serv2'},
+                {'region': 'loc1'},
+                {'region': 'loc1', 'service_type': 'serv1',
+                 'date': 'tomorrow'}]
+        response = self.client.post('/rates/resolve/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue('service' in response.data[0]['errors'])
+        self.assertEqual(response.data[1]['rate'], 0.7)
+        self.assertTrue('service' in response.data[2]['errors'])
+        self.assertTrue('service_type' in response.data[3]['errors'])
+        self.assertTrue('date' in response.data[4]['errors'])
+
+    def test_resolve_rates_fail(self):
+        """Should return a bad request if not given a list."""
+        data = {'region': 'loc1', 'service_type': 'serv1'}
+        response = self.client.post('/rates/resolve/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+# The most queries each endpoint may take, by url pattern. Every pattern
+# in clerk/urls.py needs at least one request here, and the catalog they
+# are made against has enough rows that a query per row would exceed it.
+REGION = 'q_region_0001'
+SERVICE_TYPE = 'q_type_0002'
+SERVICE = '^regions/(?P<name>\\w+)/services/(?P<serv_type>\\w+)/'
+QUERY_BUDGETS = {
+    SERVICE + 'rates/current/$': [
+        ('get', 'rates/current/', None, 5)],
+    SERVICE + 'rates/future/$': [
+        ('get', 'rates/future/', None, 4)],
+    SERVICE + 'rates/$': [
+        ('get', 'rates/', None, 4),
+        ('post', 'rates/', {'rate': '0.5'}, 17)],
+    SERVICE + '$': [
+        ('get', '', None, 5)],
+    '^regions/(?P<name>\\w+)/services/$': [
+        ('get', '/regions/%s/services/' % REGION, None, 6)],
+    '^regions/(?P<name>\\w+)/clone/$': [
+        ('post', '/regions/%s/clone/' % REGION, {'name': 'copy'}, 20)],
+    '^regions/(?P<name>\\w+)/$': [
+        ('get', '/regions/%s/' % REGION, None, 5)],
+    '^regions/$': [
+        ('get', '/regions/', None, 4),
+        ('post', '/regions/', dict([('name', 'new'), ('description', 'new')]
+                                   + [('q_type_%04d_rate' % i, 1)
+                                      for i in range(4)]), 21)],
+    '^rates/resolve/$': [
+        ('post', '/rates/resolve/', [{'region': REGION,
+                                      'service_type': 'q_type_%04d' % i}
+                                     for i in range(4)], 4)],
+    '^rates/import/$': [
+        ('post', '/rates/import/', [{'region': REGION,
+                                     'service_type': 'q_type_%04d' % i,
+                                     'rate': 1} for i in range(4)], 15)],
+    '^rates/reprice/$': [
+        ('post', '/rates/reprice/', {'region': REGION, 'percent': 10}, 15)],
+    '^ratecard/$': [
+        ('get', '/ratecard/', None, 4)],
+    '^usage/rate/$': [
+        ('post', '/usage/rate/', [{'region': REGION,
+                                   'service_type': 'q_type_%04d' % i,
+                                   'quantity': 1, 'start': '01/01/2000',
+                                   'end': '01/01/2030'}
+                                  for i in range(4)], 3)],
+    '^usage/rate/stream/$': [
+        ('post', '/usage/rate/stream/', '\n'.join(
+            json.dumps({'region': REGION, 'service_type': 'q_type_%04d' % i,
+                        'quantity': 1, 'start': '01/01/2000',
+                        'end': '01/01/2030'}) for i in range(4)), 3)],
+    '^service_types/(?P<name>\\w+)/$': [
+        ('get', '/service_types/%s/' % SERVICE_TYPE, None, 5)],
+    '^service_types/$': [
+        ('get', '/service_types/', None, 4)],
+    '^metrics$': [
+        ('get', '/metrics', None, 2)],
+}
+
+
+class Query_Budget_Tests(APITestCase):
+
+    def setUp(self):
+        synthetic.generate_catalog(regions=5, service_types=4, years=2,
+                                   prefix='q')
+        login_client(self.client)
+
+    def test_every_endpoint_has_a_budget(self):
+        """Checks that every url pattern has a query budget."""
+        patterns = [pattern.regex.pattern for pattern in urls.urlpatterns
+                    if isinstance(pattern, RegexURLPattern) and
+                    '(?P<format>' not in pattern.regex.pattern]
+        self.assertEqual(sorted(patterns), sorted(QUERY_BUDGETS.keys()))
+
+    def test_instrumentation(self):
+        """Checks that the queries and timings of a request are returned
+           in headers and logged."""
+        stream = StringIO()
+        logger = logging.getLogger('clerk.instrumentation')
+        # only to the stream, not the console handler from settings.
+        self.addCleanup(setattr, logger, 'handlers', logger.handlers)
+        self.addCleanup(setattr, logger, 'propagate', logger.propagate)
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.handlers = [logging.StreamHandler(stream)]
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        response = self.client.get('/regions/')
+        self.assertEqual(response[QUERIES_HEADER], '4')
+        self.assertTrue(re.match(r'^db;dur=[\d.]+;desc="4 queries", '
+                                 r'view;dur=[\d.]+, total;dur=[\d.]+$',
+                                 response['Server-Timing']))
+        line = json.loads(stream.getvalue())
+        self.assertEqual((line['method'], line['path'], line['status'],
+                          line['view'], line['queries']),
+                         ('GET', '/regions/', 200, 'RegionList', 4))
+
+    def test_queries_not_kept(self):
+        """Checks that queries are counted without being kept, unless
+           something else keeps them."""
+        debug = connection.use_debug_cursor
+        response = self.client.get('/regions/')
+        self.assertEqual(response[QUERIES_HEADER], '4')
+        self.assertEqual(connection.queries, [])
+        self.assertEqual(connection.use_debug_cursor, debug)
+
+        catalogcache.clear()
+        with self.assertNumQueries(4):
+            response = self.client.get('/regions/')
+        self.assertEqual(response[QUERIES_HEADER], '4')
+
+    def test_query_budgets(self):
+        """Checks that no endpoint takes more queries than its budget."""
+        for pattern, requests in sorted(QUERY_BUDGETS.items()):
+            for method, path, data, budget in requests:
+                # as if the request reached another process.
+                catalogcache.clear()
+                if pattern.startswith(SERVICE):
+                    path = '/regions/%s/services/%s/%s' % (
+                        REGION, SERVICE_TYPE, path)
+                if isinstance(data, basestring):
+                    response = self.client.post(
+                        path, data, content_type='application/x-ndjson')
+                elif method == 'get':
+                    response = self.client.get(path)
+                else:
+                    response = self.client.post(path, data, format='json')
+                label = '%s %s' % (method.upper(), path)
+                self.assertTrue(response.status_code < 300,
+                                "%s returned %d." % (label,
+                                                     response.status_code))
+                assert_query_budget(self, response, budget, label)
+
+
+class Metrics_Tests(APITestCase):
+
+    def setUp(self):
+        login_client(self.client)
+        create_region_and_services(self, 'serv1', 'loc1', 0.5)
+        metrics.clear()
+
+    def tearDown(self):
+        metrics.clear()
+
+    def test_metrics(self):
+        """Checks that requests and cache lookups are counted by view."""
+        for i in range(2):
+            self.client.get('/regions/loc1/services/serv1/rates/current/',
+                            HTTP_ACCEPT='application/json')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        lines = response.content.splitlines()
+        for line in ['clerk_requests_total{method="GET",status="200",'
+                     'view="RateCurrent"} 2',
+                     'clerk_request_duration_seconds_count{'
+                     'view="RateCurrent"} 2',
+                     'clerk_db_duration_seconds_count{view="RateCurrent"} 2',
+                     'clerk_cache_requests_total{cache="rate",'
+                     'result="hit"} 1',
+                     'clerk_cache_requests_total{cache="rate",'
+                     'result="miss"} 1']:
+            self.assertTrue(line in lines, line)
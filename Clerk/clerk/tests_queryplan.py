@@ -0,0 +1,122 @@
+import re
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from clerk import synthetic
+from clerk.admin import RateAdmin, ServiceAdmin
+from clerk.models import Service, Rate
+from clerk.tests import create_date
+from clerk.views import history_page
+
+REGIONS = 10
+SERVICE_TYPES = 10
+# about 50 rates per service, some of them in the future.
+YEARS = 10
+CHANGES_PER_YEAR = 5
+
+
+def seed_rates():
+    """Generates a catalog large enough for the query planner
+       to prefer indexes over table scans."""
+    synthetic.generate_catalog(regions=REGIONS, service_types=SERVICE_TYPES,
+                               years=YEARS,
+                               changes_per_year=CHANGES_PER_YEAR,
+                               prefix='plan')
+    connection.cursor().execute("ANALYZE")
+
+
+def full_table_scans(queryset):
+    """Returns the tables the database would read in full
+       to evaluate the given queryset."""
+    sql, params = queryset.query.sql_with_params()
+    cursor = connection.cursor()
+    if connection.vendor == 'sqlite':
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        scans = []
+        for row in cursor.fetchall():
+            # detail is e.g. 'SCAN TABLE clerk_rate' or 'SCAN clerk_rate',
+            # but not 'SCAN clerk_rate USING INDEX ...'
+            match = re.match(r'^SCAN (TABLE )?(\w+)$', row[-1])
+            if match:
+                scans.append(match.group(2))
+        return scans
+    elif connection.vendor == 'mysql':
+        cursor.execute("EXPLAIN " + sql, params)
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row))['table']
+                for row in cursor.fetchall()
+                if dict(zip(columns, row))['type'] == 'ALL']
+    else:
+        cursor.execute("EXPLAIN " + sql, params)
+        return [re.search(r'Seq Scan on (\w+)', row[0]).group(1)
+                for row in cursor.fetchall() if 'Seq Scan on' in row[0]]
+
+
+def changelist_queryset(model_admin_class, model, params):
+    """Returns the queryset the admin changelist for the given model
+       pages through, when filtered by the given parameters."""
+    request = RequestFactory().get('/admin/', params)
+    request.user = User(is_superuser=True, is_staff=True)
+    model_admin = model_admin_class(model, admin.site)
+    ChangeList = model_admin.get_changelist(request)
+    changelist = ChangeList(
+        request, model, model_admin.get_list_display(request),
+        model_admin.get_list_display_links(
+            request, model_admin.get_list_display(request)),
+        model_admin.get_list_filter(request), model_admin.date_hierarchy,
+        model_admin.search_fields, model_admin.list_select_related,
+        model_admin.list_per_page, model_admin.list_max_show_all,
+        model_admin.list_editable, model_admin)
+    return changelist.queryset[:model_admin.list_per_page]
+
+
+class RateQueryPlanTests(TestCase):
+    """Fails if any of the hot rate queries falls back to reading
+       the whole of a table."""
+
+    def setUp(self):
+        seed_rates()
+        self.service = Service.objects.all()[SERVICE_TYPES + 1]
+
+    def assertNoFullScans(self, queryset):
+        self.assertEquals(full_table_scans(queryset), [])
+
+    def test_rate_timeline(self):
+        """The query loading the timeline behind get_current_rate,
+           get_next_future_rate and get_rate_nearest_to."""
+        self.assertNoFullScans(Rate.objects.filter(service=self.service.pk))
+
+    def test_rate_list(self):
+        """The keyset pages read by RateList.get, filtered and not."""
+        rate = self.service.rate_set.order_by('date_effective')[10]
+        after = (rate.date_effective, rate.pk)
+        for filters in [{}, {'after': after},
+                        {'start': create_date(-365), 'end': create_date()},
+                        {'start': create_date(-365), 'after': after}]:
+            self.assertNoFullScans(history_page(Rate, self.service.pk,
+                                                filters, 100))
+
+    def test_set_new_rate(self):
+        """The queries made by set_new_rate to keep the intervals."""
+        date = create_date()
+        self.assertNoFullScans(self.service.rate_set.filter(
+            date_effective__gt=date).order_by('date_effective')[:1])
+        self.assertNoFullScans(self.service.rate_set.effective_at(date))
+
+    def test_rate_changelist(self):
+        """The rate admin changelist, filtered as it usually is."""
+        self.assertNoFullScans(changelist_queryset(RateAdmin, Rate, {
+            'region__id__exact': self.service.region_id}))
+        self.assertNoFullScans(changelist_queryset(RateAdmin, Rate, {
+            'region__id__exact': self.service.region_id,
+            'service_type__id__exact': self.service.service_type_id}))
+        self.assertNoFullScans(changelist_queryset(RateAdmin, Rate, {
+            'current': 'True'}))
+
+    def test_service_changelist(self):
+        """The service admin changelist, filtered by region."""
+        self.assertNoFullScans(changelist_queryset(ServiceAdmin, Service, {
+            'region__id__exact': self.service.region_id}))
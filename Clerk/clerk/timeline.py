@@ -0,0 +1,227 @@
+"""An in-process index of the rate history of each service.
+
+Holds the rates of a service sorted by date_effective so that the
+current, next and as-of lookups on Service are answered with a binary
+search instead of a query per call. Timelines are built lazily on first
+use, patched once a new rate is committed, and dropped whenever rates
+are edited or deleted (see the signal handlers at the bottom of
+models.py). A rate saved inside a transaction only drops the timeline,
+so a rate that is rolled back is never seen.
+
+Timelines keep a TimelineRate tuple of each rate rather than the model
+instance. At most CLERK_TIMELINE_MAX_ENTRIES are kept, the least
+recently used being dropped first. Each process keeps its own
+timelines, so they are also rebuilt once they are older than
+CLERK_TIMELINE_TIMEOUT seconds to pick up writes made by other
+processes."""
+from bisect import bisect_left, bisect_right
+from collections import namedtuple, OrderedDict
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from clerk import metrics
+
+# seconds a timeline is trusted before it is rebuilt from the database.
+DEFAULT_TIMEOUT = 300
+# services whose rates are loaded per query by get_timelines, this keeps
+# the query under the parameter limits of sqlite.
+LOAD_BATCH_SIZE = 500
+# services whose timelines are kept at once.
+DEFAULT_MAX_ENTRIES = 10000
+
+# the fields of a rate kept by a timeline, with the names of the model's.
+FIELDS = ('pk', 'rate', 'date_effective', 'effective_until', 'created',
+          'current', 'service_id', 'service_type_id', 'region_id')
+TimelineRate = namedtuple('TimelineRate', FIELDS)
+
+# service pk: timeline, least recently used first.
+_timelines = OrderedDict()
+_lock = threading.RLock()
+
+
+def get_timeout():
+    return getattr(settings, 'CLERK_TIMELINE_TIMEOUT', DEFAULT_TIMEOUT)
+
+
+def get_max_entries():
+    return getattr(settings, 'CLERK_TIMELINE_MAX_ENTRIES',
+                   DEFAULT_MAX_ENTRIES)
+
+
+def load_rates(**filters):
+    """Returns a TimelineRate for each rate matching the filters."""
+    from clerk.models import Rate
+
+    # the pk is loaded by its column name, id.
+    return [TimelineRate._make(values) for values in
+            Rate.objects.filter(**filters).values_list('id', *FIELDS[1:])]
+
+
+def as_rate(entry):
+    """Returns a Rate instance for a TimelineRate, or None for None."""
+    from clerk.models import Rate
+
+    if entry is None:
+        return None
+    return Rate(**entry._asdict())
+
+
+class RateTimeline(object):
+    """The rates of a single service, ordered by date_effective.
+       Rates sharing a date_effective are ordered by pk, so the most
+       recently created one wins."""
+
+    def __init__(self, rates):
+        rates = sorted(rates, key=lambda rate: (rate.date_effective,
+                                                rate.pk))
+        self.dates = [rate.date_effective for rate in rates]
+        self.rates = rates
+        self.built = time.time()
+
+    def __len__(self):
+        return len(self.rates)
+
+    def is_stale(self):
+        return time.time() - self.built > get_timeout()
+
+    def add(self, rate):
+        """Inserts a newly created rate in date order, unless the
+           timeline was loaded with it already."""
+        with _lock:
+            start = bisect_left(self.dates, rate.date_effective)
+            index = bisect_right(self.dates, rate.date_effective)
+            if any(entry.pk == rate.pk for entry in self.rates[start:index]):
+                return
+            if index > 0:
+                # mirrors the interval update made by set_new_rate.
+                self.rates[index - 1] = self.rates[index - 1]._replace(
+                    effective_until=rate.date_effective)
+            self.dates.insert(index, rate.date_effective)
+            self.rates.insert(index, TimelineRate._make(
+                getattr(rate, field) for field in FIELDS))
+
+    def rate_at(self, date):
+        """Returns the most recent rate effective on or before date."""
+        with _lock:
+            index = bisect_right(self.dates, date)
+            if index > 0:
+                return self.rates[index - 1]
+            return None
+
+    def rate_after(self, date):
+        """Returns the first rate effective strictly after date."""
+        with _lock:
+            index = bisect_right(self.dates, date)
+            if index < len(self.rates):
+                # the last of any rates sharing that date takes effect.
+                index = bisect_right(self.dates, self.dates[index])
+                return self.rates[index - 1]
+            return None
+
+    def segments(self, start, end):
+        """Splits the period from start to end wherever the rate changes.
+           Returns a list of (start, end, rate) tuples, with rate None for
+           any part before the first rate took effect."""
+        with _lock:
+            segments = []
+            index = bisect_right(self.dates, start)
+            rate = self.rates[index - 1] if index > 0 else None
+            while index < len(self.dates) and self.dates[index] < end:
+                boundary = self.dates[index]
+                segments.append((start, boundary, rate))
+                # the last of any rates sharing a date takes effect.
+                index = bisect_right(self.dates, boundary)
+                start, rate = boundary, self.rates[index - 1]
+            segments.append((start, end, rate))
+            return segments
+
+
+def _get(service_id):
+    # a timeline in use moves to the end, away from being dropped.
+    with _lock:
+        timeline = _timelines.pop(service_id, None)
+        if timeline is None or timeline.is_stale():
+            return None
+        _timelines[service_id] = timeline
+        return timeline
+
+
+def _put(service_id, timeline):
+    with _lock:
+        _timelines.pop(service_id, None)
+        _timelines[service_id] = timeline
+        while len(_timelines) > get_max_entries():
+            _timelines.popitem(last=False)
+
+
+def get_timeline(service_id):
+    """Returns the timeline for the service with the given pk,
+       building it from the database if needed."""
+    timeline = _get(service_id)
+    if timeline is None:
+        metrics.inc('clerk_cache_requests_total', cache='timeline',
+                    result='miss')
+        timeline = RateTimeline(load_rates(service=service_id))
+        _put(service_id, timeline)
+    else:
+        metrics.inc('clerk_cache_requests_total', cache='timeline',
+                    result='hit')
+    return timeline
+
+
+def get_timelines(services):
+    """Returns a dict of service pk to timeline for many services,
+       loading any missing timelines with one query per batch
+       of LOAD_BATCH_SIZE services."""
+    timelines = dict()
+    missing = list()
+    for service in services:
+        timeline = _get(service.pk)
+        if timeline is None:
+            missing.append(service.pk)
+        else:
+            timelines[service.pk] = timeline
+    if len(timelines) > 0:
+        metrics.inc('clerk_cache_requests_total', len(timelines),
+                    cache='timeline', result='hit')
+    if len(missing) > 0:
+        metrics.inc('clerk_cache_requests_total', len(missing),
+                    cache='timeline', result='miss')
+
+    for start in range(0, len(missing), LOAD_BATCH_SIZE):
+        batch = missing[start:start + LOAD_BATCH_SIZE]
+        rates = dict((pk, []) for pk in batch)
+        for rate in load_rates(service__in=batch):
+            rates[rate.service_id].append(rate)
+        for pk in batch:
+            timelines[pk] = RateTimeline(rates[pk])
+            _put(pk, timelines[pk])
+    return timelines
+
+
+def add_rate(rate):
+    """Patches the timeline of the rate's service, if one is loaded.
+       Inside a transaction the timeline is dropped instead, as the rate
+       may yet be rolled back, so should be added again once committed."""
+    if connection.in_atomic_block:
+        invalidate(rate.service_id)
+        return
+    with _lock:
+        timeline = _timelines.get(rate.service_id)
+    if timeline is not None:
+        timeline.add(rate)
+
+
+def invalidate(service_id):
+    """Drops the timeline for a service so it is rebuilt on next use."""
+    with _lock:
+        _timelines.pop(service_id, None)
+
+
+def clear():
+    """Drops every loaded timeline."""
+    with _lock:
+        _timelines.clear()
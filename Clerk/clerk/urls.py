@@ -14,13 +14,26 @@ urlpatterns = format_suffix_patterns(patterns('',
         views.ServiceDetail.as_view()),
     url(r'^regions/(?P<name>\w+)/services/$',
         views.ServiceList.as_view()),
+    url(r'^regions/(?P<name>\w+)/clone/$',
+        views.RegionClone.as_view()),
     url(r'^regions/(?P<name>\w+)/$',
         views.RegionDetail.as_view()),
     url(r'^regions/$', views.RegionList.as_view()),
+    url(r'^rates/resolve/$', views.RateResolve.as_view()),
+    url(r'^rates/import/$', views.RateImport.as_view()),
+    url(r'^rates/reprice/$', views.RateReprice.as_view()),
+    url(r'^ratecard/$', views.RateCard.as_view()),
+    url(r'^usage/rate/$', views.UsageRating.as_view()),
+    url(r'^usage/rate/stream/$', views.usage_rate_stream),
     url(r'^service_types/(?P<name>\w+)/$', views.ServiceTypeDetail.as_view()),
     url(r'^service_types/$', views.ServiceTypeList.as_view())
 ))
 
+# Metrics for monitoring, in the Prometheus text format
+urlpatterns += patterns('',
+    url(r'^metrics$', views.export_metrics),
+)
+
 # Login and logout views for the browsable API
 urlpatterns += patterns('',
     url(r'^api-auth/', include('rest_framework.urls',
@@ -1,43 +1,80 @@
-from clerk.models import Region, Service, Service_Type
+from clerk.models import ArchivedRate, Region, Service, Service_Type, Rate
+from clerk import (importer, metrics, ratecache, rating, repricing, resolver,
+                   timeline)
+from clerk.dates import parse_date, DATE_ERROR
+from clerk.conditional import (catalog_condition, get_catalog,
+                               rate_condition, ratecard_condition)
+from clerk.parsers import CSVParser
 from clerk.serializers import (RegionSerializer, ServiceSerializer,
                                RateSerializer, ServiceTypeSerializer)
-from django.http import Http404
+from django.db import transaction
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from datetime import datetime
+from django.utils import timezone
 from rest_framework import permissions
+from rest_framework.settings import api_settings
+import base64
+import math
 import re
 
+# rates listed per page by default, and at most, by RateList.
+RATE_PAGE_SIZE = 100
+MAX_RATE_PAGE_SIZE = 1000
+
+NO_RATE_ERROR = u'No rate effective at date.'
+
 
 # Helper Methods:
 
 def get_service_type(name):
+    pk = resolver.get_service_type_id(name)
     try:
-        return Service_Type.objects.get(name__exact=name)
+        if pk is not None:
+            return Service_Type.objects.get(pk=pk)
     except Service_Type.DoesNotExist:
-        raise Http404
+        resolver.clear()
+    raise Http404
 
 
 def get_region(name):
+    pk = resolver.get_region_id(name)
     try:
-        return Region.objects.get(name__exact=name)
+        if pk is not None:
+            return Region.objects.get(pk=pk)
     except Region.DoesNotExist:
+        resolver.clear()
+    raise Http404
+
+
+def get_service_id(name, serv_type):
+    pk = resolver.get_service_id(name, serv_type)
+    if pk is None:
         raise Http404
+    return pk
 
 
 def get_service(name, serv_type):
+    pk = resolver.get_service_id(name, serv_type)
     try:
-        loc = get_region(name)
-        return loc.get_service_by_type_name(type=str(serv_type))
+        if pk is not None:
+            return Service.objects.select_related(
+                'region', 'service_type', 'current_rate',
+                'next_rate').get(pk=pk)
     except Service.DoesNotExist:
-        raise Http404
+        resolver.clear()
+    raise Http404
 
 
 class ServiceTypeList(APIView):
     """List all Service Types, or create a new one."""
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
 
+    @catalog_condition
     def get(self, request, format=None):
         servTypes = Service_Type.objects.all()
         serializer = ServiceTypeSerializer(servTypes, many=True)
@@ -60,6 +97,7 @@ class ServiceTypeDetail(APIView):
     """Retrieve or update a Service Type instance."""
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
 
+    @catalog_condition
     def get(self, request, name, format=None):
         servType = get_service_type(name)
         serializer = ServiceTypeSerializer(servType)
@@ -95,6 +133,7 @@ class RegionList(APIView):
     """List all Regions, or create a new Region."""
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
 
+    @catalog_condition
     def get(self, request, format=None):
         regions = Region.objects.all()
         serializer = RegionSerializer(regions, many=True)
@@ -126,13 +165,14 @@ class RegionList(APIView):
         serializer = RegionSerializer(data=request.DATA)
         # also check we don't have additonal errors
         if serializer.is_valid() and not len(errors) > 0:
-            region = serializer.save()
-
-            # once we know all the data is there and valid, we begin creating
-            # all given service types at the new region:
-            for keyword in required.keys():
-                rate = rates[keyword]
-                region.set_new_service(required[keyword], rate)
+            # once we know all the data is there and valid, we create the
+            # region with all given service types, or nothing at all:
+            with transaction.atomic():
+                region = serializer.save()
+                region.set_new_services(
+                    dict((required[keyword], rates[keyword])
+                         for keyword in required.keys()),
+                    user_id=request.user.pk)
 
             return Response(serializer.data, status=status.HTTP_201_CREATED)
 
@@ -140,10 +180,31 @@ class RegionList(APIView):
         return Response(errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class RegionClone(APIView):
+    """Create a new region priced like an existing one, with a copy of
+       each of its services and their current and future rates."""
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def post(self, request, name, format=None):
+        source = get_region(name)
+        data = request.DATA
+        serializer = RegionSerializer(data={
+            'name': data.get('name'),
+            'description': data.get('description', source.description)})
+        if serializer.is_valid():
+            region = source.clone(serializer.object.name,
+                                  serializer.object.description,
+                                  user_id=request.user.pk)
+            return Response(RegionSerializer(region).data,
+                            status=status.HTTP_201_CREATED)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
 class RegionDetail(APIView):
     """Retrieve or update a region instance."""
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
 
+    @catalog_condition
     def get(self, request, name, format=None):
         region = get_region(name)
         serializer = RegionSerializer(region)
@@ -171,8 +232,10 @@ class ServiceList(APIView):
     """List all services, or create a new services."""
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
 
+    @catalog_condition
     def get(self, request, name, format=None):
-        services = get_region(name).service_set.all()
+        services = get_region(name).service_set.select_related(
+            'region', 'service_type', 'current_rate', 'next_rate')
         serializer = ServiceSerializer(services, many=True)
         return Response(serializer.data)
 
@@ -181,20 +244,100 @@ class ServiceDetail(APIView):
     """Retrieve or update a service instance."""
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
 
+    @catalog_condition
     def get(self, request, name, serv_type, format=None):
         service = get_service(name, serv_type)
         serializer = ServiceSerializer(service)
         return Response(serializer.data)
 
 
+def is_archived(request, date=None, after=None):
+    """Returns whether rates from the given date, or after the given
+       (date_effective, pk) keyset, could have been archived. Without a
+       date they could have been if any have been."""
+    archived_until = get_catalog(request).archived_until
+    if archived_until is None:
+        return False
+    if after is not None and after[0] >= archived_until:
+        return False
+    return date is None or date < archived_until
+
+
+def history_page(model, service_id, filters, limit):
+    """Returns the page of a service's rates, or archived rates, that
+       RateList.get reads, with one more rate than the page holds to
+       tell if there is another.
+       - filters = dict of the arguments to history"""
+    return model.objects.history(**filters).filter(
+        service=service_id).select_related(
+        'service__service_type', 'region')[:limit + 1]
+
+
+def encode_cursor(rate):
+    return base64.urlsafe_b64encode('%s|%s' % (rate.date_effective.isoformat(),
+                                               rate.pk))
+
+
+def decode_cursor(cursor):
+    """Returns the (date_effective, pk) encoded in a cursor.
+       Raises ValueError if it isn't one."""
+    try:
+        date, pk = base64.urlsafe_b64decode(str(cursor)).split('|')
+        return parse_date(date), int(pk)
+    except (TypeError, UnicodeError):
+        raise ValueError(cursor)
+
+
 class RateList(APIView):
-    """List all Rates, or create a new rate."""
+    """List all Rates, or create a new rate.
+       Rates are listed a page at a time in date order. When there are
+       more, the Link header gives the url of the next page."""
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
 
+    @catalog_condition
     def get(self, request, name, serv_type, format=None):
-        rates = get_service(name, serv_type).rate_set.all()
+        service_id = get_service_id(name, serv_type)
+        params = request.QUERY_PARAMS
+        filters = dict()
+        errors = dict()
+        for key, arg in (('from', 'start'), ('to', 'end')):
+            if key in params:
+                try:
+                    filters[arg] = parse_date(params[key])
+                except ValueError:
+                    errors[key] = [DATE_ERROR]
+        if 'cursor' in params:
+            try:
+                filters['after'] = decode_cursor(params['cursor'])
+            except ValueError:
+                errors['cursor'] = [u'Must be a cursor from a Link header.']
+        limit = RATE_PAGE_SIZE
+        if 'limit' in params:
+            try:
+                limit = int(params['limit'])
+                if not 0 < limit <= MAX_RATE_PAGE_SIZE:
+                    raise ValueError
+            except ValueError:
+                errors['limit'] = [u'Must be a whole number from 1 to %d'
+                                   % MAX_RATE_PAGE_SIZE]
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+        rates = list(history_page(Rate, service_id, filters, limit))
+        if is_archived(request, filters.get('start'), filters.get('after')):
+            # archived rates come first, but share the ordering.
+            rates = sorted(rates + list(history_page(
+                ArchivedRate, service_id, filters, limit)),
+                key=lambda rate: (rate.date_effective, rate.pk))[:limit + 1]
+        headers = dict()
+        if len(rates) > limit:
+            rates = rates[:limit]
+            query = request.GET.copy()
+            query['cursor'] = encode_cursor(rates[-1])
+            headers['Link'] = '<%s?%s>; rel="next"' % (
+                request.build_absolute_uri(request.path), query.urlencode())
         serializer = RateSerializer(rates, many=True)
-        return Response(serializer.data)
+        return Response(serializer.data, headers=headers)
 
     def post(self, request, name, serv_type, format=None):
         service = get_service(name, serv_type)
@@ -216,11 +359,12 @@ class RateList(APIView):
                                 status=status.HTTP_400_BAD_REQUEST)
 
             if date is None:
-                service.set_new_rate(float(rate))
+                service.set_new_rate(float(rate), user_id=request.user.pk)
                 return Response({'rate': rate, 'date': datetime.now()},
                                 status=status.HTTP_201_CREATED)
             else:
-                service.set_new_rate(float(rate), date)
+                service.set_new_rate(float(rate), date,
+                                     user_id=request.user.pk)
                 return Response({'rate': rate, 'date': date},
                                 status=status.HTTP_201_CREATED)
 
@@ -233,17 +377,256 @@ class RateCurrent(APIView):
     """Retrieve the 'current' rate instance."""
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
 
+    @rate_condition
     def get(self, request, name, serv_type, format=None):
-        rate = get_service(name, serv_type).get_current_rate()
+        service_id = get_service_id(name, serv_type)
+        response = ratecache.get_response('current', service_id, request)
+        if response is not None:
+            return response
+
+        service = get_service(name, serv_type)
+        rate = service.get_current_rate()
         serializer = RateSerializer(rate)
-        return Response(serializer.data)
+        return ratecache.set_response('current', service_id, request,
+                                      Response(serializer.data), self,
+                                      expires=service.next_change_at)
 
 
 class RateFuture(APIView):
     """Retrieve the next up coming rate instance."""
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
 
+    @rate_condition
     def get(self, request, name, serv_type, format=None):
-        rate = get_service(name, serv_type).get_next_future_rate()
+        service_id = get_service_id(name, serv_type)
+        response = ratecache.get_response('future', service_id, request)
+        if response is not None:
+            return response
+
+        service = get_service(name, serv_type)
+        rate = service.get_next_future_rate()
         serializer = RateSerializer(rate)
-        return Response(serializer.data)
+        return ratecache.set_response('future', service_id, request,
+                                      Response(serializer.data), self,
+                                      expires=service.next_change_at)
+
+
+class RateCard(APIView):
+    """Retrieve every rate for every service at every region, as they
+       were (or will be) at the date given by 'at', defaulting to now."""
+    permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
+
+    @ratecard_condition
+    def get(self, request, format=None):
+        date = timezone.now()
+        if 'at' in request.QUERY_PARAMS:
+            try:
+                date = parse_date(request.QUERY_PARAMS['at'])
+            except ValueError:
+                return Response({'at': [DATE_ERROR]},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+        regions = dict()
+        rates = list(Rate.objects.effective_at(date).select_related(
+            'region', 'service_type'))
+        if is_archived(request, date):
+            rates += ArchivedRate.objects.effective_at(date).select_related(
+                'region', 'service_type')
+        for rate in rates:
+            services = regions.setdefault(rate.region.name, dict())
+            services[rate.service_type.name] = rate.rate
+        return Response({'date': date, 'regions': regions})
+
+
+class RateImport(APIView):
+    """Schedule many rate changes in one request, as JSON or CSV.
+       Every row is checked before any is imported, so either all of
+       them are imported or none are."""
+    permission_classes = (permissions.IsAuthenticated,)
+    parser_classes = api_settings.DEFAULT_PARSER_CLASSES + [CSVParser]
+
+    def post(self, request, format=None):
+        try:
+            count = importer.import_rates(request.DATA,
+                                          user_id=request.user.pk)
+        except importer.RateImportError as e:
+            return Response({'errors': e.errors},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response({'imported': count}, status=status.HTTP_201_CREATED)
+
+
+class RateReprice(APIView):
+    """Set a new rate, or change the rate by a percentage, for every
+       service of a region, of a service type, or of both."""
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def post(self, request, format=None):
+        data = request.DATA
+        errors = dict()
+        filters = dict()
+        for key in ('region', 'service_type'):
+            if key in data:
+                filters[key + '__name'] = data[key]
+        if len(filters) == 0:
+            errors['non_field_errors'] = [u'Give a region, a service_type ' +
+                                          'or both.']
+        values = dict()
+        for key in ('percent', 'rate'):
+            if key in data:
+                try:
+                    values[key] = float(data[key])
+                    if math.isnan(values[key]) or math.isinf(values[key]):
+                        raise ValueError
+                except (TypeError, ValueError):
+                    errors[key] = [u'Must be a valid number']
+        date = None
+        if 'date' in data:
+            try:
+                date = parse_date(data['date'])
+            except ValueError:
+                errors['date'] = [DATE_ERROR]
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            count = repricing.reprice(Service.objects.filter(**filters),
+                                      date, user_id=request.user.pk,
+                                      **values)
+        except repricing.RepriceError as e:
+            return Response(e.errors, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'repriced': count}, status=status.HTTP_201_CREATED)
+
+
+class RateResolve(APIView):
+    """Resolve the rates for many (region, service_type, date) rows
+       in one request. Rows are answered in the order given."""
+    # Only reads rates, so is as open as the other rate views.
+    permission_classes = (permissions.AllowAny,)
+
+    def post(self, request, format=None):
+        rows = request.DATA
+        if not isinstance(rows, list):
+            return Response({'non_field_errors': [u'Must be a list of ' +
+                                                  'rows to resolve.']},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        # Every service that could match, then all their rates,
+        # regardless of how many rows were given:
+        services = Service.objects.get_by_names(
+            (row.get('region'), row.get('service_type'))
+            for row in rows if isinstance(row, dict))
+        timelines = timeline.get_timelines(services.values())
+
+        now = timezone.now()
+        results = []
+        # rows dated before the live rates of their service, answered
+        # from the archive together below.
+        misses = []
+        for row in rows:
+            result, service = self.resolve(row, services, timelines, now)
+            results.append(result)
+            if service is None:
+                continue
+            if is_archived(request, result['date']):
+                misses.append((result, service))
+            else:
+                result['errors'] = {'rate': [NO_RATE_ERROR]}
+        self.resolve_archived(misses)
+        return Response(results)
+
+    def resolve(self, row, services, timelines, now):
+        """Resolves a row against the live rates. Returns the result,
+           and the service if it had no live rate at the date."""
+        if not isinstance(row, dict):
+            return ({'errors': {'non_field_errors': [u'Must be an object.']}},
+                    None)
+
+        result = {'region': row.get('region'),
+                  'service_type': row.get('service_type'),
+                  'date': now}
+        errors = dict()
+        for key in ('region', 'service_type'):
+            if key not in row:
+                errors[key] = [u'Is a required parameter.']
+        if 'date' in row:
+            try:
+                result['date'] = parse_date(row['date'])
+            except ValueError:
+                errors['date'] = [DATE_ERROR]
+        if errors:
+            result['errors'] = errors
+            return result, None
+
+        service = services.get((unicode(row['region']),
+                                unicode(row['service_type'])))
+        if service is None:
+            result['errors'] = {'service': [u'Not found.']}
+            return result, None
+
+        rate = timelines[service.pk].rate_at(result['date'])
+        if rate is None:
+            return result, service
+        result['rate'] = rate.rate
+        result['date_effective'] = rate.date_effective
+        return result, None
+
+    def resolve_archived(self, misses):
+        """Resolves (result, service) rows against the archived rates,
+           with one query per batch of LOAD_BATCH_SIZE services however
+           many rows there are."""
+        if len(misses) == 0:
+            return
+        dates = [result['date'] for result, service in misses]
+        service_ids = list(set(service.pk for result, service in misses))
+        rates = dict((pk, []) for pk in service_ids)
+        for start in range(0, len(service_ids), timeline.LOAD_BATCH_SIZE):
+            batch = service_ids[start:start + timeline.LOAD_BATCH_SIZE]
+            for rate in ArchivedRate.objects.overlapping(
+                    min(dates), max(dates)).filter(service__in=batch):
+                rates[rate.service_id].append(rate)
+        timelines = dict((pk, timeline.RateTimeline(rates[pk]))
+                         for pk in service_ids)
+
+        for result, service in misses:
+            rate = timelines[service.pk].rate_at(result['date'])
+            if rate is None:
+                result['errors'] = {'rate': [NO_RATE_ERROR]}
+            else:
+                result['rate'] = rate.rate
+                result['date_effective'] = rate.date_effective
+
+
+class UsageRating(APIView):
+    """Rate usage of services, splitting each usage period wherever the
+       rate changed. Rows are answered in the order given."""
+    # Only reads rates, so is as open as the other rate views.
+    permission_classes = (permissions.AllowAny,)
+
+    def post(self, request, format=None):
+        rows = request.DATA
+        if not isinstance(rows, list):
+            return Response({'non_field_errors': [u'Must be a list of ' +
+                                                  'usage to rate.']},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response(rating.rate_rows(rows))
+
+
+@csrf_exempt
+@require_POST
+def usage_rate_stream(request, format=None):
+    """Rate usage posted as newline delimited JSON, one row per line,
+       streaming back a line of JSON for each row in the same order.
+       The body is read, and the results written, a chunk at a time,
+       so runs of any size are rated in constant memory."""
+    # A plain view, as the api views parse the whole body up front.
+    # Only reads rates, so is as open as the other rate views.
+    return StreamingHttpResponse(rating.rate_stream(request),
+                                 content_type='application/x-ndjson')
+
+
+@require_GET
+def export_metrics(request):
+    """Every metric, added up across the processes sharing
+       CLERK_METRICS_DIR, in the Prometheus text format."""
+    return HttpResponse(metrics.render(),
+                        content_type='text/plain; version=0.0.4')